@@ -8,23 +8,54 @@ from flask import (
     session,
     jsonify,
     send_file,
+    Response,
+    stream_with_context,
+    g,
+    has_app_context,
+    has_request_context,
 )
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session as _SessaoFlask
+from werkzeug.datastructures import CallbackDict
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
 from functools import wraps
-from datetime import datetime, timedelta
+import contextlib
+import threading
+import click
+from datetime import date, datetime, timedelta
 from dotenv import load_dotenv, find_dotenv
-from sqlalchemy import text
+from sqlalchemy import event, text
+from sqlalchemy.exc import IntegrityError, OperationalError
+from markupsafe import Markup
 from sqlalchemy.pool import NullPool
 
 import os
 from pathlib import Path
 import io
+import hashlib
+import atexit
+import json
+import queue
+import random
+import csv
+import secrets
+import select
+import tempfile
+import time
+import zlib
+import re
+import math
+import unicodedata
+from collections import OrderedDict, defaultdict
 try:
     import pandas as pd
+    import numpy as np
 except Exception:
     pd = None
+    np = None
 
 try:
     from reportlab.lib.pagesizes import letter, landscape
@@ -35,6 +66,17 @@ except Exception:
     # If reportlab not installed, PDF export will fail later with a clear error
     pass
 
+try:
+    from openpyxl import Workbook
+except Exception:
+    Workbook = None
+
+try:
+    import brotli
+except Exception:
+    # Sem brotli as respostas são comprimidas apenas com gzip
+    brotli = None
+
 # Carrega o .env do repositório (procura em parents se necessário)
 load_dotenv(find_dotenv())
 
@@ -46,10 +88,31 @@ app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
     "poolclass": NullPool,
     "pool_pre_ping": True,
 }
+# Fora do serverless (gunicorn.conf.py) cada worker mantém um pool com uma conexão por thread
+app.config['DB_POOL_SIZE'] = int(os.getenv('DB_POOL_SIZE', 0))  # 0 = NullPool
+if app.config['DB_POOL_SIZE'] > 0:
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+        "pool_size": app.config['DB_POOL_SIZE'],
+        "max_overflow": int(os.getenv('DB_MAX_OVERFLOW', 2)),
+        "pool_recycle": int(os.getenv('DB_POOL_RECYCLE', 1800)),  # segundos
+        "pool_pre_ping": True,
+    }
+# Réplica de leitura opcional para as rotas GET (ver `leitura`)
+if os.getenv("DATABASE_REPLICA_URL"):
+    app.config["SQLALCHEMY_BINDS"] = {"replica": os.getenv("DATABASE_REPLICA_URL")}
+app.config['REPLICA_CHECK_INTERVAL'] = float(os.getenv('REPLICA_CHECK_INTERVAL', 5))  # segundos
+app.config['REPLICA_MAX_LAG_BYTES'] = int(os.getenv('REPLICA_MAX_LAG_BYTES', 1024 * 1024))  # WAL
+app.config['REPLICA_RYW_JANELA'] = float(os.getenv('REPLICA_RYW_JANELA', 10))  # segundos após uma escrita
 # Usa `SECRET_KEY` se definido, senão tenta `SESSION_KEY` (compatibilidade)
 app.config["SECRET_KEY"] = os.getenv("SECRET_KEY") or os.getenv("SESSION_KEY")
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(hours=1)  # Tempo de expiração da sessão de 1 hora
+# Sessões no servidor: "banco" (tabela sessao, vale para várias instâncias) ou "local" (um worker)
+app.config['SESSION_BACKEND'] = os.getenv('SESSION_BACKEND', 'banco')
+# A validade só é renovada (e o cookie reenviado) quando resta menos que esta fração dela
+app.config['SESSION_RENOVAR_FRACAO'] = float(os.getenv('SESSION_RENOVAR_FRACAO', 0.5))
+# Fração das gravações de sessão que também apagam as sessões vencidas
+app.config['SESSION_LIMPEZA_AMOSTRA'] = float(os.getenv('SESSION_LIMPEZA_AMOSTRA', 0.01))
 
 # Configuração para upload de fotos
 # Use diretório temporário em ambientes serverless (Vercel, Lambda)
@@ -60,7 +123,50 @@ UPLOAD_FOLDER.mkdir(parents=True, exist_ok=True)
 app.config['UPLOAD_FOLDER'] = str(UPLOAD_FOLDER)
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # Limite de 16MB
 
-db = SQLAlchemy(app)
+# Compressão de respostas (gzip/brotli)
+app.config['COMPRESS_MIN_SIZE'] = int(os.getenv('COMPRESS_MIN_SIZE', 1024))  # bytes
+app.config['COMPRESS_MIMETYPES'] = {
+    'text/html', 'text/plain', 'text/csv', 'text/css', 'text/event-stream',
+    'application/json', 'application/javascript',
+}
+# Tipos cujo corpo comprimido é guardado em cache (indexado pelo hash do conteúdo)
+app.config['COMPRESS_CACHE_MIMETYPES'] = {'application/json', 'text/css', 'application/javascript'}
+app.config['COMPRESS_CACHE_SIZE'] = 128  # entradas
+
+# Transporte dos eventos de estoque (SSE): "local" (um worker) ou "postgres" (LISTEN/NOTIFY)
+app.config['EVENTOS_BACKEND'] = os.getenv('EVENTOS_BACKEND', 'local')
+# Streams SSE simultâneos por processo; cada um ocupa uma thread do worker.
+# Acima disso a página atualiza as quantidades por polling (/estoque/quantidades).
+app.config['EVENTOS_MAX_STREAMS'] = int(os.getenv('EVENTOS_MAX_STREAMS', 2))
+
+# Log de auditoria: "transacao" (grava junto com a operação) ou "buffer" (lotes em segundo plano)
+app.config['AUDIT_LOG_MODE'] = os.getenv('AUDIT_LOG_MODE', 'transacao')
+app.config['AUDIT_LOG_BATCH'] = int(os.getenv('AUDIT_LOG_BATCH', 200))  # linhas por INSERT
+app.config['AUDIT_LOG_INTERVAL'] = float(os.getenv('AUDIT_LOG_INTERVAL', 1.0))  # segundos
+app.config['AUDIT_LOG_BUFFER_MAX'] = int(os.getenv('AUDIT_LOG_BUFFER_MAX', 10000))  # linhas em memória
+
+# Índice em memória codigo -> mercadoria usado pela leitura de código de barras;
+# alterações de outros workers/instâncias chegam a ele em até este intervalo
+app.config['CODIGO_INDEX_INTERVALO'] = float(os.getenv('CODIGO_INDEX_INTERVALO', 2))  # segundos
+
+
+
+class SessaoRoteada(_SessaoFlask):
+    """Envia leituras para a réplica quando a rota pediu (`g.usar_replica`); o resto vai ao primário."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if (
+            bind is None
+            and not self._flushing
+            and has_app_context()
+            and g.get("usar_replica")
+            and replica_disponivel()
+        ):
+            return db.engines["replica"]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+db = SQLAlchemy(app, session_options={"class_": SessaoRoteada})
 
 # Grupos fixos de produtos
 PRODUCT_GROUPS = [
@@ -71,19 +177,65 @@ PRODUCT_GROUPS = [
     "Geral",
 ]
 
+# Local que recebe o estoque existente e as movimentações sem local informado
+LOCAL_PADRAO = "Principal"
+
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
+def _grupo_do_formulario(padrao_id=None):
+    """Resolve o campo `grupo_id` do formulário para um `Grupo` (ou None se inválido)."""
+    grupo_id = request.form.get("grupo_id", type=int) or padrao_id
+    if grupo_id:
+        return db.session.get(Grupo, grupo_id)
+    return Grupo.query.filter_by(nome="Geral").first()
+
+
+def _mercadorias_do_relatorio():
+    """
+    Aplica os filtros opcionais `grupo_id` e `local_id` da query string; retorna
+    (grupo, local, linhas) com as linhas de `linhas_relatorio`.
+    """
+    grupo = local = None
+    grupo_id = request.args.get('grupo_id', type=int)
+    local_id = request.args.get('local_id', type=int)
+    if local_id:
+        local = db.session.get(LocalEstoque, local_id)
+    if grupo_id:
+        grupo = db.session.get(Grupo, grupo_id)
+    return grupo, local, linhas_relatorio(grupo_id, local_id)
+
+
+def _nome_relatorio(grupo, local):
+    return "_".join(x.nome for x in (grupo, local) if x) or "todos"
+
+
+def _local_do_formulario(campo="local_id"):
+    """Resolve o campo `local_id` do formulário para um `LocalEstoque` (ou None se inválido)."""
+    local_id = request.form.get(campo, type=int)
+    if local_id:
+        return db.session.get(LocalEstoque, local_id)
+    return LocalEstoque.query.filter_by(nome=LOCAL_PADRAO).first()
+
+
 class Mercadoria(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     nome = db.Column(db.String(100), nullable=False)
     codigo = db.Column(db.String(50), nullable=False, unique=True)
-    grupo = db.Column(db.String(100), nullable=False, default="Geral")
+    grupo_id = db.Column(db.Integer, db.ForeignKey("grupo.id"), nullable=False, index=True)
     quantidade = db.Column(db.Integer, nullable=False)
     descricao = db.Column(db.String(200))
     preco = db.Column(db.Float)
+    versao_sync = db.Column(db.BigInteger, nullable=True, index=True)  # Sequência da última alteração
+
+    grupo = db.relationship("Grupo", lazy="joined")
+
+    # Permite que a checagem de duplicidade por lower(codigo) use índice
+    __table_args__ = (
+        db.Index("ix_mercadoria_codigo_lower", db.func.lower(codigo), unique=True),
+    )
 
     def __repr__(self):
         return f"<Mercadoria {self.nome}>"
@@ -122,6 +274,7 @@ class Fornecedor(db.Model):
     endereco = db.Column(db.String(200), nullable=False)
     telefone = db.Column(db.String(15), nullable=False)
     email = db.Column(db.String(100), nullable=False)
+    versao_sync = db.Column(db.BigInteger, nullable=True, index=True)  # Sequência da última alteração
 
     def __repr__(self):
         return f'<Fornecedor {self.nome}>'
@@ -132,10 +285,13 @@ class NotaFiscal(db.Model):
     numero_nf = db.Column(db.String(20), nullable=False, unique=True)
     data_emissao = db.Column(db.Date, nullable=False)
     data_entrega = db.Column(db.Date, nullable=False)
-    fornecedor_id = db.Column(db.Integer, db.ForeignKey('fornecedor.id'), nullable=False)
+    fornecedor_id = db.Column(db.Integer, db.ForeignKey('fornecedor.id'), nullable=False, index=True)
     
     fornecedor = db.relationship('Fornecedor', backref=db.backref('notas_fiscais', lazy=True))
 
+    # Listagem paginada das notas de um fornecedor, mais recentes primeiro
+    __table_args__ = (db.Index("ix_nota_fiscal_fornecedor_emissao", "fornecedor_id", "data_emissao", "id"),)
+
     def __repr__(self):
         return f'<NotaFiscal {self.numero_nf}>'
 
@@ -145,10 +301,25 @@ class ItemNotaFiscal(db.Model):
     descricao = db.Column(db.String(200), nullable=False)
     quantidade = db.Column(db.Integer, nullable=False)
     preco_unitario = db.Column(db.Float, nullable=False)
-    grupo = db.Column(db.String(50), nullable=True)  # Adicionando a coluna grupo
-    nota_fiscal_id = db.Column(db.Integer, db.ForeignKey('nota_fiscal.id'), nullable=False)
+    grupo_id = db.Column(db.Integer, db.ForeignKey('grupo.id'), nullable=True, index=True)
+    nota_fiscal_id = db.Column(db.Integer, db.ForeignKey('nota_fiscal.id'), nullable=False, index=True)
+    mercadoria_id = db.Column(db.Integer, db.ForeignKey('mercadoria.id'), nullable=True, index=True)
+    lote = db.Column(db.String(50), nullable=True)  # Número do lote impresso na NF
+    validade = db.Column(db.Date, nullable=True)
+    lote_id = db.Column(db.Integer, db.ForeignKey('lote.id'), nullable=True)
 
     nota_fiscal = db.relationship('NotaFiscal', backref=db.backref('itens', lazy=True))
+    grupo = db.relationship('Grupo', lazy='joined')
+    mercadoria = db.relationship('Mercadoria', backref=db.backref('itens_nf', lazy=True))
+    lote_estoque = db.relationship('Lote')
+
+    # Contagem e total por nota lidos só do índice
+    __table_args__ = (
+        db.Index(
+            "ix_item_nota_fiscal_nota_valores", "nota_fiscal_id",
+            postgresql_include=["quantidade", "preco_unitario"],
+        ),
+    )
 
     def __repr__(self):
         return f'<ItemNotaFiscal {self.descricao}>'
@@ -161,16 +332,27 @@ class LogMovimentacao(db.Model):
     mercadoria_id = db.Column(db.Integer, db.ForeignKey("mercadoria.id"), nullable=True)
     fornecedor_id = db.Column(db.Integer, db.ForeignKey("fornecedor.id"), nullable=True)
     descricao = db.Column(db.String(200), nullable=False)
-    data_hora = db.Column(db.DateTime, default=datetime.utcnow)
+    quantidade = db.Column(db.Integer, nullable=True)  # Unidades movimentadas (entradas/saídas)
+    local_id = db.Column(db.Integer, db.ForeignKey("local_estoque.id"), nullable=True)
+    data_hora = db.Column(db.DateTime, default=datetime.utcnow, index=True)
 
     usuario = db.relationship("Usuario", backref=db.backref("logs", lazy=True))
     mercadoria = db.relationship("Mercadoria", backref=db.backref("logs", lazy=True))
     fornecedor = db.relationship("Fornecedor", backref=db.backref("logs", lazy=True))
+    local = db.relationship("LocalEstoque")
+
+    # Histórico por local, usuário, mercadoria ou ação em ordem cronológica sem varrer o log inteiro
+    __table_args__ = (
+        db.Index("ix_log_movimentacao_local_data", "local_id", "data_hora"),
+        db.Index("ix_log_movimentacao_usuario_data", "usuario_id", "data_hora"),
+        db.Index("ix_log_movimentacao_mercadoria_data", "mercadoria_id", "data_hora"),
+        db.Index("ix_log_movimentacao_acao_data", "acao", "data_hora"),
+    )
 
 
 class Cirurgia(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    data_cirurgia = db.Column(db.Date, nullable=False)
+    data_cirurgia = db.Column(db.Date, nullable=False, index=True)
     nome_paciente = db.Column(db.String(200), nullable=False)
     referencia_produto = db.Column(db.String(500), nullable=False)  # Referência do produto usado
     foto_path = db.Column(db.String(300), nullable=True)  # Caminho da foto armazenada
@@ -190,91 +372,1680 @@ class Grupo(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     nome = db.Column(db.String(100), nullable=False, unique=True)
     descricao = db.Column(db.String(250), nullable=True)
+    versao_sync = db.Column(db.BigInteger, nullable=True, index=True)  # Sequência da última alteração
 
     def __repr__(self):
         return f"<Grupo {self.nome}>"
 
 
+class LocalEstoque(db.Model):
+    """Sala de estoque ou centro cirúrgico onde as mercadorias ficam guardadas."""
+    __tablename__ = "local_estoque"
+    id = db.Column(db.Integer, primary_key=True)
+    nome = db.Column(db.String(100), nullable=False, unique=True)
+    descricao = db.Column(db.String(250), nullable=True)
+
+    def __repr__(self):
+        return f"<LocalEstoque {self.nome}>"
+
+
+class EstoqueLocal(db.Model):
+    """Saldo de uma mercadoria em um local; `Mercadoria.quantidade` é a soma dos saldos."""
+    __tablename__ = "estoque_local"
+    # PK (local_id, mercadoria_id): as telas de um local leem só a sua faixa do índice
+    local_id = db.Column(db.Integer, db.ForeignKey("local_estoque.id"), primary_key=True)
+    mercadoria_id = db.Column(db.Integer, db.ForeignKey("mercadoria.id"), primary_key=True, index=True)
+    quantidade = db.Column(db.Integer, nullable=False, default=0)
+
+    local = db.relationship("LocalEstoque", lazy="joined")
+    mercadoria = db.relationship(
+        "Mercadoria", backref=db.backref("estoques", lazy=True, cascade="all, delete-orphan")
+    )
+
+
+class Lote(db.Model):
+    """Lote de uma mercadoria, com validade; o saldo é preenchido pelos itens de NF."""
+    __tablename__ = "lote"
+    id = db.Column(db.Integer, primary_key=True)
+    mercadoria_id = db.Column(db.Integer, db.ForeignKey("mercadoria.id"), nullable=False)
+    lote = db.Column(db.String(50), nullable=False)
+    validade = db.Column(db.Date, nullable=True)
+    quantidade = db.Column(db.Integer, nullable=False, default=0)  # Saldo ainda não consumido
+
+    mercadoria = db.relationship("Mercadoria", lazy="joined", backref=db.backref("lotes", lazy=True))
+
+    __table_args__ = (
+        db.UniqueConstraint("mercadoria_id", "lote", name="uq_lote_mercadoria_lote"),
+        db.Index("ix_lote_lote", "lote"),
+        # "Vencendo nos próximos N dias": só lotes com saldo, lidos apenas do índice
+        db.Index(
+            "ix_lote_validade", "validade", "mercadoria_id",
+            postgresql_include=["lote", "quantidade"], postgresql_where=db.text("quantidade > 0"),
+        ),
+        # FEFO: lotes com saldo de uma mercadoria em ordem de validade
+        db.Index(
+            "ix_lote_mercadoria_validade", "mercadoria_id", "validade",
+            postgresql_where=db.text("quantidade > 0"),
+        ),
+    )
+
+    def __repr__(self):
+        return f"<Lote {self.lote}>"
+
+
+class ConsumoLote(db.Model):
+    """Unidades baixadas de um lote e, quando houver, a cirurgia que as recebeu."""
+    __tablename__ = "consumo_lote"
+    id = db.Column(db.Integer, primary_key=True)
+    lote_id = db.Column(db.Integer, db.ForeignKey("lote.id"), nullable=False)
+    cirurgia_id = db.Column(db.Integer, db.ForeignKey("cirurgia.id"), nullable=True)
+    quantidade = db.Column(db.Integer, nullable=False)
+    data_hora = db.Column(db.DateTime, default=datetime.utcnow)
+
+    lote = db.relationship("Lote", lazy="joined", backref=db.backref("consumos", lazy=True))
+    cirurgia = db.relationship("Cirurgia", backref=db.backref("consumos", lazy=True))
+
+    # Rastreabilidade nos dois sentidos: pacientes de um lote e lotes de uma cirurgia
+    __table_args__ = (
+        db.Index("ix_consumo_lote_lote_cirurgia", "lote_id", "cirurgia_id", postgresql_include=["quantidade"]),
+        db.Index("ix_consumo_lote_cirurgia", "cirurgia_id"),
+    )
+
+
+class KitCirurgico(db.Model):
+    """Modelo reutilizável com os itens que um tipo de cirurgia consome (ex.: kit de implante)."""
+    __tablename__ = "kit_cirurgico"
+    id = db.Column(db.Integer, primary_key=True)
+    nome = db.Column(db.String(100), nullable=False, unique=True)
+    descricao = db.Column(db.String(500), nullable=True)
+
+    itens = db.relationship("ItemKit", lazy="selectin", cascade="all, delete-orphan")
+
+    def __repr__(self):
+        return f"<KitCirurgico {self.nome}>"
+
+
+class ItemKit(db.Model):
+    __tablename__ = "item_kit"
+    kit_id = db.Column(db.Integer, db.ForeignKey("kit_cirurgico.id"), primary_key=True)
+    mercadoria_id = db.Column(db.Integer, db.ForeignKey("mercadoria.id"), primary_key=True, index=True)
+    quantidade = db.Column(db.Integer, nullable=False)
+
+    mercadoria = db.relationship("Mercadoria", lazy="joined")
+
+
+class ItemCirurgia(db.Model):
+    """Mercadoria consumida numa cirurgia, com a quantidade e o local de onde saiu."""
+    __tablename__ = "item_cirurgia"
+    cirurgia_id = db.Column(db.Integer, db.ForeignKey("cirurgia.id"), primary_key=True)
+    mercadoria_id = db.Column(db.Integer, db.ForeignKey("mercadoria.id"), primary_key=True, index=True)
+    local_id = db.Column(db.Integer, db.ForeignKey("local_estoque.id"), nullable=False)
+    quantidade = db.Column(db.Integer, nullable=False)
+
+    cirurgia = db.relationship(
+        "Cirurgia", backref=db.backref("itens", lazy=True, cascade="all, delete-orphan")
+    )
+    mercadoria = db.relationship("Mercadoria", lazy="joined")
+    local = db.relationship("LocalEstoque", lazy="joined")
+
+
+class GastoFornecedor(db.Model):
+    """Total comprado por fornecedor, mês de emissão da NF e grupo do item."""
+    __tablename__ = "gasto_fornecedor"
+    id = db.Column(db.Integer, primary_key=True)
+    fornecedor_id = db.Column(db.Integer, db.ForeignKey("fornecedor.id"), nullable=False)
+    mes = db.Column(db.Date, nullable=False)  # Primeiro dia do mês
+    grupo_id = db.Column(db.Integer, db.ForeignKey("grupo.id"), nullable=True)
+    itens = db.Column(db.Integer, nullable=False, default=0)
+    quantidade = db.Column(db.Integer, nullable=False, default=0)
+    valor = db.Column(db.Float, nullable=False, default=0.0)
+
+
+# Uma linha por (fornecedor, mês, grupo); itens sem grupo ficam na chave 0
+db.Index(
+    "uq_gasto_fornecedor_mes_grupo",
+    GastoFornecedor.fornecedor_id, GastoFornecedor.mes, db.func.coalesce(GastoFornecedor.grupo_id, 0),
+    unique=True,
+)
+
+
+class TokenMercadoria(db.Model):
+    """Índice invertido de nome e código das mercadorias, usado para conciliar itens de NF."""
+    __tablename__ = "token_mercadoria"
+    token = db.Column(db.String(60), primary_key=True)  # "c:" código, "p:" palavra, "t:" trigrama
+    mercadoria_id = db.Column(
+        db.Integer, db.ForeignKey("mercadoria.id", ondelete="CASCADE"), primary_key=True, index=True
+    )
+
+
+class SessaoUsuario(db.Model):
+    """Sessão guardada no servidor; o cookie leva apenas o id opaco."""
+    __tablename__ = "sessao"
+    id = db.Column(db.String(64), primary_key=True)
+    usuario_id = db.Column(db.Integer, nullable=True, index=True)
+    dados = db.Column(db.Text, nullable=False)
+    expira_em = db.Column(db.DateTime, nullable=False, index=True)
+
+
+class VersaoTabela(db.Model):
+    """Contador de alterações por tabela, usado como chave dos caches de fragmentos."""
+    tabela = db.Column(db.String(50), primary_key=True)
+    versao = db.Column(db.BigInteger, nullable=False, default=0)
+
+
+class ExclusaoSync(db.Model):
+    """Tombstone de um registro excluído, para a sincronização incremental."""
+    id = db.Column(db.Integer, primary_key=True)
+    seq = db.Column(db.BigInteger, nullable=False, index=True)
+    tabela = db.Column(db.String(50), nullable=False)
+    registro_id = db.Column(db.Integer, nullable=False)
+
+
+# ========== VERSÕES DE TABELA E SEQUÊNCIA DE SINCRONIZAÇÃO ==========
+# Toda transação que insere/altera/exclui linhas destas tabelas incrementa o
+# contador da tabela e a sequência global "sync"; assim todas as instâncias
+# enxergam a mesma versão. As flushes só anotam o que mudou: os contadores são
+# travados no commit, depois de todas as linhas da transação, e sempre na mesma
+# ordem (tabelas em ordem alfabética, "sync" por último). Assim nenhuma
+# transação espera uma linha de mercadoria segurando o contador, e as sequências
+# continuam atribuídas na ordem dos commits.
+TABELAS_VERSIONADAS = ("mercadoria", "fornecedor", "grupo")
+
+
+@event.listens_for(db.session, "after_flush")
+def _registrar_alteracoes(sess, flush_context):
+    for obj in (*sess.new, *sess.dirty):
+        tabela = getattr(obj, "__tablename__", None)
+        if tabela in TABELAS_VERSIONADAS and (obj in sess.new or sess.is_modified(obj)):
+            marcar_sincronizacao(tabela, [obj.id], sess)
+    for obj in sess.deleted:
+        tabela = getattr(obj, "__tablename__", None)
+        if tabela in TABELAS_VERSIONADAS:
+            sess.info.setdefault("sync_excluidos", set()).add((tabela, obj.id))
+            marcar_sincronizacao(tabela, [], sess)
+
+
+def marcar_sincronizacao(tabela, ids, sess=None):
+    """
+    Anota linhas alteradas de `tabela` para receberem a sequência no commit
+    (chame após UPDATE em lote, que não passa pela flush). Tabelas fora de
+    TABELAS_VERSIONADAS só têm o contador incrementado.
+    """
+    sess = sess or db.session
+    sess.info.setdefault("sync_alterados", {}).setdefault(tabela, set()).update(ids)
+
+
+@event.listens_for(db.session, "before_commit")
+def _reservar_sequencia(sess):
+    sess.flush()  # anota o que ainda está pendente antes de travar os contadores
+    alterados = sess.info.pop("sync_alterados", None)
+    excluidos = sess.info.pop("sync_excluidos", None)
+    if not alterados:
+        return
+    conn = sess.connection(bind_arguments={"bind": db.engine})
+    tocar_tabelas(*alterados, conn=conn)
+    versionadas = {t: ids for t, ids in alterados.items() if t in TABELAS_VERSIONADAS}
+    if not versionadas:
+        return
+    seq = proxima_seq(conn)
+    for tabela, ids in sorted(versionadas.items()):
+        if ids:
+            modelo = db.metadata.tables[tabela]
+            conn.execute(modelo.update().where(modelo.c.id.in_(sorted(ids))).values(versao_sync=seq))
+    if excluidos:
+        conn.execute(
+            ExclusaoSync.__table__.insert(),
+            [{"seq": seq, "tabela": tabela, "registro_id": id_} for tabela, id_ in sorted(excluidos)],
+        )
+
+
+@event.listens_for(db.session, "after_rollback")
+def _descartar_sincronizacao(sess):
+    sess.info.pop("sync_alterados", None)
+    sess.info.pop("sync_excluidos", None)
+
+
+def proxima_seq(conn=None):
+    """Reserva o próximo valor da sequência de sincronização (trava até o commit; use no commit)."""
+    conn = conn or db.session.connection()
+    return conn.execute(text(
+        "INSERT INTO versao_tabela (tabela, versao) VALUES ('sync', 1) "
+        "ON CONFLICT (tabela) DO UPDATE SET versao = versao_tabela.versao + 1 "
+        "RETURNING versao"
+    )).scalar()
+
+
+def tocar_tabelas(*tabelas, conn=None):
+    """Incrementa a versão das tabelas, em ordem alfabética (usado no commit por `_reservar_sequencia`)."""
+    conn = conn or db.session.connection()
+    for tabela in sorted(tabelas):
+        conn.execute(
+            text(
+                "INSERT INTO versao_tabela (tabela, versao) VALUES (:t, 1) "
+                "ON CONFLICT (tabela) DO UPDATE SET versao = versao_tabela.versao + 1"
+            ),
+            {"t": tabela},
+        )
+
+
+# ========== ÍNDICE EM MEMÓRIA POR CÓDIGO ==========
+# Dicionário lower(codigo) -> snapshot da mercadoria para o leitor de código de
+# barras responder sem ir ao banco. A busca só lê o dicionário; quem o mantém é:
+# - o commit deste processo, que aplica na hora as mercadorias que alterou;
+# - uma thread em segundo plano que, a cada CODIGO_INDEX_INTERVALO segundos,
+#   relê do primário a sequência de sincronização ("sync" em `versao_tabela`) e,
+#   se houve commit depois da que o índice guarda (de outro worker ou instância,
+#   ou uma atualização em massa), só as mercadorias com `versao_sync` maior e as
+#   exclusões registradas desde então.
+# Logo, alterações feitas fora deste processo aparecem em até
+# CODIGO_INDEX_INTERVALO segundos. As leituras da thread vão ao primário: uma
+# réplica atrasada devolveria linhas antigas já marcadas como atuais. Enquanto o
+# índice não foi carregado (worker sem aquecimento) a busca consulta o banco.
+
+class IndiceCodigo:
+    def __init__(self):
+        self._por_codigo = {}
+        self._codigo_por_id = {}
+        self._seq = None
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def _primario(self, consulta):
+        return db.session.execute(consulta, bind_arguments={"bind": db.engine})
+
+    def _seq_atual(self):
+        return self._primario(
+            db.select(VersaoTabela.versao).where(VersaoTabela.tabela == "sync")
+        ).scalar() or 0
+
+    def _linha(self, id_, codigo, nome, quantidade):
+        return {"id": id_, "codigo": codigo, "nome": nome, "quantidade": quantidade}
+
+    def _guardar(self, id_, codigo, nome, quantidade):
+        chave = codigo.lower()
+        self._por_codigo[chave] = self._linha(id_, codigo, nome, quantidade)
+        self._codigo_por_id[id_] = chave
+
+    def _remover(self, id_):
+        chave = self._codigo_por_id.pop(id_, None)
+        if chave is not None and self._por_codigo.get(chave, {}).get("id") == id_:
+            del self._por_codigo[chave]
+
+    def carregar(self):
+        seq = self._seq_atual()  # antes das linhas: um commit no meio é relido na próxima atualização
+        linhas = self._primario(
+            db.select(Mercadoria.id, Mercadoria.codigo, Mercadoria.nome, Mercadoria.quantidade)
+        ).all()
+        with self._lock:
+            self._por_codigo = {}
+            self._codigo_por_id = {}
+            for linha in linhas:
+                self._guardar(*linha)
+            self._seq = seq
+
+    def limpar(self):
+        """Descarta o índice (ex.: banco recriado); a thread o recarrega."""
+        with self._lock:
+            self._por_codigo, self._codigo_por_id, self._seq = {}, {}, None
+
+    def atualizar(self):
+        """Aplica ao índice os commits feitos desde a sequência em que ele está."""
+        desde = self._seq
+        seq = self._seq_atual()
+        if seq <= desde:
+            return
+        linhas = self._primario(
+            db.select(Mercadoria.id, Mercadoria.codigo, Mercadoria.nome, Mercadoria.quantidade)
+            .where(Mercadoria.versao_sync > desde)
+        ).all()
+        excluidos = self._primario(
+            db.select(ExclusaoSync.registro_id)
+            .where(ExclusaoSync.tabela == Mercadoria.__tablename__, ExclusaoSync.seq > desde)
+        ).scalars().all()
+        with self._lock:
+            for id_ in (*excluidos, *(linha.id for linha in linhas)):
+                self._remover(id_)  # o código pode ter mudado
+            for linha in linhas:
+                self._guardar(*linha)
+            self._seq = max(self._seq, seq)
+
+    def aplicar(self, alteradas):
+        """Commit deste processo: {id: (id, codigo, nome, quantidade) ou None se excluída}."""
+        with self._lock:
+            if self._seq is None:
+                return
+            for id_, linha in alteradas.items():
+                self._remover(id_)
+                if linha is not None:
+                    self._guardar(*linha)
+
+    def iniciar(self):
+        """Garante a thread que mantém o índice em dia."""
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._executar, name="indice-codigo", daemon=True)
+                self._thread.start()
+
+    def _executar(self):
+        with app.app_context():
+            while True:
+                if self._seq is not None:
+                    time.sleep(app.config["CODIGO_INDEX_INTERVALO"])
+                try:
+                    if self._seq is None:
+                        self.carregar()
+                    else:
+                        self.atualizar()
+                except Exception as e:
+                    print("Warning: índice de códigos não atualizado:", e)
+                    time.sleep(app.config["CODIGO_INDEX_INTERVALO"])
+                finally:
+                    db.session.remove()
+
+    def buscar(self, codigo):
+        """Retorna (encontrado_no_indice, snapshot); sem índice carregado, consulta o banco."""
+        self.iniciar()
+        with self._lock:
+            if self._seq is not None:
+                linha = self._por_codigo.get(codigo.lower())
+                return linha is not None, linha
+        linha = db.session.execute(
+            db.select(Mercadoria.id, Mercadoria.codigo, Mercadoria.nome, Mercadoria.quantidade)
+            .where(db.func.lower(Mercadoria.codigo) == codigo.lower())
+            .limit(1)
+        ).first()
+        return False, linha and self._linha(*linha)
+
+
+indice_codigo = IndiceCodigo()
+
+
+@event.listens_for(db.session, "after_flush")
+def _coletar_codigos(sess, flush_context):
+    alteradas = sess.info.setdefault("codigos_alterados", {})
+    for obj in (*sess.new, *sess.dirty):
+        if isinstance(obj, Mercadoria):
+            alteradas[obj.id] = (obj.id, obj.codigo, obj.nome, obj.quantidade)
+    for obj in sess.deleted:
+        if isinstance(obj, Mercadoria):
+            alteradas[obj.id] = None
+
+
+@event.listens_for(db.session, "after_commit")
+def _aplicar_codigos(sess):
+    alteradas = sess.info.pop("codigos_alterados", None)
+    if alteradas:
+        indice_codigo.aplicar(alteradas)
+
+
+@event.listens_for(db.session, "after_rollback")
+def _descartar_codigos(sess):
+    sess.info.pop("codigos_alterados", None)
+
+
+# ========== ÍNDICE DE TOKENS (CONCILIAÇÃO DE ITENS DE NF) ==========
+# Nome e código de cada mercadoria viram tokens normalizados (minúsculos, sem
+# acento) em `token_mercadoria`: "c:" o código sem separadores, "p:" as palavras
+# do nome e "t:" os trigramas delas, no formato do pg_trgm. A flush mantém o
+# índice quando mercadorias são criadas, renomeadas ou excluídas. Para conciliar
+# descrições de NF, o código, as palavras e os trigramas mais raros de cada uma
+# votam em candidatos pelo índice e só esses recebem a pontuação completa; o
+# catálogo não é varrido.
+
+PALAVRAS_IGNORADAS = {"a", "o", "e", "de", "da", "do", "das", "dos", "com", "sem", "para", "em"}
+CONCILIACAO_TRIGRAMAS = 8  # trigramas mais raros da descrição que votam (cobrem abreviações)
+CONCILIACAO_FREQUENCIA_MAX = 5000  # tokens em mais mercadorias que isso não votam
+CONCILIACAO_CANDIDATOS = 50  # candidatos pontuados por descrição
+CONCILIACAO_LIMIAR = 0.6  # similaridade mínima para vincular sem confirmação
+CONCILIACAO_MARGEM = 0.1  # vantagem mínima do melhor candidato sobre o segundo
+CONCILIACAO_LOTE = 500  # descrições por consulta ao índice
+
+
+def _normalizar(texto):
+    """Palavras minúsculas, sem acento e sem pontuação: 'Sérum-10 mL' -> ['serum', '10', 'ml']."""
+    texto = unicodedata.normalize("NFKD", texto or "")
+    texto = "".join(c for c in texto if not unicodedata.combining(c)).lower()
+    return re.findall(r"[a-z0-9]+", texto)
+
+
+def _token_codigo(texto):
+    return "c:" + "".join(_normalizar(texto))[:58]
+
+
+def _tokens_palavras(palavras):
+    tokens = set()
+    for palavra in palavras:
+        if palavra in PALAVRAS_IGNORADAS:
+            continue
+        tokens.add("p:" + palavra[:58])
+        palavra = f"  {palavra} "
+        tokens.update("t:" + palavra[i:i + 3] for i in range(len(palavra) - 2))
+    return tokens
+
+
+def tokens_mercadoria(codigo, nome):
+    return _tokens_palavras(_normalizar(nome)) | {_token_codigo(codigo)}
+
+
+def tokens_descricao(descricao):
+    """Tokens de uma descrição de NF; cada trecho entre espaços também é tentado como código."""
+    codigos = {_token_codigo(trecho) for trecho in (descricao or "").split()}
+    return _tokens_palavras(_normalizar(descricao)) | (codigos - {"c:"})
+
+
+def indexar_mercadorias(ids=None, conn=None):
+    """Regera os tokens das mercadorias `ids` (de todas, se None) na transação de `conn`."""
+    conn = conn or db.session.connection()
+    tabela = TokenMercadoria.__table__
+    consulta = db.select(Mercadoria.id, Mercadoria.codigo, Mercadoria.nome)
+    if ids is None:
+        conn.execute(tabela.delete())
+    else:
+        ids = list(ids)
+        conn.execute(tabela.delete().where(tabela.c.mercadoria_id.in_(ids)))
+        consulta = consulta.where(Mercadoria.id.in_(ids))
+    linhas = []
+    for id_, codigo, nome in conn.execute(consulta).all():
+        linhas.extend({"token": token, "mercadoria_id": id_} for token in tokens_mercadoria(codigo, nome))
+        if len(linhas) >= 10000:
+            conn.execute(tabela.insert(), linhas)
+            linhas = []
+    if linhas:
+        conn.execute(tabela.insert(), linhas)
+
+
+@event.listens_for(db.session, "after_flush")
+def _reindexar_mercadorias(sess, flush_context):
+    ids = {obj.id for obj in (*sess.new, *sess.deleted) if isinstance(obj, Mercadoria)}
+    ids.update(
+        obj.id for obj in sess.dirty
+        if isinstance(obj, Mercadoria)
+        and any(db.inspect(obj).attrs[campo].history.has_changes() for campo in ("nome", "codigo"))
+    )
+    if ids:
+        indexar_mercadorias(ids, sess.connection())
+
+
+def _perfil(tokens):
+    """Separa os tokens em (códigos, palavras, trigramas) para pontuar sem refiltrar."""
+    perfil = {"c": set(), "p": set(), "t": set()}
+    for token in tokens:
+        perfil[token[0]].add(token)
+    return perfil["c"], perfil["p"], perfil["t"]
+
+
+def _dice(a, b):
+    return 2 * len(a & b) / (len(a) + len(b)) if a or b else 0.0
+
+
+def similaridade(consulta, alvo):
+    """
+    De 0 a 1 entre os perfis de uma descrição e de uma mercadoria: o código dela
+    na descrição vale 1; senão, Dice dos trigramas (70%) e das palavras (30%).
+    """
+    if consulta[0] & alvo[0]:
+        return 1.0
+    return round(0.7 * _dice(consulta[2], alvo[2]) + 0.3 * _dice(consulta[1], alvo[1]), 3)
+
+
+def sugerir_mercadorias(descricoes, limite=5):
+    """
+    Candidatos de cada descrição como listas de (similaridade, id, codigo, nome),
+    da mais parecida para a menos. Cada lote de CONCILIACAO_LOTE descrições faz
+    três consultas: frequência dos tokens, mercadorias dos que votam e os nomes
+    dos candidatos. Descrições repetidas (comuns no histórico) são pontuadas uma vez.
+    """
+    unicas = list(dict.fromkeys(descricoes))
+    sugestoes = []
+    for inicio in range(0, len(unicas), CONCILIACAO_LOTE):
+        sugestoes.extend(_sugerir_lote(unicas[inicio:inicio + CONCILIACAO_LOTE], limite))
+    por_descricao = dict(zip(unicas, sugestoes))
+    return [por_descricao[descricao] for descricao in descricoes]
+
+
+def consulta_frequencia_tokens(tokens):
+    return (
+        db.select(TokenMercadoria.token, db.func.count())
+        .where(TokenMercadoria.token.in_(tokens))
+        .group_by(TokenMercadoria.token)
+    )
+
+
+def consulta_postings(tokens):
+    return db.select(TokenMercadoria.token, TokenMercadoria.mercadoria_id).where(TokenMercadoria.token.in_(tokens))
+
+
+def _sugerir_lote(descricoes, limite):
+    consultas = [tokens_descricao(descricao) for descricao in descricoes]
+    todos = set().union(*consultas)
+    if not todos:
+        return [[] for _ in descricoes]
+    frequencia = dict(db.session.execute(consulta_frequencia_tokens(todos)).all())
+
+    # Votam o código, as palavras e os trigramas mais raros; tokens comuns demais ficam de fora
+    votantes = []
+    for tokens in consultas:
+        conhecidos = [t for t in tokens if t in frequencia and frequencia[t] <= CONCILIACAO_FREQUENCIA_MAX]
+        trigramas = sorted((t for t in conhecidos if t.startswith("t:")), key=frequencia.get)
+        votantes.append([t for t in conhecidos if not t.startswith("t:")] + trigramas[:CONCILIACAO_TRIGRAMAS])
+    postings = {}
+    busca = set().union(*votantes)
+    if busca:
+        for token, mercadoria_id in db.session.execute(consulta_postings(busca)):
+            postings.setdefault(token, []).append(mercadoria_id)
+
+    candidatos = []
+    for tokens in votantes:
+        votos = defaultdict(float)
+        for token in tokens:
+            peso = 1 / math.sqrt(frequencia[token])  # raros pesam mais, sem anular os comuns
+            for mercadoria_id in postings.get(token, ()):
+                votos[mercadoria_id] += peso
+        candidatos.append(sorted(votos, key=votos.get, reverse=True)[:CONCILIACAO_CANDIDATOS])
+
+    ids = set().union(*candidatos)
+    mercadorias = {}
+    if ids:
+        mercadorias = {
+            linha.id: linha for linha in db.session.execute(
+                db.select(Mercadoria.id, Mercadoria.codigo, Mercadoria.nome).where(Mercadoria.id.in_(ids))
+            )
+        }
+    alvos = {}
+    sugestoes = []
+    for tokens, ids_candidatos in zip(consultas, candidatos):
+        consulta = _perfil(tokens)
+        pontuados = []
+        for m in (mercadorias[i] for i in ids_candidatos if i in mercadorias):
+            if m.id not in alvos:
+                alvos[m.id] = _perfil(tokens_mercadoria(m.codigo, m.nome))
+            pontuados.append((similaridade(consulta, alvos[m.id]), m.id, m.codigo, m.nome))
+        pontuados.sort(key=lambda p: (-p[0], p[3]))
+        sugestoes.append(pontuados[:limite])
+    return sugestoes
+
+
+# ========== EVENTOS DE ESTOQUE (SSE) ==========
+# Após cada commit que altera mercadorias, eventos compactos {id, quantidade}
+# são entregues às páginas abertas via Server-Sent Events. Com um worker basta
+# o canal local; com vários, o canal PostgreSQL usa NOTIFY e cada processo
+# repassa aos seus assinantes o que recebe por LISTEN.
+# Cada stream aberto prende uma thread do worker (gthread), então o número de
+# streams por processo é limitado a EVENTOS_MAX_STREAMS; as páginas recusadas
+# passam a consultar as quantidades periodicamente.
+
+class CanalLocal:
+    """Distribui eventos entre os assinantes deste processo."""
+
+    def __init__(self, maximo):
+        self._assinantes = set()
+        self._lock = threading.Lock()
+        self.maximo = maximo
+
+    def assinar(self):
+        """Fila do novo assinante, ou None se o processo já tem `maximo` streams."""
+        fila = queue.Queue(maxsize=1000)
+        with self._lock:
+            if len(self._assinantes) >= self.maximo:
+                return None
+            self._assinantes.add(fila)
+        return fila
+
+    def cancelar(self, fila):
+        with self._lock:
+            self._assinantes.discard(fila)
+
+    def entregar(self, eventos):
+        with self._lock:
+            assinantes = list(self._assinantes)
+        for fila in assinantes:
+            for evento in eventos:
+                try:
+                    fila.put_nowait(evento)
+                except queue.Full:
+                    break  # cliente lento: perde eventos até recarregar a página
+
+    def publicar(self, eventos):
+        self.entregar(eventos)
+
+    def encerrar(self):
+        """Fecha os streams abertos (desligamento do worker); os navegadores reconectam."""
+        with self._lock:
+            assinantes = list(self._assinantes)
+        for fila in assinantes:
+            try:
+                fila.put_nowait(None)
+            except queue.Full:
+                fila.get_nowait()
+                fila.put_nowait(None)
+
+
+class CanalPostgres(CanalLocal):
+    """Publica com NOTIFY e escuta com LISTEN numa conexão dedicada."""
+
+    CANAL = "estoque"
+    LIMITE_PAYLOAD = 7000  # NOTIFY aceita até 8000 bytes
+    ESPERA_MINIMA, ESPERA_MAXIMA = 1, 60  # segundos entre reconexões do LISTEN
+
+    def __init__(self, maximo):
+        super().__init__(maximo)
+        self._ouvinte = None
+
+    def assinar(self):
+        with self._lock:
+            if self._ouvinte is None or not self._ouvinte.is_alive():
+                self._ouvinte = threading.Thread(target=self._escutar, name="estoque-listen", daemon=True)
+                self._ouvinte.start()
+        return super().assinar()
+
+    def _escutar(self):
+        # Thread própria, fora de qualquer requisição: precisa do contexto do app para `db.engine`
+        espera = self.ESPERA_MINIMA
+        with app.app_context():
+            while True:
+                conn = None
+                try:
+                    conn = db.engine.raw_connection()
+                    dbapi = conn.driver_connection
+                    dbapi.autocommit = True
+                    dbapi.cursor().execute(f"LISTEN {self.CANAL}")
+                    espera = self.ESPERA_MINIMA
+                    while True:
+                        if select.select([dbapi], [], [], 5) == ([], [], []):
+                            continue
+                        dbapi.poll()
+                        while dbapi.notifies:
+                            self.entregar(json.loads(dbapi.notifies.pop(0).payload))
+                except Exception as e:
+                    print(f"Warning: ouvinte de eventos de estoque caiu; reconectando em {espera}s:", e)
+                finally:
+                    if conn is not None:
+                        conn.close()
+                # Eventos publicados enquanto desconectado se perdem; o polling das páginas cobre a lacuna
+                time.sleep(espera)
+                espera = min(espera * 2, self.ESPERA_MAXIMA)
+
+    def publicar(self, eventos):
+        lotes, lote = [], []
+        for evento in eventos:
+            lote.append(evento)
+            if len(lote) > 1 and len(json.dumps(lote)) > self.LIMITE_PAYLOAD:
+                lotes.append(lote[:-1])
+                lote = [evento]
+        lotes.append(lote)
+        with db.engine.connect() as conn:
+            for lote in lotes:
+                conn.execute(text("SELECT pg_notify(:c, :p)"), {"c": self.CANAL, "p": json.dumps(lote)})
+            conn.commit()
+
+
+canal_estoque = (CanalPostgres if app.config['EVENTOS_BACKEND'] == 'postgres' else CanalLocal)(
+    app.config['EVENTOS_MAX_STREAMS']
+)
+
+
+@event.listens_for(db.session, "after_flush")
+def _coletar_eventos_estoque(sess, flush_context):
+    eventos = sess.info.setdefault("eventos_estoque", {})
+    for obj in (*sess.new, *sess.dirty):
+        if isinstance(obj, Mercadoria):
+            eventos[obj.id] = {"id": obj.id, "quantidade": obj.quantidade}
+    for obj in sess.deleted:
+        if isinstance(obj, Mercadoria):
+            eventos[obj.id] = {"id": obj.id, "excluida": True}
+
+
+@event.listens_for(db.session, "after_commit")
+def _publicar_eventos_estoque(sess):
+    eventos = sess.info.pop("eventos_estoque", None)
+    if eventos:
+        try:
+            canal_estoque.publicar(list(eventos.values()))
+        except Exception as e:
+            print("Warning: não foi possível publicar eventos de estoque:", e)
+
+
+@event.listens_for(db.session, "after_rollback")
+def _descartar_eventos_estoque(sess):
+    sess.info.pop("eventos_estoque", None)
+
+
+def consulta_versoes(tabelas):
+    return db.select(VersaoTabela.tabela, VersaoTabela.versao).where(VersaoTabela.tabela.in_(list(tabelas)))
+
+
+def versoes_tabelas(*tabelas):
+    versoes = dict.fromkeys(tabelas, 0)
+    versoes.update(db.session.execute(consulta_versoes(tabelas)).all())
+    return versoes
+
+
+# ========== ESTOQUE POR LOCAL ==========
+# Cada movimentação altera o saldo do local e, pelo mesmo delta, o total em
+# `Mercadoria.quantidade`, na mesma transação. A linha da mercadoria é travada
+# primeiro, então movimentações concorrentes do mesmo item se serializam e o
+# total nunca precisa ser recalculado somando os locais.
+
+def ajustar_estoque(mercadoria_id, local_id, delta):
+    """Soma `delta` ao saldo do local e ao total; ValueError se o saldo ficaria negativo."""
+    db.session.flush()  # a releitura abaixo não pode descartar alterações pendentes
+    mercadoria = db.session.get(Mercadoria, mercadoria_id, with_for_update=True, populate_existing=True)
+    saldo = db.session.get(EstoqueLocal, (local_id, mercadoria_id), populate_existing=True)
+    if saldo is None:
+        saldo = EstoqueLocal(local_id=local_id, mercadoria_id=mercadoria_id, quantidade=0)
+        db.session.add(saldo)
+    if saldo.quantidade + delta < 0:
+        raise ValueError(f"Quantidade insuficiente no local (disponível: {saldo.quantidade}).")
+    saldo.quantidade += delta
+    mercadoria.quantidade = (mercadoria.quantidade or 0) + delta
+    return saldo
+
+
+def transferir_estoque(mercadoria_id, origem_id, destino_id, quantidade):
+    """Move `quantidade` entre dois locais; o total da mercadoria não muda."""
+    if origem_id == destino_id:
+        raise ValueError("Origem e destino devem ser locais diferentes.")
+    ajustar_estoque(mercadoria_id, origem_id, -quantidade)
+    ajustar_estoque(mercadoria_id, destino_id, quantidade)
+
+
+# ========== LOTES E VALIDADES (FEFO) ==========
+# Itens de NF com número de lote somam ao saldo do lote; saídas e cirurgias
+# consomem os lotes com saldo em ordem de validade (o que vence primeiro sai
+# primeiro), registrando em `consumo_lote` para rastrear quem recebeu cada lote.
+# Unidades sem lote registrado (estoque anterior, entradas manuais) saem depois.
+# Lotes vencidos não saem pela FEFO (cirurgias usam implantes): a saída que só
+# fecharia com eles é recusada, e eles só saem numa saída de descarte de vencidos.
+# Os lotes não são separados por local: o que se garante é que, por mercadoria,
+# a soma dos lotes nunca passa do estoque total e nenhum lote fica negativo
+# (`conferir_lotes`). Entradas e estornos que quebrariam isso são recusados.
+
+def entrada_lote(mercadoria_id, numero, validade, quantidade):
+    """Soma `quantidade` ao lote, criando-o se preciso; confira com `conferir_lotes`."""
+    lote = db.session.execute(
+        db.select(Lote).where(Lote.mercadoria_id == mercadoria_id, Lote.lote == numero).with_for_update()
+    ).scalar()
+    if lote is None:
+        lote = Lote(mercadoria_id=mercadoria_id, lote=numero, validade=validade, quantidade=0)
+        db.session.add(lote)
+    elif validade and lote.validade is None:
+        lote.validade = validade
+    lote.quantidade = (lote.quantidade or 0) + quantidade
+    return lote
+
+
+def conferir_lotes(*lotes):
+    """ValueError se algum dos lotes ficou negativo ou passou do estoque da mercadoria."""
+    lotes = [lote for lote in lotes if lote is not None]
+    for lote in lotes:
+        if lote.quantidade < 0:
+            raise ValueError(
+                f"O lote {lote.lote} já teve unidades consumidas; o estorno deixaria o saldo em {lote.quantidade}."
+            )
+    conferir_estoque_lotes({lote.mercadoria_id for lote in lotes})
+
+
+def _lotes_excedentes(mercadoria_ids):
+    """(id, codigo, estoque, soma dos lotes) da primeira mercadoria cujos lotes passam do estoque total."""
+    db.session.flush()
+    return db.session.execute(
+        db.select(Mercadoria.id, Mercadoria.codigo, Mercadoria.quantidade, db.func.sum(Lote.quantidade))
+        .join(Lote, Lote.mercadoria_id == Mercadoria.id)
+        .where(Mercadoria.id.in_(list(mercadoria_ids)))
+        .group_by(Mercadoria.id, Mercadoria.codigo, Mercadoria.quantidade)
+        .having(db.func.sum(Lote.quantidade) > Mercadoria.quantidade)
+        .limit(1)
+    ).first()
+
+
+def conferir_estoque_lotes(mercadoria_ids):
+    """ValueError se os lotes de alguma das mercadorias somam mais que o estoque total dela."""
+    if not mercadoria_ids:
+        return
+    excedente = _lotes_excedentes(mercadoria_ids)
+    if excedente:
+        _, codigo, estoque, em_lotes = excedente
+        raise ValueError(
+            f"Os lotes de '{codigo}' somariam {em_lotes} unidades, mais que o estoque total ({estoque})."
+        )
+
+
+def conferir_validade(mercadoria_ids):
+    """
+    ValueError se a saída só fecharia com lotes vencidos: depois dos lotes válidos,
+    as unidades sem lote não cobriram o resto e os lotes passariam do estoque total.
+    """
+    excedente = _lotes_excedentes(mercadoria_ids)
+    if excedente:
+        mercadoria_id, codigo, _, _ = excedente
+        vencidos = db.session.execute(
+            db.select(Lote.lote, Lote.validade, Lote.quantidade)
+            .where(Lote.mercadoria_id == mercadoria_id, Lote.quantidade > 0, Lote.validade < date.today())
+            .order_by(Lote.validade, Lote.id)
+        ).all()
+        lista = ", ".join(f"{lote} (venceu em {validade:%d/%m/%Y}, {q} un.)" for lote, validade, q in vencidos)
+        raise ValueError(
+            f"Não há unidades de '{codigo}' dentro da validade para esta saída. Lotes vencidos: {lista}. "
+            "Eles só saem numa saída de descarte de vencidos."
+        )
+
+
+def consumir_lotes(mercadoria_id, quantidade, cirurgia=None, vencidos=False):
+    """Baixa até `quantidade` dos lotes em ordem FEFO; retorna [(lote, quantidade)] consumidos."""
+    return consumir_lotes_varios({mercadoria_id: quantidade}, cirurgia, vencidos)[mercadoria_id]
+
+
+def consulta_lotes_fefo(mercadoria_ids, vencidos=False):
+    """Lotes com saldo das mercadorias, por mercadoria e na ordem FEFO; os vencidos só com `vencidos`."""
+    consulta = db.select(Lote).where(Lote.mercadoria_id.in_(list(mercadoria_ids)), Lote.quantidade > 0)
+    if not vencidos:
+        consulta = consulta.where(db.or_(Lote.validade.is_(None), Lote.validade >= date.today()))
+    return consulta.order_by(Lote.mercadoria_id, Lote.validade.asc().nulls_last(), Lote.id)
+
+
+def consumir_lotes_varios(quantidades, cirurgia=None, vencidos=False):
+    """
+    Como `consumir_lotes`, para {mercadoria_id: quantidade}: os lotes de todas as
+    mercadorias são travados e lidos num único SELECT. Retorna {mercadoria_id: [(lote, quantidade)]}.
+    Sem `vencidos` (descarte), ValueError se faltaria consumir lotes vencidos.
+    """
+    restante = dict(quantidades)
+    consumidos = {mercadoria_id: [] for mercadoria_id in quantidades}
+    lotes = db.session.execute(consulta_lotes_fefo(quantidades, vencidos).with_for_update()).scalars()
+    for lote in lotes:
+        q = min(lote.quantidade, restante[lote.mercadoria_id])
+        if q <= 0:
+            continue
+        lote.quantidade -= q
+        restante[lote.mercadoria_id] -= q
+        db.session.add(ConsumoLote(lote=lote, cirurgia=cirurgia, quantidade=q))
+        consumidos[lote.mercadoria_id].append((lote, q))
+    faltando = [mercadoria_id for mercadoria_id, q in restante.items() if q > 0]
+    if faltando and not vencidos:
+        conferir_validade(faltando)
+    return consumidos
+
+
+def baixar_estoque(mercadoria_id, local_id, quantidade, cirurgia=None, vencidos=False):
+    """Saída: tira `quantidade` do local e consome os lotes em ordem FEFO (vencidos só no descarte)."""
+    ajustar_estoque(mercadoria_id, local_id, -quantidade)
+    return consumir_lotes(mercadoria_id, quantidade, cirurgia, vencidos)
+
+
+def baixar_estoque_varios(local_id, quantidades, cirurgia=None):
+    """
+    Saída de várias mercadorias de um local ({mercadoria_id: quantidade}) com um
+    UPDATE condicional nos saldos e outro nos totais, sem carregar as entidades.
+    ValueError se algum item não tiver saldo no local (a transação deve ser
+    desfeita). Retorna os lotes consumidos, como `consumir_lotes_varios`.
+    """
+    ids = sorted(quantidades)
+    db.session.flush()
+    # Trava as mercadorias em ordem de id (a mesma ordem para todos os kits) antes dos saldos,
+    # como em `ajustar_estoque`, para saídas concorrentes não entrarem em deadlock
+    db.session.execute(
+        db.select(Mercadoria.id).where(Mercadoria.id.in_(ids)).order_by(Mercadoria.id).with_for_update()
+    )
+    delta = db.case(quantidades, value=EstoqueLocal.mercadoria_id)
+    baixados = db.session.execute(
+        db.update(EstoqueLocal)
+        .where(
+            EstoqueLocal.local_id == local_id,
+            EstoqueLocal.mercadoria_id.in_(ids),
+            EstoqueLocal.quantidade >= delta,
+        )
+        .values(quantidade=EstoqueLocal.quantidade - delta)
+        .returning(EstoqueLocal.mercadoria_id)
+        .execution_options(synchronize_session=False)
+    ).scalars().all()
+    faltando = set(ids) - set(baixados)
+    if faltando:
+        codigos = db.session.execute(
+            db.select(Mercadoria.codigo).where(Mercadoria.id.in_(faltando)).order_by(Mercadoria.codigo)
+        ).scalars()
+        raise ValueError(f"Quantidade insuficiente no local para: {', '.join(codigos)}.")
+
+    # O UPDATE em lote não passa pela flush: versão de sincronização (que também
+    # atualiza o índice de códigos) e eventos SSE são anotados aqui
+    marcar_sincronizacao("mercadoria", ids)
+    totais = db.session.execute(
+        db.update(Mercadoria)
+        .where(Mercadoria.id.in_(ids))
+        .values(quantidade=Mercadoria.quantidade - db.case(quantidades, value=Mercadoria.id))
+        .returning(Mercadoria.id, Mercadoria.quantidade)
+        .execution_options(synchronize_session=False)
+    ).all()
+    eventos = db.session.info.setdefault("eventos_estoque", {})
+    for id_, quantidade in totais:
+        eventos[id_] = {"id": id_, "quantidade": quantidade}
+    db.session.info["escreveu"] = True
+    return consumir_lotes_varios(quantidades, cirurgia)
+
+
+def descrever_lotes(consumidos):
+    return ", ".join(f"{lote.lote} ({q})" for lote, q in consumidos)
+
+
+def _aplicar_lote_item(item):
+    """Soma o item de NF ao saldo do seu lote (itens sem lote ou sem mercadoria não entram)."""
+    if item.lote and item.mercadoria_id:
+        item.lote_estoque = entrada_lote(item.mercadoria_id, item.lote, item.validade, item.quantidade)
+    else:
+        item.lote_estoque = None
+
+
+def _estornar_lote_item(item):
+    """
+    Desfaz `_aplicar_lote_item` antes de editar ou excluir o item. Retorna o lote
+    estornado, que pode ficar negativo até o item ser reaplicado: confira-o com
+    `conferir_lotes` ao final da alteração.
+    """
+    if item.lote_estoque is None:
+        return None
+    lote = db.session.get(Lote, item.lote_id, with_for_update=True, populate_existing=True)
+    lote.quantidade -= item.quantidade
+    return lote
+
+
+def acumular_gasto(item, sinal=1):
+    """
+    Soma (ou, com sinal=-1, subtrai) o item de NF no agregado de gastos do fornecedor.
+    Um único upsert pelo índice único (fornecedor, mês, grupo): dois itens do mesmo
+    mês e grupo lançados ao mesmo tempo não disputam a criação da linha.
+    """
+    db.session.flush()  # grava o item (e o grupo_id da relação) antes do upsert
+    nota = item.nota_fiscal or db.session.get(NotaFiscal, item.nota_fiscal_id)
+    gasto_id, itens = db.session.execute(
+        text(
+            "INSERT INTO gasto_fornecedor (fornecedor_id, mes, grupo_id, itens, quantidade, valor) "
+            "VALUES (:fornecedor_id, :mes, :grupo_id, :itens, :quantidade, :valor) "
+            "ON CONFLICT (fornecedor_id, mes, coalesce(grupo_id, 0)) DO UPDATE SET "
+            "itens = gasto_fornecedor.itens + excluded.itens, "
+            "quantidade = gasto_fornecedor.quantidade + excluded.quantidade, "
+            "valor = gasto_fornecedor.valor + excluded.valor "
+            "RETURNING id, itens"
+        ),
+        {
+            "fornecedor_id": nota.fornecedor_id,
+            "mes": nota.data_emissao.replace(day=1),
+            "grupo_id": item.grupo_id,
+            "itens": sinal,
+            "quantidade": sinal * item.quantidade,
+            "valor": sinal * item.quantidade * item.preco_unitario,
+        },
+    ).one()
+    if itens <= 0:
+        db.session.execute(text("DELETE FROM gasto_fornecedor WHERE id = :id AND itens <= 0"), {"id": gasto_id})
+
+
+def vincular_item(item, mercadoria_id):
+    """Liga o item de NF à mercadoria, levando junto a entrada do lote."""
+    anterior = _estornar_lote_item(item)
+    item.mercadoria_id = mercadoria_id
+    _aplicar_lote_item(item)
+    conferir_lotes(anterior, item.lote_estoque)
+
+
+def conciliar_itens(itens):
+    """
+    Vincula os itens sem mercadoria cujo melhor candidato é claro: similaridade
+    >= CONCILIACAO_LIMIAR e folga de CONCILIACAO_MARGEM sobre o segundo. Retorna
+    os itens vinculados; o commit fica com quem chamou.
+    """
+    pendentes = [item for item in itens if item.mercadoria_id is None]
+    vinculados = []
+    for item, candidatos in zip(pendentes, sugerir_mercadorias([item.descricao for item in pendentes], limite=2)):
+        if candidatos and candidatos[0][0] >= CONCILIACAO_LIMIAR and (
+            len(candidatos) == 1 or candidatos[0][0] - candidatos[1][0] >= CONCILIACAO_MARGEM
+        ):
+            try:
+                # Só a entrada do lote pode ser recusada; itens sem lote dispensam o savepoint
+                with db.session.begin_nested() if item.lote else contextlib.nullcontext():
+                    vincular_item(item, candidatos[0][1])
+            except ValueError:
+                continue  # lote acima do estoque: fica pendente para vínculo manual
+            vinculados.append(item)
+    return vinculados
+
+
+def _itens_do_formulario():
+    """
+    Linhas `item_mercadoria_id`/`item_quantidade` do formulário como {mercadoria_id: quantidade}.
+    As linhas são pareadas antes da conversão: linha sem mercadoria é ignorada e
+    mercadoria com quantidade inválida gera ValueError, sem deslocar as demais.
+    """
+    ids = request.form.getlist("item_mercadoria_id")
+    quantidades = request.form.getlist("item_quantidade")
+    if len(ids) != len(quantidades):
+        raise ValueError("Linhas de itens incompletas.")
+    itens = {}
+    for linha, (mercadoria_id, quantidade) in enumerate(zip(ids, quantidades), start=1):
+        mercadoria_id, quantidade = mercadoria_id.strip(), quantidade.strip()
+        if not mercadoria_id:
+            continue
+        if not mercadoria_id.isdigit():
+            raise ValueError(f"Item {linha}: mercadoria inválida.")
+        if not quantidade.isdigit() or int(quantidade) <= 0:
+            raise ValueError(f"Item {linha}: informe uma quantidade maior que zero.")
+        itens[int(mercadoria_id)] = itens.get(int(mercadoria_id), 0) + int(quantidade)
+    return itens
+
+
+def _data_do_formulario(campo):
+    valor = request.form.get(campo, "").strip()
+    return datetime.strptime(valor, "%Y-%m-%d").date() if valor else None
+
+
 # Função para criar um usuário inicial
-def criar_usuario_inicial():
+def criar_usuario_inicial(conn):
     """
     Cria um usuário gerente inicial se nenhum usuário existir no banco de dados.
     """
-    if Usuario.query.first() is None:
+    if conn.execute(db.select(Usuario.id).limit(1)).first() is None:
         username = os.getenv("USER")
         password = os.getenv("PASSWORD")  # Altere esta senha para uma senha forte
+        if not username or not password:
+            print("Warning: USER/PASSWORD não definidos; nenhum usuário inicial foi criado.")
+            return
         email = os.getenv("EMAIL", f"{username}@estoque.local")
 
-        novo_usuario = Usuario(username=username, email=email, role="gerente")
-        novo_usuario.set_password(password)
-        db.session.add(novo_usuario)
-        db.session.commit()
+        conn.execute(
+            Usuario.__table__.insert().values(
+                username=username,
+                email=email,
+                role="gerente",
+                password_hash=generate_password_hash(password),
+            )
+        )
+
+
+# ========== MIGRAÇÕES VERSIONADAS ==========
+# Cada passo roda uma única vez, em ordem, e fica registrado na tabela
+# `schema_version`. Na inicialização basta ler a versão atual: se o banco já
+# estiver em dia nenhuma inspeção de esquema é feita. Instâncias subindo ao
+# mesmo tempo se serializam por um advisory lock do PostgreSQL.
+# Um banco vazio não passa pelos passos: recebe o esquema atual dos modelos e
+# os dados iniciais de uma vez (`_criar_esquema_atual`) e o ledger já sai na
+# última versão. Os passos só valem para bancos criados antes de cada um deles.
+
+MIGRATION_LOCK_ID = 7402311  # chave arbitrária usada em pg_advisory_lock
+
+
+def _migracao_criar_tabelas(conn):
+    # Bancos anteriores ao ledger: cria as tabelas que ainda faltarem
+    db.metadata.create_all(bind=conn)
+
+
+def _criar_esquema_atual(conn):
+    """Banco vazio: esquema atual dos modelos e os mesmos dados iniciais dos passos."""
+    db.metadata.create_all(bind=conn)
+    criar_usuario_inicial(conn)
+    _migracao_grupos_padrao(conn)
+    conn.execute(LocalEstoque.__table__.insert().values(nome=LOCAL_PADRAO))
+    conn.execute(VersaoTabela.__table__.insert().values(tabela="sync", versao=1))
+    _migracao_busca_trigramas(conn)  # índices fora dos modelos: dependem da extensão
+
+
+def _migracao_usuario_email_role(conn):
+    # Garantir que as colunas `email` e `role` existem na tabela usuario (para bancos já existentes)
+    cols = [c["name"] for c in db.inspect(conn).get_columns("usuario")]
+    if "email" not in cols:
+        conn.execute(text("ALTER TABLE usuario ADD COLUMN email VARCHAR(100);"))
+    if "role" not in cols:
+        conn.execute(text("ALTER TABLE usuario ADD COLUMN role VARCHAR(50) DEFAULT 'funcionario';"))
+        conn.execute(text("UPDATE usuario SET role = 'gerente' WHERE id = (SELECT MIN(id) FROM usuario);"))
+
+
+def _migracao_mercadoria_codigo(conn):
+    # Garantir que a coluna `codigo` exista na tabela (para bancos já existentes).
+    cols = [c["name"] for c in db.inspect(conn).get_columns("mercadoria")]
+    if "codigo" not in cols:
+        # adiciona coluna, popula com um valor único baseado no id, adiciona constraint e torna NOT NULL
+        conn.execute(text("ALTER TABLE mercadoria ADD COLUMN codigo VARCHAR(50);"))
+        conn.execute(text("UPDATE mercadoria SET codigo = 'm' || id::text WHERE codigo IS NULL OR codigo = '';"))
+        conn.execute(text("ALTER TABLE mercadoria ADD CONSTRAINT uq_mercadoria_codigo UNIQUE (codigo);"))
+        conn.execute(text("ALTER TABLE mercadoria ALTER COLUMN codigo SET NOT NULL;"))
+
+
+def _migracao_mercadoria_grupo(conn):
+    # Garantir que a coluna `grupo` exista na tabela mercadoria (para bancos já existentes).
+    cols = [c["name"] for c in db.inspect(conn).get_columns("mercadoria")]
+    if "grupo" not in cols:
+        conn.execute(text("ALTER TABLE mercadoria ADD COLUMN grupo VARCHAR(100) DEFAULT 'Geral';"))
+        conn.execute(text("UPDATE mercadoria SET grupo = 'Geral' WHERE grupo IS NULL OR grupo = '';"))
+        conn.execute(text("ALTER TABLE mercadoria ALTER COLUMN grupo SET NOT NULL;"))
+
+
+def _migracao_grupos_padrao(conn):
+    # Popular a tabela de grupos com valores padrão se vazia
+    if conn.execute(db.select(Grupo.id).limit(1)).first() is None:
+        conn.execute(Grupo.__table__.insert(), [{"nome": nome} for nome in PRODUCT_GROUPS])
+
+
+def _migracao_indices_secundarios(conn):
+    # Códigos que só diferem em maiúsculas/minúsculas impedem o índice único em
+    # lower(codigo). Qual deles renomear (ou fundir) é decisão de quem usa o
+    # estoque: o passo para e lista os conflitos em vez de escolher sozinho.
+    repetidos = conn.execute(text(
+        "SELECT id, codigo FROM mercadoria WHERE lower(codigo) IN ("
+        "SELECT lower(codigo) FROM mercadoria GROUP BY lower(codigo) HAVING COUNT(*) > 1"
+        ") ORDER BY lower(codigo), id"
+    )).all()
+    if repetidos:
+        grupos = defaultdict(list)
+        for id_, codigo in repetidos:
+            grupos[codigo.lower()].append(f"'{codigo}' (id {id_})")
+        raise RuntimeError(
+            "Há mercadorias com o mesmo código ignorando maiúsculas/minúsculas: "
+            + "; ".join(", ".join(itens) for itens in grupos.values())
+            + ". Renomeie os códigos repetidos e suba o app novamente."
+        )
+    # Mesmos nomes gerados pelos modelos, para bancos criados antes dos índices
+    for ddl in (
+        "CREATE INDEX IF NOT EXISTS ix_mercadoria_grupo ON mercadoria (grupo)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS ix_mercadoria_codigo_lower ON mercadoria (lower(codigo))",
+        "CREATE INDEX IF NOT EXISTS ix_nota_fiscal_fornecedor_id ON nota_fiscal (fornecedor_id)",
+        "CREATE INDEX IF NOT EXISTS ix_item_nota_fiscal_nota_fiscal_id ON item_nota_fiscal (nota_fiscal_id)",
+        "CREATE INDEX IF NOT EXISTS ix_log_movimentacao_data_hora ON log_movimentacao (data_hora)",
+        "CREATE INDEX IF NOT EXISTS ix_cirurgia_data_cirurgia ON cirurgia (data_cirurgia)",
+    ):
+        conn.execute(text(ddl))
+
+
+def _migracao_grupo_fk(conn):
+    # Troca os nomes de grupo gravados por linha por uma FK para `grupo`
+    conn.execute(text("ALTER TABLE mercadoria ADD COLUMN IF NOT EXISTS grupo_id INTEGER REFERENCES grupo (id);"))
+    conn.execute(text("ALTER TABLE item_nota_fiscal ADD COLUMN IF NOT EXISTS grupo_id INTEGER REFERENCES grupo (id);"))
+    conn.execute(text("INSERT INTO grupo (nome) SELECT 'Geral' WHERE NOT EXISTS (SELECT 1 FROM grupo WHERE nome = 'Geral');"))
+    for tabela in ("mercadoria", "item_nota_fiscal"):
+        cols = [c["name"] for c in db.inspect(conn).get_columns(tabela)]
+        if "grupo" not in cols:
+            continue
+        # Nomes usados nas linhas mas ausentes na tabela de grupos viram grupos novos
+        conn.execute(text(
+            f"INSERT INTO grupo (nome) SELECT DISTINCT t.grupo FROM {tabela} t "
+            "WHERE t.grupo IS NOT NULL AND t.grupo <> '' "
+            "AND NOT EXISTS (SELECT 1 FROM grupo g WHERE g.nome = t.grupo);"
+        ))
+        conn.execute(text(
+            f"UPDATE {tabela} t SET grupo_id = g.id FROM grupo g "
+            "WHERE g.nome = t.grupo AND t.grupo_id IS NULL;"
+        ))
+        conn.execute(text(f"ALTER TABLE {tabela} DROP COLUMN grupo;"))
+    conn.execute(text(
+        "UPDATE mercadoria SET grupo_id = (SELECT id FROM grupo WHERE nome = 'Geral') WHERE grupo_id IS NULL;"
+    ))
+    conn.execute(text("ALTER TABLE mercadoria ALTER COLUMN grupo_id SET NOT NULL;"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_mercadoria_grupo_id ON mercadoria (grupo_id)"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_item_nota_fiscal_grupo_id ON item_nota_fiscal (grupo_id)"))
+
+
+def _migracao_log_quantidade(conn):
+    # Quantidade movimentada em coluna própria; logs antigos só a tinham no texto
+    conn.execute(text("ALTER TABLE log_movimentacao ADD COLUMN IF NOT EXISTS quantidade INTEGER;"))
+    conn.execute(text(
+        "UPDATE log_movimentacao "
+        "SET quantidade = substring(descricao from '^(?:Entrada|Saída) de ([0-9]+)')::int "
+        "WHERE acao IN ('Entrada', 'Saída') AND quantidade IS NULL;"
+    ))
+
+
+def _migracao_item_mercadoria(conn):
+    # Vincula itens de NF a mercadorias para a avaliação de custo
+    conn.execute(text("ALTER TABLE item_nota_fiscal ADD COLUMN IF NOT EXISTS mercadoria_id INTEGER REFERENCES mercadoria (id);"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_item_nota_fiscal_mercadoria_id ON item_nota_fiscal (mercadoria_id)"))
+
+
+def _migracao_versao_tabela(conn):
+    VersaoTabela.__table__.create(conn, checkfirst=True)
+
+
+def _migracao_sincronizacao(conn):
+    # Registros existentes entram na sequência como versão 1 (primeira sincronização)
+    for tabela in TABELAS_VERSIONADAS:
+        conn.execute(text(f"ALTER TABLE {tabela} ADD COLUMN IF NOT EXISTS versao_sync BIGINT;"))
+        conn.execute(text(f"UPDATE {tabela} SET versao_sync = 1 WHERE versao_sync IS NULL;"))
+        conn.execute(text(f"CREATE INDEX IF NOT EXISTS ix_{tabela}_versao_sync ON {tabela} (versao_sync)"))
+    ExclusaoSync.__table__.create(conn, checkfirst=True)
+    conn.execute(text(
+        "INSERT INTO versao_tabela (tabela, versao) VALUES ('sync', 1) "
+        "ON CONFLICT (tabela) DO UPDATE SET versao = GREATEST(versao_tabela.versao, 1)"
+    ))
+
+
+def _migracao_estoque_por_local(conn):
+    # O estoque atual de cada mercadoria passa a ser o saldo do local padrão
+    LocalEstoque.__table__.create(conn, checkfirst=True)
+    EstoqueLocal.__table__.create(conn, checkfirst=True)
+    conn.execute(
+        text("INSERT INTO local_estoque (nome) SELECT :n WHERE NOT EXISTS (SELECT 1 FROM local_estoque WHERE nome = :n);"),
+        {"n": LOCAL_PADRAO},
+    )
+    conn.execute(
+        text(
+            "INSERT INTO estoque_local (local_id, mercadoria_id, quantidade) "
+            "SELECT l.id, m.id, m.quantidade FROM mercadoria m JOIN local_estoque l ON l.nome = :n "
+            "WHERE NOT EXISTS (SELECT 1 FROM estoque_local e WHERE e.mercadoria_id = m.id);"
+        ),
+        {"n": LOCAL_PADRAO},
+    )
+    conn.execute(text("ALTER TABLE log_movimentacao ADD COLUMN IF NOT EXISTS local_id INTEGER REFERENCES local_estoque (id);"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_log_movimentacao_local_data ON log_movimentacao (local_id, data_hora)"))
+
+
+def _migracao_indices_log(conn):
+    # Filtros da auditoria (/informacoes) combinados com o período
+    for coluna in ("usuario_id", "mercadoria_id", "acao"):
+        nome = coluna.removesuffix("_id")
+        conn.execute(text(
+            f"CREATE INDEX IF NOT EXISTS ix_log_movimentacao_{nome}_data ON log_movimentacao ({coluna}, data_hora)"
+        ))
+
+
+def _migracao_sessao(conn):
+    SessaoUsuario.__table__.create(conn, checkfirst=True)
+
+
+def _migracao_lotes(conn):
+    Lote.__table__.create(conn, checkfirst=True)
+    ConsumoLote.__table__.create(conn, checkfirst=True)
+    conn.execute(text("ALTER TABLE item_nota_fiscal ADD COLUMN IF NOT EXISTS lote VARCHAR(50);"))
+    conn.execute(text("ALTER TABLE item_nota_fiscal ADD COLUMN IF NOT EXISTS validade DATE;"))
+    conn.execute(text("ALTER TABLE item_nota_fiscal ADD COLUMN IF NOT EXISTS lote_id INTEGER REFERENCES lote (id);"))
+
+
+def _migracao_gastos(conn):
+    GastoFornecedor.__table__.create(conn, checkfirst=True)
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_nota_fiscal_fornecedor_emissao ON nota_fiscal (fornecedor_id, data_emissao, id)"
+    ))
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_item_nota_fiscal_nota_valores ON item_nota_fiscal (nota_fiscal_id) "
+        "INCLUDE (quantidade, preco_unitario)"
+    ))
+    # Carga inicial do agregado; daí em diante ele é mantido item a item
+    conn.execute(text(
+        "INSERT INTO gasto_fornecedor (fornecedor_id, mes, grupo_id, itens, quantidade, valor) "
+        "SELECT n.fornecedor_id, date_trunc('month', n.data_emissao)::date, i.grupo_id, "
+        "COUNT(*), SUM(i.quantidade), SUM(i.quantidade * i.preco_unitario) "
+        "FROM item_nota_fiscal i JOIN nota_fiscal n ON n.id = i.nota_fiscal_id "
+        "WHERE NOT EXISTS (SELECT 1 FROM gasto_fornecedor) "
+        "GROUP BY n.fornecedor_id, date_trunc('month', n.data_emissao), i.grupo_id"
+    ))
+
+
+def _migracao_kits(conn):
+    KitCirurgico.__table__.create(conn, checkfirst=True)
+    ItemKit.__table__.create(conn, checkfirst=True)
+    ItemCirurgia.__table__.create(conn, checkfirst=True)
+
+
+def _migracao_tokens_mercadoria(conn):
+    TokenMercadoria.__table__.create(conn, checkfirst=True)
+    indexar_mercadorias(conn=conn)
+
+
+def _migracao_busca_trigramas(conn):
+    # A busca da página inicial (ILIKE '%termo%') só usa índice com pg_trgm. Sem
+    # permissão para criar a extensão a busca continua funcionando, varrendo a tabela.
+    if conn.dialect.name != "postgresql":
+        return
+    try:
+        with conn.begin_nested():
+            conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+    except Exception as e:
+        print("Warning: extensão pg_trgm indisponível; a busca por nome/código fará Seq Scan:", e)
+        return
+    for coluna in ("nome", "codigo"):
+        conn.execute(text(
+            f"CREATE INDEX IF NOT EXISTS ix_mercadoria_{coluna}_trgm ON mercadoria USING gin ({coluna} gin_trgm_ops)"
+        ))
+
+
+# (versão, descrição, passo) — sempre acrescente no fim, nunca reordene
+MIGRACOES = [
+    (1, "Tabelas iniciais", _migracao_criar_tabelas),
+    (2, "Colunas email e role em usuario", _migracao_usuario_email_role),
+    (3, "Usuário gerente inicial", criar_usuario_inicial),
+    (4, "Coluna codigo em mercadoria", _migracao_mercadoria_codigo),
+    (5, "Coluna grupo em mercadoria", _migracao_mercadoria_grupo),
+    (6, "Grupos padrão", _migracao_grupos_padrao),
+    (7, "Índices secundários e lower(codigo)", _migracao_indices_secundarios),
+    (8, "Grupo como chave estrangeira", _migracao_grupo_fk),
+    (9, "Quantidade em log_movimentacao", _migracao_log_quantidade),
+    (10, "Mercadoria em item_nota_fiscal", _migracao_item_mercadoria),
+    (11, "Tabela versao_tabela", _migracao_versao_tabela),
+    (12, "Sequência de sincronização e tombstones", _migracao_sincronizacao),
+    (13, "Estoque por local", _migracao_estoque_por_local),
+    (14, "Índices de filtro do log", _migracao_indices_log),
+    (15, "Sessões no servidor", _migracao_sessao),
+    (16, "Lotes e validades", _migracao_lotes),
+    (17, "Gastos por fornecedor", _migracao_gastos),
+    (18, "Kits e itens de cirurgia", _migracao_kits),
+    (19, "Índice de tokens das mercadorias", _migracao_tokens_mercadoria),
+    (20, "Índices de trigramas da busca", _migracao_busca_trigramas),
+]
+
+
+def versao_esquema(conn):
+    """Retorna a última migração aplicada (0 se o ledger ainda não existe)."""
+    try:
+        return conn.execute(text("SELECT MAX(version) FROM schema_version")).scalar() or 0
+    except Exception:
+        conn.rollback()
+        return 0
+
+
+def aplicar_migracoes():
+    """Aplica, uma única vez e em ordem, as migrações pendentes de `MIGRACOES`."""
+    alvo = MIGRACOES[-1][0]
+    with db.engine.connect() as conn:
+        if versao_esquema(conn) >= alvo:
+            return
+
+        postgres = conn.dialect.name == "postgresql"
+        if postgres:
+            conn.execute(text("SELECT pg_advisory_lock(:k)"), {"k": MIGRATION_LOCK_ID})
+            conn.commit()
+        try:
+            conn.execute(text(
+                "CREATE TABLE IF NOT EXISTS schema_version ("
+                "version INTEGER PRIMARY KEY, "
+                "descricao VARCHAR(200) NOT NULL, "
+                "aplicada_em TIMESTAMP NOT NULL)"
+            ))
+            conn.commit()
+            # Relê a versão: outra instância pode ter migrado enquanto esperávamos o lock
+            atual = versao_esquema(conn)
+            registrar = text("INSERT INTO schema_version (version, descricao, aplicada_em) VALUES (:v, :d, :t)")
+            if atual == 0 and not db.inspect(conn).has_table(Mercadoria.__tablename__):
+                try:
+                    _criar_esquema_atual(conn)
+                    conn.execute(registrar, [
+                        {"v": versao, "d": descricao, "t": datetime.utcnow()} for versao, descricao, _ in MIGRACOES
+                    ])
+                    conn.commit()
+                except Exception as e:
+                    conn.rollback()
+                    raise RuntimeError(f"Criação do esquema inicial falhou: {e}") from e
+                return
+            for versao, descricao, passo in MIGRACOES:
+                if versao <= atual:
+                    continue
+                try:
+                    passo(conn)
+                    conn.execute(registrar, {"v": versao, "d": descricao, "t": datetime.utcnow()})
+                    conn.commit()
+                except Exception as e:
+                    # Os passos seguintes dependem deste: o app não sobe com o esquema pela metade
+                    conn.rollback()
+                    raise RuntimeError(f"Migração {versao} ({descricao}) falhou: {e}") from e
+        finally:
+            if postgres:
+                conn.execute(text("SELECT pg_advisory_unlock(:k)"), {"k": MIGRATION_LOCK_ID})
+                conn.commit()
+
 
-# Inicializando o banco de dados e criando um usuário inicial, se necessário
 # Em ambientes serverless (Vercel/Lambda) evite abrir conexões automáticas durante import.
-# Execute as migrações manualmente definindo RUN_MIGRATIONS=1 no ambiente quando precisar criar/alterar tabelas.
+# Execute as migrações definindo RUN_MIGRATIONS=1 no ambiente; com o banco em dia
+# isso custa apenas a leitura de `schema_version`.
 if os.getenv("RUN_MIGRATIONS", "0") in ("1", "true", "True"):
     with app.app_context():
-        db.create_all()
+        aplicar_migracoes()
+
+
+# ========== RÉPLICA DE LEITURA ==========
+# Rotas marcadas com `leitura` consultam DATABASE_REPLICA_URL quando a réplica
+# responde e está com atraso aceitável (verificado a cada REPLICA_CHECK_INTERVAL).
+# Escritas ficam no primário, assim como as leituras do usuário logo após uma
+# escrita dele (ex.: o redirect depois de uma movimentação).
+
+_estado_replica = {"ok": False, "verificado_em": None}
+_replica_lock = threading.Lock()
+
+
+def _verificar_replica():
+    replica = db.engines["replica"]
+    with replica.connect() as conn:
+        if replica.dialect.name != "postgresql":
+            conn.execute(text("SELECT 1"))
+            return True
+        lsn_replica = conn.execute(text("SELECT pg_last_wal_replay_lsn()")).scalar()
+    if lsn_replica is None:
+        return True  # não é standby (ex.: dois bancos locais em teste)
+    with db.engine.connect() as conn:
+        atraso = conn.execute(
+            text("SELECT pg_wal_lsn_diff(pg_current_wal_lsn(), CAST(:lsn AS pg_lsn))"), {"lsn": str(lsn_replica)}
+        ).scalar()
+    return atraso <= app.config["REPLICA_MAX_LAG_BYTES"]
+
+
+def replica_disponivel():
+    if "replica" not in app.config.get("SQLALCHEMY_BINDS", {}):
+        return False
+    agora = time.monotonic()
+    with _replica_lock:
+        verificado = _estado_replica["verificado_em"]
+        if verificado is not None and agora - verificado < app.config["REPLICA_CHECK_INTERVAL"]:
+            return _estado_replica["ok"]
+        _estado_replica["verificado_em"] = agora
+    try:
+        ok = _verificar_replica()
+    except Exception as e:
+        print("Warning: réplica de leitura indisponível, usando o primário:", e)
+        ok = False
+    _estado_replica["ok"] = ok
+    return ok
 
-        # Garantir que as colunas `email` e `role` existem na tabela usuario (para bancos já existentes)
-        try:
-            inspector = db.inspect(db.engine)
-            cols = [c["name"] for c in inspector.get_columns("usuario")]
 
-            if "email" not in cols:
-                db.session.execute(text("ALTER TABLE usuario ADD COLUMN email VARCHAR(100);"))
-                db.session.commit()
+def marcar_replica_indisponivel():
+    with _replica_lock:
+        _estado_replica.update(ok=False, verificado_em=time.monotonic())
 
-            if "role" not in cols:
-                db.session.execute(text("ALTER TABLE usuario ADD COLUMN role VARCHAR(50) DEFAULT 'funcionario';"))
-                db.session.execute(text("UPDATE usuario SET role = 'gerente' WHERE id = (SELECT MIN(id) FROM usuario);"))
-                db.session.commit()
-        except Exception as e:
-            db.session.rollback()
-            print("Warning: não foi possível garantir colunas de usuario automaticamente:", e)
 
-        criar_usuario_inicial()
+@event.listens_for(db.session, "after_flush")
+def _marcar_escrita(sess, flush_context):
+    sess.info["escreveu"] = True
 
-        # Garantir que a coluna `codigo` exista na tabela (para bancos já existentes).
-        try:
-            inspector = db.inspect(db.engine)
-            cols = [c["name"] for c in inspector.get_columns("mercadoria")]
-            if "codigo" not in cols:
-                # adiciona coluna, popula com um valor único baseado no id, adiciona constraint e torna NOT NULL
-                db.session.execute(text("ALTER TABLE mercadoria ADD COLUMN codigo VARCHAR(50);"))
-                db.session.execute(text("UPDATE mercadoria SET codigo = 'm' || id::text WHERE codigo IS NULL OR codigo = '';"))
-                db.session.execute(text("ALTER TABLE mercadoria ADD CONSTRAINT uq_mercadoria_codigo UNIQUE (codigo);"))
-                db.session.execute(text("ALTER TABLE mercadoria ALTER COLUMN codigo SET NOT NULL;"))
-                db.session.commit()
-        except Exception as e:
-            db.session.rollback()
-            print("Warning: não foi possível garantir coluna 'codigo' automaticamente:", e)
 
-        # Garantir que a coluna `grupo` exista na tabela mercadoria (para bancos já existentes).
-        try:
-            inspector = db.inspect(db.engine)
-            cols = [c["name"] for c in inspector.get_columns("mercadoria")]
-            if "grupo" not in cols:
-                db.session.execute(text("ALTER TABLE mercadoria ADD COLUMN grupo VARCHAR(100) DEFAULT 'Geral';"))
-                db.session.execute(text("UPDATE mercadoria SET grupo = 'Geral' WHERE grupo IS NULL OR grupo = '';"))
-                db.session.execute(text("ALTER TABLE mercadoria ALTER COLUMN grupo SET NOT NULL;"))
-                db.session.commit()
-        except Exception as e:
-            db.session.rollback()
-            print("Warning: não foi possível garantir coluna 'grupo' automaticamente:", e)
+@event.listens_for(db.session, "after_commit")
+def _registrar_ultima_escrita(sess):
+    # Sem réplica não há o que rotear: evita regravar a sessão a cada escrita
+    if (
+        sess.info.pop("escreveu", False)
+        and has_request_context()
+        and "replica" in app.config.get("SQLALCHEMY_BINDS", {})
+    ):
+        session["ultima_escrita"] = time.time()
+
+
+@event.listens_for(db.session, "after_rollback")
+def _descartar_escrita(sess):
+    sess.info.pop("escreveu", None)
+
 
-        # Garantir que exista a tabela de grupos e popular com valores padrão se vazia
+def leitura(f):
+    """Decorator para rotas somente leitura: GETs podem ser atendidos pela réplica."""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        recente = time.time() - session.get("ultima_escrita", 0) < app.config["REPLICA_RYW_JANELA"]
+        if request.method == "GET" and not recente:
+            g.usar_replica = True
         try:
-            if not Grupo.query.first():
-                # Insere os grupos padrão se nenhum existir
-                for nome in PRODUCT_GROUPS:
-                    g = Grupo(nome=nome)
-                    db.session.add(g)
-                db.session.commit()
-        except Exception as e:
+            return f(*args, **kwargs)
+        except OperationalError:
+            # Réplica caiu entre verificações: repete a leitura no primário
+            if not g.pop("usar_replica", False):
+                raise
+            marcar_replica_indisponivel()
             db.session.rollback()
-            print("Warning: não foi possível popular grupos padrão automaticamente:", e)
+            return f(*args, **kwargs)
+    return decorated_function
+
+
+# ========== SESSÕES NO SERVIDOR ==========
+# O cookie guarda só um id aleatório; os dados ficam na tabela `sessao` (ou num
+# dicionário do processo, com SESSION_BACKEND=local). Requisições que não mexem
+# na sessão não regravam nada nem enviam Set-Cookie; a validade deslizante só
+# é renovada quando falta menos de SESSION_RENOVAR_FRACAO do tempo de vida.
+# Sessões abandonadas (sem logout) são apagadas numa amostra das gravações
+# (SESSION_LIMPEZA_AMOSTRA), para o armazém não crescer sem limite.
+# O papel do usuário fica na sessão, então `gerente_required` não consulta o
+# banco; alterar papel ou senha derruba as outras sessões do usuário.
+
+class SessaoServidor(CallbackDict, SessionMixin):
+    def __init__(self, dados=None, sid=None, expira_em=None):
+        def ao_alterar(sessao):
+            sessao.modified = True
+            sessao.accessed = True
+
+        super().__init__(dados, ao_alterar)
+        self.sid = sid
+        self.expira_em = expira_em
+        self.modified = False
+        self.accessed = False
+        self.trocar_id = False
+
+    def __getitem__(self, chave):
+        self.accessed = True
+        return super().__getitem__(chave)
+
+    def get(self, chave, padrao=None):
+        self.accessed = True
+        return super().get(chave, padrao)
+
+    def setdefault(self, chave, padrao=None):
+        self.accessed = True
+        return super().setdefault(chave, padrao)
+
+    def renovar_id(self):
+        """Gera um id novo ao salvar (evita fixação de sessão no login)."""
+        self.trocar_id = True
+        self.modified = True
+
+
+class ArmazemSessaoLocal:
+    """Sessões num dicionário deste processo (apenas um worker)."""
+
+    def __init__(self):
+        self._sessoes = {}
+        self._lock = threading.Lock()
+
+    def carregar(self, sid):
+        with self._lock:
+            registro = self._sessoes.get(sid)
+        return registro and (registro[1], registro[2])
+
+    def gravar(self, sid, usuario_id, dados, expira_em):
+        with self._lock:
+            self._sessoes[sid] = (usuario_id, dados, expira_em)
+
+    def excluir(self, sid):
+        with self._lock:
+            self._sessoes.pop(sid, None)
+
+    def limpar_vencidas(self):
+        agora = datetime.utcnow()
+        with self._lock:
+            for sid in [s for s, r in self._sessoes.items() if r[2] < agora]:
+                del self._sessoes[sid]
+
+    def excluir_do_usuario(self, usuario_id, exceto=None):
+        with self._lock:
+            for sid in [s for s, r in self._sessoes.items() if r[0] == usuario_id and s != exceto]:
+                del self._sessoes[sid]
+
+
+class ArmazemSessaoBanco:
+    """Sessões na tabela `sessao`, sempre no primário (fora da sessão do SQLAlchemy da rota)."""
+
+    def carregar(self, sid):
+        with db.engine.connect() as conn:
+            return conn.execute(
+                db.select(SessaoUsuario.dados, SessaoUsuario.expira_em).where(SessaoUsuario.id == sid)
+            ).first()
+
+    def gravar(self, sid, usuario_id, dados, expira_em):
+        with db.engine.begin() as conn:
+            conn.execute(
+                text(
+                    "INSERT INTO sessao (id, usuario_id, dados, expira_em) VALUES (:id, :u, :d, :e) "
+                    "ON CONFLICT (id) DO UPDATE SET usuario_id = :u, dados = :d, expira_em = :e"
+                ),
+                {"id": sid, "u": usuario_id, "d": dados, "e": expira_em},
+            )
+
+    def excluir(self, sid):
+        with db.engine.begin() as conn:
+            conn.execute(db.delete(SessaoUsuario).where(SessaoUsuario.id == sid))
+
+    def limpar_vencidas(self):
+        with db.engine.begin() as conn:
+            # Índice em expira_em
+            conn.execute(db.delete(SessaoUsuario).where(SessaoUsuario.expira_em < datetime.utcnow()))
+
+    def excluir_do_usuario(self, usuario_id, exceto=None):
+        with db.engine.begin() as conn:
+            conn.execute(
+                db.delete(SessaoUsuario).where(SessaoUsuario.usuario_id == usuario_id, SessaoUsuario.id != exceto)
+            )
+
+
+class InterfaceSessaoServidor(SessionInterface):
+    serializer = TaggedJSONSerializer()
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            registro = armazem_sessao.carregar(sid)
+            if registro is not None and registro[1] > datetime.utcnow():
+                return SessaoServidor(self.serializer.loads(registro[0]), sid, registro[1])
+        return SessaoServidor()
+
+    def save_session(self, app, sessao, response):
+        nome = self.get_cookie_name(app)
+        dominio = self.get_cookie_domain(app)
+        caminho = self.get_cookie_path(app)
+        if sessao.accessed:
+            response.vary.add("Cookie")
+
+        if not sessao:
+            if sessao.sid is not None:
+                armazem_sessao.excluir(sessao.sid)
+                response.delete_cookie(nome, domain=dominio, path=caminho)
+                response.vary.add("Cookie")
+            return
+
+        agora = datetime.utcnow()
+        vida = app.permanent_session_lifetime
+        if sessao.trocar_id and sessao.sid is not None:
+            armazem_sessao.excluir(sessao.sid)
+            sessao.sid = None
+        renovar = sessao.sid is None or sessao.expira_em - agora < vida * app.config["SESSION_RENOVAR_FRACAO"]
+        if not (sessao.modified or renovar):
+            return
+        if sessao.sid is None:
+            sessao.sid = secrets.token_urlsafe(32)
+        expira_em = agora + vida if renovar else sessao.expira_em
+        armazem_sessao.gravar(sessao.sid, sessao.get("user_id"), self.serializer.dumps(dict(sessao)), expira_em)
+        if random.random() < app.config["SESSION_LIMPEZA_AMOSTRA"]:
+            armazem_sessao.limpar_vencidas()
+        if renovar:
+            response.set_cookie(
+                nome,
+                sessao.sid,
+                expires=expira_em,
+                httponly=self.get_cookie_httponly(app),
+                domain=dominio,
+                path=caminho,
+                secure=self.get_cookie_secure(app),
+                samesite=self.get_cookie_samesite(app),
+            )
+            response.vary.add("Cookie")
+
+
+armazem_sessao = ArmazemSessaoLocal() if app.config['SESSION_BACKEND'] == 'local' else ArmazemSessaoBanco()
+app.session_interface = InterfaceSessaoServidor()
 
 
 def login_required(f):
@@ -283,7 +2054,6 @@ def login_required(f):
         if "user_id" not in session:
             flash("Por favor, faça login para acessar esta página.", "warning")
             return redirect(url_for("login"))
-        session.modified = True  # Atualiza o tempo da sessão a cada requisição
         return f(*args, **kwargs)
     return decorated_function
 
@@ -295,36 +2065,473 @@ def gerente_required(f):
         if "user_id" not in session:
             flash("Por favor, faça login para acessar esta página.", "warning")
             return redirect(url_for("login"))
-        usuario = Usuario.query.get(session["user_id"])
-        if not usuario or usuario.role != "gerente":
+        if session.get("role") != "gerente":
             flash("Você não tem permissão para acessar esta página. Apenas gerentes podem.", "error")
             return redirect(url_for("index"))
-        session.modified = True
         return f(*args, **kwargs)
     return decorated_function
 
 
-def registrar_log(acao, descricao, mercadoria_id=None, fornecedor_id=None):
-    log = LogMovimentacao(
-        usuario_id=session.get("user_id"),
+# ========== LOG DE AUDITORIA ==========
+# `registrar_log` não faz commit: a linha entra na transação de quem chamou e só
+# existe se a operação for confirmada. Com AUDIT_LOG_MODE=buffer as linhas das
+# transações confirmadas vão para um buffer limitado em memória e uma thread as
+# grava em INSERTs de várias linhas ao juntar AUDIT_LOG_BATCH linhas ou a cada
+# AUDIT_LOG_INTERVAL segundos; o restante é gravado no encerramento do processo.
+# No modo buffer um processo que morre sem encerrar perde o que não foi gravado.
+
+def registrar_log(acao, descricao, mercadoria_id=None, fornecedor_id=None, quantidade=None, local_id=None):
+    """Registra a ação no log de auditoria junto com a transação atual (chame antes do commit)."""
+    dados = dict(
+        usuario_id=session.get("user_id") if has_request_context() else None,
         acao=acao,
         mercadoria_id=mercadoria_id,
         fornecedor_id=fornecedor_id,
         descricao=descricao,
+        quantidade=quantidade,
+        local_id=local_id,
+        data_hora=datetime.utcnow(),
     )
-    db.session.add(log)
-    db.session.commit()
+    if auditoria is None:
+        db.session.add(LogMovimentacao(**dados))
+    else:
+        db.session.info.setdefault("logs_auditoria", []).append((time.monotonic(), dados))
+
+
+class BufferAuditoria:
+    """Acumula linhas de log e as grava em lotes numa thread própria."""
+
+    def __init__(self, lote, intervalo, maximo):
+        self.lote, self.intervalo, self.maximo = lote, intervalo, maximo
+        self._pendentes = []  # (instante em que entrou, linha)
+        self._cond = threading.Condition()
+        self._gravacao = threading.Lock()  # um lote por vez, na ordem de chegada
+        self._thread = None
+        self._parar = False
+        self._metricas = {
+            "lotes": 0, "linhas": 0, "maior_lote": 0, "falhas": 0,
+            "latencia_media_ms": 0.0, "latencia_max_ms": 0.0, "gravacoes_sincronas": 0,
+        }
+
+    def adicionar(self, linhas):
+        with self._cond:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._executar, name="auditoria", daemon=True)
+                self._thread.start()
+            if len(self._pendentes) + len(linhas) <= self.maximo:
+                self._pendentes.extend(linhas)
+                if len(self._pendentes) >= self.lote:
+                    self._cond.notify()
+                return
+        # Buffer cheio (banco lento): quem chamou grava o buffer e as próprias linhas
+        self._metricas["gravacoes_sincronas"] += 1
+        self.descarregar(linhas)
+
+    def _executar(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: len(self._pendentes) >= self.lote or self._parar, self.intervalo)
+                if self._parar:
+                    return
+            self.descarregar()
+
+    def descarregar(self, extras=()):
+        """Grava agora tudo o que está pendente (mais `extras`), em lotes de `lote` linhas."""
+        with self._gravacao:
+            with self._cond:
+                linhas, self._pendentes = self._pendentes + list(extras), []
+            for i in range(0, len(linhas), self.lote):
+                self._gravar(linhas[i:i + self.lote])
+
+    def _gravar(self, lote):
+        tabela = LogMovimentacao.__table__
+        try:
+            with app.app_context(), db.engine.begin() as conn:
+                try:
+                    with conn.begin_nested():
+                        conn.execute(tabela.insert(), [linha for _, linha in lote])
+                except IntegrityError:
+                    # Alguma linha referencia um registro excluído depois de enfileirada:
+                    # grava uma a uma e, nessas, descarta as referências
+                    for _, linha in lote:
+                        try:
+                            with conn.begin_nested():
+                                conn.execute(tabela.insert(), linha)
+                        except IntegrityError:
+                            conn.execute(tabela.insert(), {
+                                **linha, "mercadoria_id": None, "fornecedor_id": None, "local_id": None,
+                            })
+        except Exception as e:
+            self._metricas["falhas"] += 1
+            print(f"Warning: {len(lote)} linhas do log de auditoria não foram gravadas:", e)
+            return
+        latencia = (time.monotonic() - min(t for t, _ in lote)) * 1000
+        m = self._metricas
+        m["latencia_media_ms"] = (m["latencia_media_ms"] * m["lotes"] + latencia) / (m["lotes"] + 1)
+        m["latencia_max_ms"] = max(m["latencia_max_ms"], latencia)
+        m["lotes"] += 1
+        m["linhas"] += len(lote)
+        m["maior_lote"] = max(m["maior_lote"], len(lote))
+
+    def encerrar(self):
+        with self._cond:
+            self._parar = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+        self.descarregar()
+
+    def metricas(self):
+        m = dict(self._metricas, modo="buffer", pendentes=len(self._pendentes))
+        m["media_lote"] = round(m["linhas"] / m["lotes"], 1) if m["lotes"] else 0
+        return m
+
+
+auditoria = None
+if app.config['AUDIT_LOG_MODE'] == 'buffer':
+    auditoria = BufferAuditoria(
+        app.config['AUDIT_LOG_BATCH'], app.config['AUDIT_LOG_INTERVAL'], app.config['AUDIT_LOG_BUFFER_MAX'],
+    )
+    atexit.register(auditoria.encerrar)
+
+
+@event.listens_for(db.session, "after_commit")
+def _enfileirar_logs(sess):
+    linhas = sess.info.pop("logs_auditoria", None)
+    if linhas:
+        auditoria.adicionar(linhas)
+
+
+@event.listens_for(db.session, "after_rollback")
+def _descartar_logs(sess):
+    sess.info.pop("logs_auditoria", None)
+
+
+# ========== COMPRESSÃO DE RESPOSTAS ==========
+# Negocia brotli/gzip pelo Accept-Encoding. Respostas em streaming são
+# comprimidas pedaço a pedaço; corpos pequenos (< COMPRESS_MIN_SIZE) seguem
+# sem compressão. A razão de compressão acumulada fica em METRICAS.
+
+METRICAS = {"compressao": {}}
+_metricas_lock = threading.Lock()
+_cache_comprimido = OrderedDict()  # (sha1, codificação) -> bytes
+
+
+def _registrar_compressao(codificacao, original, comprimido):
+    with _metricas_lock:
+        m = METRICAS["compressao"].setdefault(codificacao, {"respostas": 0, "bytes_in": 0, "bytes_out": 0})
+        m["respostas"] += 1
+        m["bytes_in"] += original
+        m["bytes_out"] += comprimido
+        m["razao"] = round(m["bytes_in"] / m["bytes_out"], 2) if m["bytes_out"] else None
+
+
+def _novo_compressor(codificacao):
+    if codificacao == "br":
+        return brotli.Compressor(quality=5)
+    return zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31: formato gzip
+
+
+def _comprimir(dados, codificacao):
+    if codificacao == "br":
+        return brotli.compress(dados, quality=5)
+    c = _novo_compressor(codificacao)
+    return c.compress(dados) + c.flush()
+
+
+def _comprimir_stream(pedacos, codificacao):
+    compressor = _novo_compressor(codificacao)
+    original = comprimido = 0
+    for pedaco in pedacos:
+        if isinstance(pedaco, str):
+            pedaco = pedaco.encode("utf-8")
+        if not pedaco:
+            continue
+        original += len(pedaco)
+        # Descarrega a cada pedaço para o cliente receber os dados progressivamente
+        if codificacao == "br":
+            saida = compressor.process(pedaco) + compressor.flush()
+        else:
+            saida = compressor.compress(pedaco) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        comprimido += len(saida)
+        yield saida
+    final = compressor.finish() if codificacao == "br" else compressor.flush()
+    comprimido += len(final)
+    yield final
+    _registrar_compressao(codificacao, original, comprimido)
+
+
+def _codificacao_aceita():
+    aceitas = request.accept_encodings
+    if brotli is not None and aceitas.quality("br") > 0:
+        return "br"
+    if aceitas.quality("gzip") > 0:
+        return "gzip"
+    return None
+
+
+@app.after_request
+def comprimir_resposta(response):
+    if (
+        response.status_code != 200
+        or response.direct_passthrough  # send_file: xlsx/pdf/fotos já são compactos
+        or "Content-Encoding" in response.headers
+        or response.mimetype not in app.config["COMPRESS_MIMETYPES"]
+    ):
+        return response
+    response.vary.add("Accept-Encoding")
+    codificacao = _codificacao_aceita()
+    if codificacao is None:
+        return response
+
+    if response.is_streamed:
+        response.response = _comprimir_stream(response.response, codificacao)
+        response.headers.pop("Content-Length", None)
+        response.headers["Content-Encoding"] = codificacao
+        return response
+
+    dados = response.get_data()
+    if len(dados) < app.config["COMPRESS_MIN_SIZE"]:
+        return response
+    if response.mimetype in app.config["COMPRESS_CACHE_MIMETYPES"]:
+        chave = (hashlib.sha1(dados).digest(), codificacao)
+        with _metricas_lock:
+            comprimido = _cache_comprimido.get(chave)
+            if comprimido is not None:
+                _cache_comprimido.move_to_end(chave)
+        if comprimido is None:
+            comprimido = _comprimir(dados, codificacao)
+            with _metricas_lock:
+                _cache_comprimido[chave] = comprimido
+                while len(_cache_comprimido) > app.config["COMPRESS_CACHE_SIZE"]:
+                    _cache_comprimido.popitem(last=False)
+    else:
+        comprimido = _comprimir(dados, codificacao)
+    _registrar_compressao(codificacao, len(dados), len(comprimido))
+    response.set_data(comprimido)
+    response.headers["Content-Encoding"] = codificacao
+    return response
+
+
+@app.route("/metricas")
+@gerente_required
+def metricas():
+    with _metricas_lock:
+        dados = dict(METRICAS)
+    dados["auditoria"] = auditoria.metricas() if auditoria else {"modo": "transacao"}
+    return jsonify(dados)
+
+
+# ========== CONSULTAS SOMENTE LEITURA ==========
+# Listagens e exportações selecionam só as colunas exibidas. O resultado são
+# `Row` do SQLAlchemy (tuplas nomeadas): nada entra no identity map da sessão,
+# não há cópia de estado para detectar alterações nem lazy load por linha.
+# Use as entidades do ORM apenas quando a rota for alterar o registro.
+
+# As rotas montam suas consultas por funções `consulta_*`, que devolvem o
+# SELECT sem executá-lo: tests/test_indices.py roda EXPLAIN nessas mesmas
+# funções, então o plano verificado é o da consulta que a rota executa.
+
+def consulta_relatorio(grupo_id=None, local_id=None):
+    """
+    Mercadorias do relatório (id, codigo, nome, grupo, quantidade, descricao,
+    preco). Com local, a quantidade é o saldo dele e só as mercadorias presentes
+    no local são lidas.
+    """
+    if local_id:
+        quantidade = EstoqueLocal.quantidade
+    else:
+        quantidade = Mercadoria.quantidade
+    consulta = (
+        db.select(
+            Mercadoria.id, Mercadoria.codigo, Mercadoria.nome, Grupo.nome.label("grupo"),
+            quantidade.label("quantidade"), Mercadoria.descricao, Mercadoria.preco,
+        )
+        .join(Grupo, Mercadoria.grupo_id == Grupo.id)
+        .order_by(Mercadoria.nome)
+    )
+    if local_id:
+        consulta = consulta.join(
+            EstoqueLocal,
+            db.and_(EstoqueLocal.mercadoria_id == Mercadoria.id, EstoqueLocal.local_id == local_id),
+        )
+    if grupo_id:
+        consulta = consulta.where(Mercadoria.grupo_id == grupo_id)
+    return consulta
+
+
+def linhas_relatorio(grupo_id=None, local_id=None):
+    return db.session.execute(consulta_relatorio(grupo_id, local_id)).all()
+
+
+def consulta_codigo_existente(codigo):
+    """Id da mercadoria com esse código, sem diferenciar maiúsculas (índice lower(codigo))."""
+    return db.select(Mercadoria.id).where(db.func.lower(Mercadoria.codigo) == codigo.lower()).limit(1)
+
+
+CIRURGIAS_POR_PAGINA = 100
+
+
+def consulta_cirurgias(pagina=1):
+    """
+    Página de cirurgias, mais recentes primeiro, com o produto e o usuário já
+    resolvidos. Traz uma linha a mais para indicar se há próxima página.
+    """
+    return (
+        db.select(
+            Cirurgia.id, Cirurgia.data_cirurgia, Cirurgia.nome_paciente, Cirurgia.descricao,
+            Cirurgia.referencia_produto, Cirurgia.foto_path,
+            Mercadoria.codigo.label("mercadoria_codigo"), Mercadoria.nome.label("mercadoria_nome"),
+            Usuario.username.label("usuario"),
+            db.select(db.func.count())
+            .where(ItemCirurgia.cirurgia_id == Cirurgia.id)
+            .scalar_subquery()
+            .label("itens"),
+        )
+        .outerjoin(Mercadoria, Cirurgia.mercadoria_id == Mercadoria.id)
+        .outerjoin(Usuario, Cirurgia.usuario_id == Usuario.id)
+        .order_by(Cirurgia.data_cirurgia.desc(), Cirurgia.id.desc())
+        .offset((pagina - 1) * CIRURGIAS_POR_PAGINA)
+        .limit(CIRURGIAS_POR_PAGINA + 1)
+    )
+
+
+def linhas_cirurgias(pagina=1):
+    return db.session.execute(consulta_cirurgias(pagina)).all()
+
+
+def linhas_fornecedores():
+    return db.session.execute(
+        db.select(
+            Fornecedor.id, Fornecedor.cnpj, Fornecedor.nome, Fornecedor.endereco,
+            Fornecedor.telefone, Fornecedor.email,
+        ).order_by(Fornecedor.nome)
+    ).all()
+
+
+# ========== CACHE DE FRAGMENTOS DO INDEX ==========
+# A tabela de estoque e as opções de fornecedor são guardadas já renderizadas,
+# indexadas pelas versões das tabelas. Quando `mercadoria` muda, só as linhas
+# cujos dados mudaram são renderizadas de novo.
+
+_fragmentos = {}  # nome -> (chave, html)
+_linhas_estoque = {}  # mercadoria id -> (dados da linha, html)
+_fragmentos_lock = threading.Lock()
+
+
+def consulta_tabela_estoque():
+    """Todas as mercadorias da página inicial; lida só quando a versão delas muda."""
+    return (
+        db.select(
+            Mercadoria.id, Grupo.nome, Mercadoria.nome, Mercadoria.quantidade,
+            Mercadoria.descricao, Mercadoria.preco,
+        )
+        .join(Grupo, Mercadoria.grupo_id == Grupo.id)
+        .order_by(Mercadoria.id)
+    )
+
+
+def consulta_opcoes_fornecedores():
+    return db.select(Fornecedor.id, Fornecedor.nome).order_by(Fornecedor.nome)
+
+
+def _tabela_estoque_html(chave):
+    with _fragmentos_lock:
+        if _fragmentos.get("tabela_estoque", (None,))[0] == chave:
+            return _fragmentos["tabela_estoque"][1]
+
+    linhas = db.session.execute(consulta_tabela_estoque()).all()
+    template = app.jinja_env.get_template("_linha_mercadoria.html")
+    with _fragmentos_lock:
+        partes = []
+        for dados in linhas:
+            dados = tuple(dados)
+            cache = _linhas_estoque.get(dados[0])
+            if cache is None or cache[0] != dados:
+                id_, grupo, nome, quantidade, descricao, preco = dados
+                cache = (dados, template.render(
+                    id=id_, grupo=grupo, nome=nome, quantidade=quantidade, descricao=descricao, preco=preco,
+                ))
+                _linhas_estoque[id_] = cache
+            partes.append(cache[1])
+        # descarta linhas de mercadorias excluídas
+        for id_ in _linhas_estoque.keys() - {d[0] for d in linhas}:
+            del _linhas_estoque[id_]
+        html = "".join(partes)
+        _fragmentos["tabela_estoque"] = (chave, html)
+        return html
+
+
+def _opcoes_fornecedores_html(chave):
+    with _fragmentos_lock:
+        if _fragmentos.get("opcoes_fornecedores", (None,))[0] == chave:
+            return _fragmentos["opcoes_fornecedores"][1]
+    fornecedores = db.session.execute(consulta_opcoes_fornecedores()).all()
+    html = app.jinja_env.get_template("_opcoes_fornecedores.html").render(fornecedores=fornecedores)
+    with _fragmentos_lock:
+        _fragmentos["opcoes_fornecedores"] = (chave, html)
+    return html
 
 
 @app.route("/")
 @login_required
+@leitura
 def index():
-    mercadorias = Mercadoria.query.all()
+    versoes = versoes_tabelas(*TABELAS_VERSIONADAS)
     usuario = Usuario.query.get(session.get("user_id"))
-    fornecedores = Fornecedor.query.order_by(Fornecedor.nome).all()
-    # versão serializável para uso em JavaScript
-    fornecedores_json = [ { 'id': f.id, 'nome': f.nome } for f in fornecedores ]
-    return render_template("index.html", mercadorias=mercadorias, usuario=usuario, fornecedores=fornecedores, fornecedores_json=fornecedores_json)
+    tabela_html = _tabela_estoque_html((versoes["mercadoria"], versoes["grupo"]))
+    opcoes_fornecedores = _opcoes_fornecedores_html(versoes["fornecedor"])
+    return render_template(
+        "index.html",
+        usuario=usuario,
+        tabela_html=Markup(tabela_html),
+        opcoes_fornecedores=Markup(opcoes_fornecedores),
+    )
+
+
+@app.route("/eventos/estoque")
+@login_required
+def eventos_estoque():
+    """Stream SSE com as alterações de quantidade das mercadorias."""
+    fila = canal_estoque.assinar()
+    if fila is None:
+        # Sem thread livre para mais um stream: o EventSource desiste e a página faz polling
+        return Response("Limite de streams atingido.", status=503, mimetype="text/plain")
+
+    def gerar():
+        try:
+            yield "retry: 5000\n\n"
+            while True:
+                try:
+                    evento = fila.get(timeout=15)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                if evento is None:
+                    return  # worker encerrando
+                yield f"data: {json.dumps(evento)}\n\n"
+        finally:
+            canal_estoque.cancelar(fila)
+
+    return Response(
+        gerar(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.route("/estoque/quantidades")
+@login_required
+@leitura
+def quantidades_estoque():
+    """Quantidades atuais das mercadorias em `ids` (polling quando não há stream SSE)."""
+    ids = request.args.getlist("ids", type=int)[:500]
+    if not ids:
+        return jsonify({})
+    linhas = db.session.execute(
+        db.select(Mercadoria.id, Mercadoria.quantidade).where(Mercadoria.id.in_(ids))
+    ).all()
+    return jsonify({str(id_): quantidade for id_, quantidade in linhas})
 
 
 @app.route("/adicionar", methods=["GET", "POST"])
@@ -335,7 +2542,14 @@ def adicionar():
         # Novo cadastro de mercadoria
         if form_type == "novo":
             codigo = request.form["codigo"].strip()
-            grupo = request.form.get("grupo", "Geral").strip()
+            grupo = _grupo_do_formulario()
+            if not grupo:
+                flash("Grupo inválido.", "error")
+                return redirect(url_for("adicionar"))
+            local = _local_do_formulario()
+            if not local:
+                flash("Local inválido.", "error")
+                return redirect(url_for("adicionar"))
             nome = request.form.get("nome", "").strip()
             try:
                 quantidade = int(request.form["quantidade"])
@@ -346,28 +2560,33 @@ def adicionar():
                 preco = float(request.form.get("preco", 0))
             except Exception:
                 preco = 0.0
-            mercadoria_existente = Mercadoria.query.filter(
-                db.func.lower(Mercadoria.codigo) == codigo.lower()
-            ).first()
-            if mercadoria_existente:
+            if db.session.execute(consulta_codigo_existente(codigo)).first():
                 flash("Já existe uma mercadoria com esse código!", "error")
                 return redirect(url_for("adicionar"))
 
             nova_mercadoria = Mercadoria(
                 nome=nome or codigo,
                 codigo=codigo,
-                quantidade=quantidade,
+                quantidade=0,
                 descricao=descricao,
                 preco=preco,
                 grupo=grupo,
             )
             db.session.add(nova_mercadoria)
-            db.session.commit()
+            db.session.flush()
+            try:
+                ajustar_estoque(nova_mercadoria.id, local.id, quantidade)
+            except ValueError as e:
+                db.session.rollback()
+                flash(str(e), "error")
+                return redirect(url_for("adicionar"))
             registrar_log(
                 "Inserção",
-                f"Mercadoria '{nova_mercadoria.codigo}' adicionada com quantidade {quantidade}.",
+                f"Mercadoria '{nova_mercadoria.codigo}' adicionada com quantidade {quantidade} em '{local.nome}'.",
                 mercadoria_id=nova_mercadoria.id,
+                local_id=local.id,
             )
+            db.session.commit()
             flash("Mercadoria adicionada com sucesso!", "success")
             return redirect(url_for("index"))
 
@@ -383,6 +2602,7 @@ def adicionar():
             except Exception:
                 mov_q = 0
             mov_desc = request.form.get("mov_descricao", "")
+            descarte = mov_type == "saida" and request.form.get("descarte_vencidos") == "1"
 
             if not merc_id or mov_q <= 0 or mov_type not in ("entrada", "saida"):
                 flash("Dados de movimentação inválidos.", "error")
@@ -392,32 +2612,64 @@ def adicionar():
             if not merc:
                 flash("Mercadoria não encontrada.", "error")
                 return redirect(url_for("adicionar"))
+            local = _local_do_formulario()
+            if not local:
+                flash("Local inválido.", "error")
+                return redirect(url_for("adicionar"))
 
-            if mov_type == "entrada":
-                merc.quantidade = (merc.quantidade or 0) + mov_q
-                acao = "Entrada"
-                descricao_log = f"Entrada de {mov_q} na mercadoria '{merc.codigo}'. {mov_desc}"
-            else:
-                # saída
-                if (merc.quantidade or 0) < mov_q:
-                    flash("Quantidade insuficiente para saída.", "error")
-                    return redirect(url_for("adicionar"))
-                merc.quantidade = (merc.quantidade or 0) - mov_q
-                acao = "Saída"
-                descricao_log = f"Saída de {mov_q} da mercadoria '{merc.codigo}'. {mov_desc}"
-
+            try:
+                if mov_type == "entrada":
+                    acao = "Entrada"
+                    descricao_log = f"Entrada de {mov_q} na mercadoria '{merc.codigo}' em '{local.nome}'. {mov_desc}"
+                    ajustar_estoque(merc.id, local.id, mov_q)
+                else:
+                    acao = "Saída"
+                    descricao_log = f"Saída de {mov_q} da mercadoria '{merc.codigo}' em '{local.nome}'. {mov_desc}"
+                    if descarte:
+                        descricao_log += " Descarte de vencidos."
+                    consumidos = baixar_estoque(merc.id, local.id, mov_q, vencidos=descarte)
+                    if consumidos:
+                        descricao_log += f" Lotes: {descrever_lotes(consumidos)}."
+            except ValueError as e:
+                db.session.rollback()
+                flash(str(e), "error")
+                return redirect(url_for("adicionar"))
+            registrar_log(acao, descricao_log, mercadoria_id=merc.id, quantidade=mov_q, local_id=local.id)
             db.session.commit()
-            registrar_log(acao, descricao_log, mercadoria_id=merc.id)
             flash(f"Movimentação '{acao}' registrada com sucesso.", "success")
             return redirect(url_for("index"))
 
-    # fornecer lista de grupos, mercadorias e fornecedores para o formulário
-    grupos = [g.nome for g in Grupo.query.order_by(Grupo.nome).all()]
-    if not grupos:
-        grupos = PRODUCT_GROUPS
+        # Transferência entre locais (total da mercadoria não muda)
+        if form_type == "transferir":
+            merc = db.session.get(Mercadoria, request.form.get("mercadoria_id", type=int) or 0)
+            origem = _local_do_formulario("origem_id")
+            destino = _local_do_formulario("destino_id")
+            quantidade = request.form.get("quantidade", 0, type=int)
+            if not merc or not origem or not destino or quantidade <= 0:
+                flash("Dados de transferência inválidos.", "error")
+                return redirect(url_for("adicionar"))
+            try:
+                transferir_estoque(merc.id, origem.id, destino.id, quantidade)
+            except ValueError as e:
+                db.session.rollback()
+                flash(str(e), "error")
+                return redirect(url_for("adicionar"))
+            descricao_log = f"Transferência de {quantidade} da mercadoria '{merc.codigo}' de '{origem.nome}' para '{destino.nome}'."
+            registrar_log("Transferência (saída)", descricao_log, mercadoria_id=merc.id, quantidade=quantidade, local_id=origem.id)
+            registrar_log("Transferência (entrada)", descricao_log, mercadoria_id=merc.id, quantidade=quantidade, local_id=destino.id)
+            db.session.commit()
+            flash("Transferência registrada com sucesso.", "success")
+            return redirect(url_for("adicionar"))
+
+    # fornecer lista de grupos, locais, mercadorias e fornecedores para o formulário
+    grupos = Grupo.query.order_by(Grupo.nome).all()
+    locais = LocalEstoque.query.order_by(LocalEstoque.nome).all()
     mercadorias = Mercadoria.query.order_by(Mercadoria.nome).all()
     fornecedores = Fornecedor.query.order_by(Fornecedor.nome).all()
-    return render_template("adicionar.html", grupos=grupos, mercadorias=mercadorias, fornecedores=fornecedores)
+    return render_template(
+        "adicionar.html", grupos=grupos, locais=locais, mercadorias=mercadorias, fornecedores=fornecedores,
+        local_padrao=LOCAL_PADRAO,
+    )
 
 
 
@@ -451,8 +2703,8 @@ def nova_nf():
             fornecedor_id=fornecedor.id
         )
         db.session.add(nova)
-        db.session.commit()
         registrar_log('Inserção NF', f"Nota Fiscal '{numero_nf}' criada para fornecedor '{fornecedor.nome}'.", fornecedor_id=fornecedor.id)
+        db.session.commit()
         flash('Nota Fiscal criada com sucesso!', 'success')
         return redirect(url_for('listar_notas_fiscais', fornecedor_id=fornecedor.id))
     except Exception as e:
@@ -466,25 +2718,67 @@ def nova_nf():
 def editar(id):
     mercadoria = Mercadoria.query.get_or_404(id)
     if request.method == "POST":
+        # Trava a linha antes de alterá-la (mesma ordem das movimentações) e
+        # calcula a diferença sobre a quantidade travada
+        mercadoria = db.session.get(Mercadoria, id, with_for_update=True, populate_existing=True)
+        grupo = _grupo_do_formulario(mercadoria.grupo_id)
+        if not grupo:
+            flash("Grupo inválido.", "error")
+            return redirect(url_for("editar", id=id))
+        local = _local_do_formulario()
+        if not local:
+            flash("Local inválido.", "error")
+            return redirect(url_for("editar", id=id))
         mercadoria.codigo = request.form["codigo"].strip()
-        mercadoria.grupo = request.form.get("grupo", mercadoria.grupo).strip()
+        mercadoria.grupo = grupo
         mercadoria.nome = request.form.get("nome", mercadoria.nome).strip()
-        mercadoria.quantidade = int(request.form["quantidade"])
         mercadoria.descricao = request.form["descricao"]
         mercadoria.preco = float(request.form["preco"])
-        db.session.commit()
+        # A diferença no total é lançada no local escolhido
+        delta = int(request.form["quantidade"]) - (mercadoria.quantidade or 0)
+        try:
+            if delta:
+                ajustar_estoque(mercadoria.id, local.id, delta)
+            if delta < 0:
+                conferir_estoque_lotes([mercadoria.id])
+        except ValueError as e:
+            db.session.rollback()
+            flash(str(e), "error")
+            return redirect(url_for("editar", id=id))
         registrar_log(
             "Edição",
             f"Mercadoria '{mercadoria.codigo}' editada. Quantidade: {mercadoria.quantidade}.",
             mercadoria_id=mercadoria.id,
+            quantidade=abs(delta) or None,
+            local_id=local.id if delta else None,
         )
+        db.session.commit()
         flash("Mercadoria editada com sucesso!", "success")
         return redirect(url_for("index"))
 
-    grupos = [g.nome for g in Grupo.query.order_by(Grupo.nome).all()]
-    if not grupos:
-        grupos = PRODUCT_GROUPS
-    return render_template("editar.html", mercadoria=mercadoria, grupos=grupos)
+    grupos = Grupo.query.order_by(Grupo.nome).all()
+    locais = LocalEstoque.query.order_by(LocalEstoque.nome).all()
+    return render_template(
+        "editar.html", mercadoria=mercadoria, grupos=grupos, locais=locais, local_padrao=LOCAL_PADRAO,
+    )
+
+
+# Registros que impedem a exclusão de uma mercadoria (as chaves estrangeiras não cascateiam)
+REFERENCIAS_MERCADORIA = (
+    (Lote, "lotes"),
+    (ItemKit, "kits cirúrgicos"),
+    (ItemCirurgia, "cirurgias"),
+    (Cirurgia, "cirurgias"),
+    (ItemNotaFiscal, "itens de nota fiscal"),
+)
+
+
+def referencias_mercadoria(mercadoria_id):
+    """Descrições dos registros que ainda usam a mercadoria, numa única consulta."""
+    existe = db.session.execute(db.select(*(
+        db.exists().where(modelo.mercadoria_id == mercadoria_id) for modelo, _ in REFERENCIAS_MERCADORIA
+    ))).one()
+    return list(dict.fromkeys(nome for (_, nome), usado in zip(REFERENCIAS_MERCADORIA, existe) if usado))
 
 
 @app.route("/excluir/<int:id>")
@@ -497,75 +2791,296 @@ def excluir(id):
         flash("Mercadoria não encontrada.", "error")
         return redirect(url_for("index"))
 
+    usos = referencias_mercadoria(mercadoria.id)
+    if usos:
+        flash(
+            f"Não é possível excluir a mercadoria '{mercadoria.codigo}': ela é usada em {', '.join(usos)}.",
+            "error",
+        )
+        return redirect(url_for("index"))
+
     try:
-        # Registrar o log antes de excluir a mercadoria
+        # O log não referencia a mercadoria: ela deixa de existir nesta mesma transação
         registrar_log(
             acao="Exclusão",
             descricao=f"Mercadoria '{mercadoria.codigo}' excluída.",
-            mercadoria_id=mercadoria.id
         )
 
         # Agora exclui a mercadoria
         db.session.delete(mercadoria)
         db.session.commit()
         flash("Mercadoria excluída com sucesso!", "success")
+    except IntegrityError:
+        db.session.rollback()
+        flash(
+            f"Não é possível excluir a mercadoria '{mercadoria.codigo}': ainda há registros ligados a ela.",
+            "error",
+        )
     except Exception as e:
         db.session.rollback()
         flash(f"Erro ao excluir mercadoria: {str(e)}", "error")
     
     return redirect(url_for("index"))
 
+@app.route("/mercadorias/by-codigo/<path:codigo>")
+@login_required
+@leitura
+def buscar_por_codigo(codigo):
+    """Busca exata por código (leitor de código de barras)."""
+    _, mercadoria = indice_codigo.buscar(codigo.strip())
+    if mercadoria is None:
+        return jsonify({"erro": "Mercadoria não encontrada."}), 404
+    return jsonify(mercadoria)
+
+
+@app.route("/sync")
+@login_required
+@leitura
+def sincronizar():
+    """Alterações desde a versão `since` (tombstones incluídos) para manter cópias locais."""
+    desde = request.args.get("since", 0, type=int)
+    atual = versoes_tabelas("sync")["sync"]
+
+    def faixa(coluna):
+        return coluna > desde, coluna <= atual
+
+    def linhas(modelo, *colunas):
+        return [
+            dict(linha._mapping)
+            for linha in db.session.execute(db.select(*colunas).where(*faixa(modelo.versao_sync)))
+        ]
+
+    excluidos = {tabela: [] for tabela in TABELAS_VERSIONADAS}
+    for tabela, registro_id in db.session.execute(
+        db.select(ExclusaoSync.tabela, ExclusaoSync.registro_id).where(*faixa(ExclusaoSync.seq))
+    ):
+        excluidos[tabela].append(registro_id)
+
+    return jsonify({
+        "versao": atual,
+        "mercadorias": linhas(
+            Mercadoria, Mercadoria.id, Mercadoria.codigo, Mercadoria.nome, Mercadoria.grupo_id,
+            Mercadoria.quantidade, Mercadoria.descricao, Mercadoria.preco,
+        ),
+        "fornecedores": linhas(
+            Fornecedor, Fornecedor.id, Fornecedor.cnpj, Fornecedor.nome, Fornecedor.endereco,
+            Fornecedor.telefone, Fornecedor.email,
+        ),
+        "grupos": linhas(Grupo, Grupo.id, Grupo.nome, Grupo.descricao),
+        "excluidos": excluidos,
+    })
+
+
+def consulta_busca_mercadorias(termo):
+    """
+    Mercadorias com `termo` no nome ou no código. No PostgreSQL o ILIKE usa os
+    índices de trigramas (migração 20); termos com menos de 3 letras varrem a tabela.
+    """
+    padrao = f"%{termo}%"
+    return (
+        db.select(
+            Mercadoria.id, Mercadoria.codigo, Grupo.nome.label("grupo"), Mercadoria.quantidade,
+            Mercadoria.descricao, Mercadoria.preco,
+        )
+        .join(Grupo, Mercadoria.grupo_id == Grupo.id)
+        .where(db.or_(Mercadoria.nome.ilike(padrao), Mercadoria.codigo.ilike(padrao)))
+    )
+
+
 @app.route("/buscar_ajax", methods=["GET"])
 @login_required
+@leitura
 def buscar_ajax():
     query = request.args.get("query", "").strip().lower()
-    resultados = Mercadoria.query.filter(
-        (Mercadoria.nome.ilike(f"%{query}%")) | (Mercadoria.codigo.ilike(f"%{query}%"))
-    ).all()
-    mercadorias = [
-        {
-            "id": mercadoria.id,
-            "codigo": mercadoria.codigo,
-            "grupo": mercadoria.grupo,
-            "quantidade": mercadoria.quantidade,
-            "descricao": mercadoria.descricao,
-            "preco": mercadoria.preco,
-        }
-        for mercadoria in resultados
-    ]
+    mercadorias = [dict(linha._mapping) for linha in db.session.execute(consulta_busca_mercadorias(query))]
     return jsonify(mercadorias)
 
+# ========== AUDITORIA (LOG DE MOVIMENTAÇÕES) ==========
+# A listagem é paginada e a exportação lê o log com cursor no servidor
+# (stream_results), em lotes de EXPORT_LOTE linhas, então o tamanho do período
+# não muda o uso de memória do worker.
+
+LOGS_POR_PAGINA = 200
+EXPORT_LOTE = 2000
+CABECALHO_EXPORT_LOG = [
+    "ID", "Data e Hora", "Usuário", "Ação", "Mercadoria", "Fornecedor", "Local", "Quantidade", "Descrição",
+]
+
+
+def _filtros_log():
+    """Lê os filtros da query string; retorna (valores para o formulário, condições SQL)."""
+    filtros = {
+        "inicio": request.args.get("inicio", "").strip(),
+        "fim": request.args.get("fim", "").strip(),
+        "usuario_id": request.args.get("usuario_id", type=int),
+        "acao": request.args.get("acao", "").strip(),
+        "codigo": request.args.get("codigo", "").strip(),
+    }
+    inicio = fim = None
+    try:
+        if filtros["inicio"]:
+            inicio = datetime.strptime(filtros["inicio"], "%Y-%m-%d")
+        if filtros["fim"]:
+            # Data final inclusiva
+            fim = datetime.strptime(filtros["fim"], "%Y-%m-%d") + timedelta(days=1)
+    except ValueError:
+        flash("Data inválida; use o formato AAAA-MM-DD.", "error")
+    mercadoria_id = None
+    if filtros["codigo"]:
+        # Resolve o código antes (índice lower(codigo)) para filtrar pelo índice do log
+        mercadoria_id = db.session.execute(consulta_codigo_existente(filtros["codigo"])).scalar() or 0
+    return filtros, condicoes_log(inicio, fim, filtros["usuario_id"], filtros["acao"], mercadoria_id)
+
+
+def condicoes_log(inicio=None, fim=None, usuario_id=None, acao=None, mercadoria_id=None):
+    """Condições do filtro de logs; `mercadoria_id=0` é um código que não existe."""
+    condicoes = []
+    if inicio:
+        condicoes.append(LogMovimentacao.data_hora >= inicio)
+    if fim:
+        condicoes.append(LogMovimentacao.data_hora < fim)
+    if usuario_id:
+        condicoes.append(LogMovimentacao.usuario_id == usuario_id)
+    if acao:
+        condicoes.append(LogMovimentacao.acao == acao)
+    if mercadoria_id is not None:
+        condicoes.append(LogMovimentacao.mercadoria_id == mercadoria_id if mercadoria_id else db.false())
+    return condicoes
+
+
+def consulta_logs(condicoes, pagina=1):
+    """Página de logs filtrados, mais recentes primeiro, com uma linha a mais."""
+    return (
+        db.select(LogMovimentacao)
+        .where(*condicoes)
+        .order_by(LogMovimentacao.data_hora.desc(), LogMovimentacao.id.desc())
+        .offset((pagina - 1) * LOGS_POR_PAGINA)
+        .limit(LOGS_POR_PAGINA + 1)
+    )
+
+
+def _lotes_log(consulta):
+    """Executa a consulta com cursor no servidor e devolve as linhas em lotes."""
+    resultado = db.session.execute(
+        consulta, execution_options={"stream_results": True, "yield_per": EXPORT_LOTE}
+    )
+    try:
+        yield from resultado.partitions()
+    finally:
+        resultado.close()
+
+
+def _linha_export_log(linha):
+    id_, data_hora, usuario, acao, codigo, fornecedor, local, quantidade, descricao = linha
+    return [
+        id_, data_hora.strftime("%d/%m/%Y %H:%M:%S") if data_hora else "", usuario or "", acao,
+        codigo or "", fornecedor or "", local or "", quantidade if quantidade is not None else "", descricao,
+    ]
+
+
 @app.route("/informacoes")
 @login_required
+@leitura
 def informacoes():
-    logs = LogMovimentacao.query.order_by(LogMovimentacao.data_hora.desc()).all()
-    return render_template("informacoes.html", logs=logs)
+    filtros, condicoes = _filtros_log()
+    pagina = max(request.args.get("pagina", 1, type=int), 1)
+    logs = db.session.execute(consulta_logs(condicoes, pagina)).scalars().all()
+    usuarios = db.session.execute(db.select(Usuario.id, Usuario.username).order_by(Usuario.username)).all()
+    return render_template(
+        "informacoes.html",
+        logs=logs[:LOGS_POR_PAGINA],
+        tem_proxima=len(logs) > LOGS_POR_PAGINA,
+        pagina=pagina,
+        filtros=filtros,
+        filtros_args={k: v for k, v in filtros.items() if v},
+        usuarios=usuarios,
+    )
+
+
+@app.route("/informacoes/export")
+@login_required
+@leitura
+def informacoes_export():
+    """Exporta o log filtrado em CSV (streaming) ou XLSX (write-only), lendo em lotes."""
+    _, condicoes = _filtros_log()
+    consulta = (
+        db.select(
+            LogMovimentacao.id, LogMovimentacao.data_hora, Usuario.username, LogMovimentacao.acao,
+            Mercadoria.codigo, Fornecedor.nome, LocalEstoque.nome, LogMovimentacao.quantidade,
+            LogMovimentacao.descricao,
+        )
+        .outerjoin(Usuario, LogMovimentacao.usuario_id == Usuario.id)
+        .outerjoin(Mercadoria, LogMovimentacao.mercadoria_id == Mercadoria.id)
+        .outerjoin(Fornecedor, LogMovimentacao.fornecedor_id == Fornecedor.id)
+        .outerjoin(LocalEstoque, LogMovimentacao.local_id == LocalEstoque.id)
+        .where(*condicoes)
+        .order_by(LogMovimentacao.data_hora, LogMovimentacao.id)
+    )
+    nome = f"log_movimentacao_{datetime.now():%Y%m%d_%H%M%S}"
+
+    if request.args.get("formato") == "xlsx":
+        if Workbook is None:
+            flash("Dependência openpyxl não instalada no servidor.", "error")
+            return redirect(url_for("informacoes", **request.args))
+        # O zip do XLSX só pode ser gerado no fim: as linhas vão para um arquivo
+        # temporário em disco e nunca ficam todas em memória
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet("Log")
+        ws.append(CABECALHO_EXPORT_LOG)
+        for lote in _lotes_log(consulta):
+            for linha in lote:
+                ws.append(_linha_export_log(linha))
+        arquivo = tempfile.TemporaryFile(dir=app.config['UPLOAD_FOLDER'])
+        wb.save(arquivo)
+        arquivo.seek(0)
+        return send_file(
+            arquivo, download_name=f"{nome}.xlsx", as_attachment=True,
+            mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        )
+
+    def gerar():
+        buffer = io.StringIO()
+        escritor = csv.writer(buffer, delimiter=";")
+        buffer.write("\ufeff")  # BOM para o Excel reconhecer UTF-8
+        escritor.writerow(CABECALHO_EXPORT_LOG)
+        for lote in _lotes_log(consulta):
+            escritor.writerows(_linha_export_log(linha) for linha in lote)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+
+    return Response(
+        stream_with_context(gerar()),
+        mimetype="text/csv",
+        headers={"Content-Disposition": f"attachment; filename={nome}.csv"},
+    )
 
 
 @app.route('/relatorios')
 @login_required
+@leitura
 def relatorios():
-    # filtro por grupo opcional
-    selected_grupo = request.args.get('grupo') or None
-    query = Mercadoria.query
-    if selected_grupo:
-        query = query.filter_by(grupo=selected_grupo)
-    mercadorias = query.order_by(Mercadoria.nome).all()
-    grupos = [g.nome for g in Grupo.query.order_by(Grupo.nome).all()]
-    return render_template('relatorios.html', mercadorias=mercadorias, grupos=grupos, selected_grupo=selected_grupo)
+    selected_grupo, selected_local, linhas = _mercadorias_do_relatorio()
+    grupos = Grupo.query.order_by(Grupo.nome).all()
+    locais = LocalEstoque.query.order_by(LocalEstoque.nome).all()
+    avaliacao = _avaliacao_por_id()
+    return render_template(
+        'relatorios.html', linhas=linhas, grupos=grupos, locais=locais,
+        selected_grupo=selected_grupo, selected_local=selected_local, avaliacao=avaliacao,
+    )
 
 
 @app.route('/relatorios/export_excel')
 @login_required
+@leitura
 def relatorios_export_excel():
     if pd is None:
         flash('Dependência pandas não instalada no servidor.', 'error')
         return redirect(url_for('relatorios'))
-    selected_grupo = request.args.get('grupo') or None
-    query = Mercadoria.query
-    if selected_grupo:
-        query = query.filter_by(grupo=selected_grupo)
-    mercadorias = query.order_by(Mercadoria.nome).all()
+    selected_grupo, selected_local, linhas = _mercadorias_do_relatorio()
+    avaliacao = _avaliacao_por_id()
+    vazio = {}
     data = [
         {
             'ID': m.id,
@@ -575,33 +3090,41 @@ def relatorios_export_excel():
             'Quantidade': m.quantidade,
             'Descrição': m.descricao,
             'Preço': m.preco,
+            'Custo médio': avaliacao.get(m.id, vazio).get('custo_medio'),
+            'Valor (custo médio)': valor_custo_medio(m.quantidade, avaliacao.get(m.id)),
+            # As camadas FIFO são do estoque total, não de um local
+            'Valor (FIFO)': None if selected_local else avaliacao.get(m.id, vazio).get('valor_fifo'),
         }
-        for m in mercadorias
+        for m in linhas
     ]
     df = pd.DataFrame(data)
     output = io.BytesIO()
     df.to_excel(output, index=False, engine='openpyxl')
     output.seek(0)
-    filename = f"relatorio_estoque_{selected_grupo or 'todos'}.xlsx"
+    filename = f"relatorio_estoque_{_nome_relatorio(selected_grupo, selected_local)}.xlsx"
     return send_file(output, download_name=filename, as_attachment=True, mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
 
 
 @app.route('/relatorios/export_pdf')
 @login_required
+@leitura
 def relatorios_export_pdf():
-    selected_grupo = request.args.get('grupo') or None
-    query = Mercadoria.query
-    if selected_grupo:
-        query = query.filter_by(grupo=selected_grupo)
-    mercadorias = query.order_by(Mercadoria.nome).all()
+    selected_grupo, selected_local, linhas = _mercadorias_do_relatorio()
+    avaliacao = _avaliacao_por_id()
 
     # Gerar PDF simples com ReportLab
     try:
         buffer = io.BytesIO()
         doc = SimpleDocTemplate(buffer, pagesize=landscape(letter))
-        data = [["ID", "Código", "Nome", "Grupo", "Quantidade", "Descrição", "Preço"]]
-        for m in mercadorias:
-            data.append([m.id, m.codigo, m.nome, m.grupo, m.quantidade, m.descricao or '', f"R$ {m.preco}"])
+        data = [["ID", "Código", "Nome", "Grupo", "Quantidade", "Descrição", "Preço", "Valor (médio)", "Valor (FIFO)"]]
+        for m in linhas:
+            a = avaliacao.get(m.id, {})
+            medio = valor_custo_medio(m.quantidade, a)
+            data.append([
+                m.id, m.codigo, m.nome, m.grupo, m.quantidade, m.descricao or '', f"R$ {m.preco}",
+                f"R$ {medio:.2f}" if medio is not None else '',
+                f"R$ {a['valor_fifo']:.2f}" if a and not selected_local else '',
+            ])
 
         table = Table(data, repeatRows=1)
         style = TableStyle([
@@ -614,14 +3137,248 @@ def relatorios_export_pdf():
         elements = [table]
         doc.build(elements)
         buffer.seek(0)
-        filename = f"relatorio_estoque_{selected_grupo or 'todos'}.pdf"
+        filename = f"relatorio_estoque_{_nome_relatorio(selected_grupo, selected_local)}.pdf"
         return send_file(buffer, download_name=filename, as_attachment=True, mimetype='application/pdf')
     except Exception as e:
         flash(f'Erro ao gerar PDF: {e}', 'error')
         return redirect(url_for('relatorios'))
 
+# ========== PREVISÃO DE CONSUMO E PONTO DE REPOSIÇÃO ==========
+# Calculado de uma vez para todos os produtos com pandas/NumPy a partir das
+# saídas registradas no log. O resultado fica em cache até chegar uma nova
+# movimentação (qualquer novo registro de log muda a versão).
+
+Z_NIVEL_SERVICO = 1.65  # ~95% de nível de serviço para o estoque de segurança
+_cache_reposicao = {}
+
+
+def calcular_reposicao(janela_dias=90, prazo_dias=7, cobertura_dias=30):
+    """
+    Retorna um DataFrame (um produto por linha) com consumo diário médio, dias de
+    cobertura, ponto de reposição e quantidade sugerida de compra.
+    """
+    versao = db.session.query(db.func.max(LogMovimentacao.id)).scalar() or 0
+    chave = (versao, date.today(), janela_dias, prazo_dias, cobertura_dias)
+    if chave in _cache_reposicao:
+        return _cache_reposicao[chave]
+
+    dia = db.func.date(LogMovimentacao.data_hora)
+    saidas = pd.DataFrame(
+        db.session.execute(
+            db.select(LogMovimentacao.mercadoria_id, dia, db.func.sum(LogMovimentacao.quantidade))
+            .where(
+                LogMovimentacao.acao == "Saída",
+                LogMovimentacao.mercadoria_id.isnot(None),
+                LogMovimentacao.data_hora >= datetime.utcnow() - timedelta(days=janela_dias),
+            )
+            .group_by(LogMovimentacao.mercadoria_id, dia)
+        ).all(),
+        columns=["id", "dia", "qtd"],
+    )
+    estoque = pd.DataFrame(
+        db.session.execute(
+            db.select(Mercadoria.id, Mercadoria.codigo, Mercadoria.nome, Mercadoria.quantidade)
+        ).all(),
+        columns=["id", "codigo", "nome", "quantidade"],
+    ).set_index("id")
+
+    # Soma e soma dos quadrados do consumo diário; dias sem saída contam como zero
+    saidas["qtd"] = saidas["qtd"].fillna(0).astype(float)
+    saidas["qtd2"] = saidas["qtd"] ** 2
+    por_item = saidas.groupby("id")[["qtd", "qtd2"]].sum()
+    df = estoque.join(por_item, how="left").fillna({"qtd": 0.0, "qtd2": 0.0})
+
+    estoque_atual = df["quantidade"].fillna(0).to_numpy(dtype=float)
+    taxa = df["qtd"].to_numpy() / janela_dias
+    desvio = np.sqrt(np.maximum(df["qtd2"].to_numpy() / janela_dias - taxa ** 2, 0.0))
+    seguranca = Z_NIVEL_SERVICO * desvio * np.sqrt(prazo_dias)
+    ponto = taxa * prazo_dias + seguranca
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cobertura = np.where(taxa > 0, estoque_atual / taxa, np.inf)
+    sugerido = np.ceil(np.maximum(ponto + taxa * cobertura_dias - estoque_atual, 0.0))
+
+    resultado = pd.DataFrame({
+        "codigo": df["codigo"],
+        "nome": df["nome"],
+        "quantidade": estoque_atual.astype(int),
+        "consumo_diario": taxa.round(2),
+        "dias_cobertura": np.round(cobertura, 1),
+        "ponto_reposicao": np.ceil(ponto).astype(int),
+        "sugerido": sugerido.astype(int),
+        "repor": (taxa > 0) & (estoque_atual <= ponto),
+    }, index=df.index).sort_values(["dias_cobertura", "nome"])
+
+    _cache_reposicao.clear()
+    _cache_reposicao[chave] = resultado
+    return resultado
+
+
+def _parametros_reposicao():
+    janela = max(request.args.get("janela", 90, type=int), 1)
+    prazo = max(request.args.get("prazo", 7, type=int), 0)
+    cobertura = max(request.args.get("cobertura", 30, type=int), 0)
+    return janela, prazo, cobertura
+
+
+@app.route('/relatorios/reposicao')
+@login_required
+@leitura
+def relatorio_reposicao():
+    if pd is None:
+        flash('Dependência pandas não instalada no servidor.', 'error')
+        return redirect(url_for('relatorios'))
+    janela, prazo, cobertura = _parametros_reposicao()
+    todos = request.args.get('todos') == '1'
+    df = calcular_reposicao(janela, prazo, cobertura)
+    linhas = df if todos else df[df["repor"]]
+    return render_template(
+        'reposicao.html',
+        itens=linhas.reset_index().replace({np.inf: None}).to_dict('records'),
+        janela=janela, prazo=prazo, cobertura=cobertura, todos=todos,
+    )
+
+
+@app.route('/relatorios/reposicao/export_excel')
+@login_required
+@leitura
+def relatorio_reposicao_export_excel():
+    if pd is None:
+        flash('Dependência pandas não instalada no servidor.', 'error')
+        return redirect(url_for('relatorios'))
+    # Produtos sem consumo têm cobertura infinita: exporta a célula vazia
+    df = calcular_reposicao(*_parametros_reposicao()).reset_index().replace({np.inf: None}).rename(columns={
+        'id': 'ID',
+        'codigo': 'Código',
+        'nome': 'Nome',
+        'quantidade': 'Quantidade',
+        'consumo_diario': 'Consumo diário',
+        'dias_cobertura': 'Dias de cobertura',
+        'ponto_reposicao': 'Ponto de reposição',
+        'sugerido': 'Compra sugerida',
+        'repor': 'Repor',
+    })
+    output = io.BytesIO()
+    df.to_excel(output, index=False, engine='openpyxl')
+    output.seek(0)
+    return send_file(output, download_name="relatorio_reposicao.xlsx", as_attachment=True, mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+
+
+# ========== AVALIAÇÃO DE ESTOQUE (CUSTO MÉDIO / FIFO) ==========
+# Custos calculados a partir dos itens de NF vinculados a mercadorias e das
+# saídas registradas no log. O primeiro cálculo é feito em lote (vetorizado);
+# depois só as mercadorias com itens ou saídas novas são recalculadas.
+# Edições/exclusões de itens e notas (em qualquer instância) sobem a versão
+# dessas tabelas em `versao_tabela`; o snapshot guarda a versão com que foi
+# calculado e é refeito inteiro quando ela muda.
+
+TABELAS_AVALIACAO = ("item_nota_fiscal", "nota_fiscal")
+
+_avaliacao = {"custos": None, "versao": None, "ultimo_item": 0, "ultimo_log": 0}
+_avaliacao_lock = threading.Lock()
+
+
+@event.listens_for(db.session, "after_flush")
+def _marcar_avaliacao(sess, flush_context):
+    for obj in (*sess.dirty, *sess.deleted):
+        tabela = getattr(obj, "__tablename__", None)
+        if tabela in TABELAS_AVALIACAO and (obj in sess.deleted or sess.is_modified(obj)):
+            marcar_sincronizacao(tabela, [], sess)
+
+
+def _custos_por_mercadoria(ids=None):
+    """Custo médio ponderado e camadas FIFO restantes por mercadoria (todas ou `ids`)."""
+    entradas_q = (
+        db.select(
+            ItemNotaFiscal.mercadoria_id, NotaFiscal.data_entrega, ItemNotaFiscal.id,
+            ItemNotaFiscal.quantidade, ItemNotaFiscal.preco_unitario,
+        )
+        .join(NotaFiscal, ItemNotaFiscal.nota_fiscal_id == NotaFiscal.id)
+        .where(ItemNotaFiscal.mercadoria_id.isnot(None))
+    )
+    saidas_q = (
+        db.select(LogMovimentacao.mercadoria_id, db.func.sum(LogMovimentacao.quantidade))
+        .where(LogMovimentacao.acao == "Saída", LogMovimentacao.mercadoria_id.isnot(None))
+        .group_by(LogMovimentacao.mercadoria_id)
+    )
+    if ids is not None:
+        entradas_q = entradas_q.where(ItemNotaFiscal.mercadoria_id.in_(ids))
+        saidas_q = saidas_q.where(LogMovimentacao.mercadoria_id.in_(ids))
+
+    colunas = ["qtd_comprada", "custo_medio", "qtd_fifo", "valor_fifo", "cmv_fifo"]
+    entradas = pd.DataFrame(
+        db.session.execute(entradas_q).all(),
+        columns=["mercadoria_id", "data", "item_id", "qtd", "preco"],
+    )
+    if entradas.empty:
+        return pd.DataFrame(columns=colunas, index=pd.Index([], name="mercadoria_id"))
+    saidas = pd.Series(dict(db.session.execute(saidas_q).all()), dtype=float)
+
+    entradas = entradas.sort_values(["mercadoria_id", "data", "item_id"])
+    qtd = entradas["qtd"].to_numpy(dtype=float)
+    preco = entradas["preco"].to_numpy(dtype=float)
+    # Saídas consomem as camadas mais antigas primeiro
+    fim = entradas.groupby("mercadoria_id")["qtd"].cumsum().to_numpy(dtype=float)
+    saido = saidas.reindex(entradas["mercadoria_id"]).fillna(0).to_numpy(dtype=float)
+    consumido = np.clip(saido - (fim - qtd), 0, qtd)
+    restante = qtd - consumido
+
+    por_item = pd.DataFrame({
+        "mercadoria_id": entradas["mercadoria_id"].to_numpy(),
+        "qtd_comprada": qtd,
+        "valor_compra": qtd * preco,
+        "qtd_fifo": restante,
+        "valor_fifo": restante * preco,
+        "cmv_fifo": consumido * preco,
+    }).groupby("mercadoria_id").sum()
+    por_item["custo_medio"] = por_item["valor_compra"] / por_item["qtd_comprada"].where(por_item["qtd_comprada"] > 0)
+    return por_item[colunas]
+
+
+def avaliar_estoque():
+    """Retorna o snapshot de custos por mercadoria, atualizando-o incrementalmente."""
+    ultimo_item = db.session.query(db.func.max(ItemNotaFiscal.id)).scalar() or 0
+    ultimo_log = db.session.query(db.func.max(LogMovimentacao.id)).scalar() or 0
+    # Lida antes dos dados: um commit no meio só faz o próximo cálculo ser completo
+    versao = sum(versoes_tabelas(*TABELAS_AVALIACAO).values())
+    with _avaliacao_lock:
+        custos = _avaliacao["custos"]
+        if custos is None or versao != _avaliacao["versao"]:
+            custos = _custos_por_mercadoria()
+        elif ultimo_item != _avaliacao["ultimo_item"] or ultimo_log != _avaliacao["ultimo_log"]:
+            novos_itens = db.select(ItemNotaFiscal.mercadoria_id).where(
+                ItemNotaFiscal.id > _avaliacao["ultimo_item"], ItemNotaFiscal.mercadoria_id.isnot(None)
+            )
+            novas_saidas = db.select(LogMovimentacao.mercadoria_id).where(
+                LogMovimentacao.id > _avaliacao["ultimo_log"],
+                LogMovimentacao.acao == "Saída",
+                LogMovimentacao.mercadoria_id.isnot(None),
+            )
+            afetadas = list(db.session.execute(novos_itens.union(novas_saidas)).scalars())
+            if afetadas:
+                parcial = _custos_por_mercadoria(afetadas)
+                custos = pd.concat([custos.drop(afetadas, errors="ignore"), parcial])
+        _avaliacao.update(custos=custos, versao=versao, ultimo_item=ultimo_item, ultimo_log=ultimo_log)
+        return custos
+
+
+def _avaliacao_por_id():
+    """Snapshot como dict {mercadoria_id: {...}} para templates e exportações."""
+    if pd is None:
+        return {}
+    custos = avaliar_estoque().astype(float).round(2)
+    return custos.astype(object).where(custos.notna(), None).to_dict("index")
+
+
+def valor_custo_medio(quantidade, custos):
+    """Quantidade em estoque valorizada pelo custo médio das compras."""
+    if not custos or custos.get("custo_medio") is None:
+        return None
+    return round((quantidade or 0) * custos["custo_medio"], 2)
+
+
 @app.route("/fornecedores", methods=["GET", "POST"])
 @login_required
+@leitura
 def gerenciar_fornecedores():
     fornecedor_id = request.args.get('fornecedor_id')
     fornecedor = Fornecedor.query.get(fornecedor_id) if fornecedor_id else None
@@ -647,12 +3404,12 @@ def gerenciar_fornecedores():
             fornecedor.endereco = endereco
             fornecedor.telefone = telefone
             fornecedor.email = email
-            db.session.commit()
             registrar_log(
                 "Edição Fornecedor",
                 f"Fornecedor '{fornecedor.nome}' editado.",
                 fornecedor_id=fornecedor.id,
             )
+            db.session.commit()
             flash('Fornecedor editado com sucesso!', 'success')
         else:  # Novo fornecedor
             fornecedor_existente = Fornecedor.query.filter_by(cnpj=cnpj).first()
@@ -668,18 +3425,22 @@ def gerenciar_fornecedores():
                 email=email
             )
             db.session.add(novo_fornecedor)
-            db.session.commit()
+            db.session.flush()
             registrar_log(
                 "Inserção Fornecedor",
                 f"Fornecedor '{novo_fornecedor.nome}' adicionado.",
                 fornecedor_id=novo_fornecedor.id,
             )
+            db.session.commit()
             flash('Fornecedor adicionado com sucesso!', 'success')
 
         return redirect(url_for('gerenciar_fornecedores'))
 
-    fornecedores = Fornecedor.query.all()
-    return render_template('fornecedor.html', fornecedores=fornecedores, fornecedor=fornecedor)
+    return render_template('fornecedor.html', fornecedores=linhas_fornecedores(), fornecedor=fornecedor)
+
+def consulta_notas_do_fornecedor(fornecedor_id):
+    return db.select(NotaFiscal.id).where(NotaFiscal.fornecedor_id == fornecedor_id).limit(1)
+
 
 @app.route('/excluir_fornecedor/<int:id>')
 @login_required
@@ -691,16 +3452,15 @@ def excluir_fornecedor(id):
         return redirect(url_for('gerenciar_fornecedores'))
 
     # Verificar se existem notas fiscais associadas
-    notas_associadas = NotaFiscal.query.filter_by(fornecedor_id=fornecedor.id).all()
-    if notas_associadas:
+    if db.session.execute(consulta_notas_do_fornecedor(fornecedor.id)).first():
         flash("Não é possível excluir o fornecedor, pois existem notas fiscais associadas.", "error")
         return redirect(url_for('gerenciar_fornecedores'))
 
     try:
+        # Sem fornecedor_id: o fornecedor deixa de existir nesta mesma transação
         registrar_log(
             acao="Exclusão Fornecedor",
             descricao=f"Fornecedor '{fornecedor.nome}' excluído.",
-            fornecedor_id=fornecedor.id
         )
 
         # Agora exclui o fornecedor
@@ -755,12 +3515,127 @@ def criar_nota_fiscal(fornecedor_id):
 
     return render_template("nova_nf.html", fornecedor=fornecedor)
 
+NFS_POR_PAGINA = 100
+
+
+def consulta_pagina_nfs(fornecedor_id, pagina=1):
+    """Página de notas do fornecedor com a contagem e o total dos itens de cada uma."""
+    # A página de notas sai do índice (fornecedor, emissão); só os itens dela são somados
+    notas = (
+        db.select(NotaFiscal.id, NotaFiscal.numero_nf, NotaFiscal.data_emissao, NotaFiscal.data_entrega)
+        .where(NotaFiscal.fornecedor_id == fornecedor_id)
+        .order_by(NotaFiscal.data_emissao.desc(), NotaFiscal.id.desc())
+        .offset((pagina - 1) * NFS_POR_PAGINA)
+        .limit(NFS_POR_PAGINA + 1)
+        .subquery()
+    )
+    return (
+        db.select(
+            notas,
+            db.func.count(ItemNotaFiscal.id).label("itens"),
+            db.func.coalesce(db.func.sum(ItemNotaFiscal.quantidade * ItemNotaFiscal.preco_unitario), 0).label("total"),
+        )
+        .outerjoin(ItemNotaFiscal, ItemNotaFiscal.nota_fiscal_id == notas.c.id)
+        .group_by(notas.c.id, notas.c.numero_nf, notas.c.data_emissao, notas.c.data_entrega)
+        .order_by(notas.c.data_emissao.desc(), notas.c.id.desc())
+    )
+
+
 @app.route("/fornecedores/<int:fornecedor_id>/nfs")
 @login_required
+@leitura
 def listar_notas_fiscais(fornecedor_id):
     fornecedor = Fornecedor.query.get_or_404(fornecedor_id)
-    notas_fiscais = NotaFiscal.query.filter_by(fornecedor_id=fornecedor.id).all()
-    return render_template("listar_nfs.html", fornecedor=fornecedor, notas_fiscais=notas_fiscais)
+    pagina = max(request.args.get("pagina", 1, type=int), 1)
+    notas_fiscais = db.session.execute(consulta_pagina_nfs(fornecedor.id, pagina)).all()
+    return render_template(
+        "listar_nfs.html",
+        fornecedor=fornecedor,
+        notas_fiscais=notas_fiscais[:NFS_POR_PAGINA],
+        tem_proxima=len(notas_fiscais) > NFS_POR_PAGINA,
+        pagina=pagina,
+        resumo=_resumo_gastos(fornecedor.id),
+    )
+
+
+def _resumo_gastos(fornecedor_id):
+    """Totais do fornecedor lidos do agregado `gasto_fornecedor`."""
+    return db.session.execute(
+        db.select(
+            db.func.coalesce(db.func.sum(GastoFornecedor.itens), 0).label("itens"),
+            db.func.coalesce(db.func.sum(GastoFornecedor.valor), 0).label("valor"),
+        ).where(GastoFornecedor.fornecedor_id == fornecedor_id)
+    ).one()
+
+
+def _condicoes_gasto(fornecedor_id, ano=None):
+    condicoes = [GastoFornecedor.fornecedor_id == fornecedor_id]
+    if ano:
+        condicoes += [GastoFornecedor.mes >= date(ano, 1, 1), GastoFornecedor.mes < date(ano + 1, 1, 1)]
+    return condicoes
+
+
+def consulta_gastos_por_mes(fornecedor_id, ano=None):
+    return (
+        db.select(
+            GastoFornecedor.mes,
+            db.func.sum(GastoFornecedor.itens),
+            db.func.sum(GastoFornecedor.quantidade),
+            db.func.sum(GastoFornecedor.valor),
+        )
+        .where(*_condicoes_gasto(fornecedor_id, ano))
+        .group_by(GastoFornecedor.mes)
+        .order_by(GastoFornecedor.mes.desc())
+    )
+
+
+def consulta_gastos_por_grupo(fornecedor_id, ano=None):
+    return (
+        db.select(
+            Grupo.nome,
+            db.func.sum(GastoFornecedor.itens),
+            db.func.sum(GastoFornecedor.quantidade),
+            db.func.sum(GastoFornecedor.valor).label("valor"),
+        )
+        .outerjoin(Grupo, GastoFornecedor.grupo_id == Grupo.id)
+        .where(*_condicoes_gasto(fornecedor_id, ano))
+        .group_by(Grupo.nome)
+        .order_by(db.desc("valor"))
+    )
+
+
+@app.route("/fornecedores/<int:fornecedor_id>/gastos")
+@login_required
+@leitura
+def gastos_fornecedor(fornecedor_id):
+    """Gasto do fornecedor por mês e por grupo, a partir do agregado mantido item a item."""
+    fornecedor = Fornecedor.query.get_or_404(fornecedor_id)
+    ano = request.args.get("ano", type=int)
+    por_mes = db.session.execute(consulta_gastos_por_mes(fornecedor.id, ano)).all()
+    por_grupo = db.session.execute(consulta_gastos_por_grupo(fornecedor.id, ano)).all()
+    anos = db.session.execute(
+        db.select(GastoFornecedor.mes).where(GastoFornecedor.fornecedor_id == fornecedor.id).distinct()
+    ).scalars()
+    return render_template(
+        "gastos_fornecedor.html",
+        fornecedor=fornecedor,
+        por_mes=por_mes,
+        por_grupo=por_grupo,
+        total=sum(linha[3] for linha in por_mes),
+        ano=ano,
+        anos=sorted({mes.year for mes in anos}, reverse=True),
+    )
+
+def consulta_itens_nf(nf_id):
+    return db.select(ItemNotaFiscal).where(ItemNotaFiscal.nota_fiscal_id == nf_id).order_by(ItemNotaFiscal.id)
+
+
+def consulta_totais_nf(nf_id):
+    return db.select(
+        db.func.count(ItemNotaFiscal.id).label("itens"),
+        db.func.coalesce(db.func.sum(ItemNotaFiscal.quantidade * ItemNotaFiscal.preco_unitario), 0).label("valor"),
+    ).where(ItemNotaFiscal.nota_fiscal_id == nf_id)
+
 
 @app.route("/nota_fiscal/<int:nf_id>", methods=["GET", "POST"])
 @login_required
@@ -771,24 +3646,44 @@ def detalhar_nota_fiscal(nf_id):
         descricao = request.form['descricao']
         quantidade = int(request.form['quantidade'])
         preco_unitario = float(request.form['preco_unitario'])
-        grupo = request.form['grupo']  # Novo campo do grupo
+        grupo = _grupo_do_formulario()
 
         novo_item = ItemNotaFiscal(
             descricao=descricao,
             quantidade=quantidade,
             preco_unitario=preco_unitario,
             grupo=grupo,  # Armazena o grupo selecionado
-            nota_fiscal_id=nota_fiscal.id
+            nota_fiscal_id=nota_fiscal.id,
+            mercadoria_id=request.form.get('mercadoria_id', type=int),
+            lote=request.form.get('lote', '').strip() or None,
         )
         try:
+            novo_item.validade = _data_do_formulario('validade')
             db.session.add(novo_item)
+            _aplicar_lote_item(novo_item)
+            conferir_lotes(novo_item.lote_estoque)
+            # Sem mercadoria escolhida, tenta a conciliação pelo índice de tokens
+            vinculado = novo_item.mercadoria_id is None and bool(conciliar_itens([novo_item]))
+            acumular_gasto(novo_item)
             db.session.commit()
-            flash('Item adicionado com sucesso!', 'success')
+            if vinculado:
+                flash(f'Item adicionado e vinculado a {novo_item.mercadoria.codigo}.', 'success')
+            else:
+                flash('Item adicionado com sucesso!', 'success')
         except Exception as e:
             db.session.rollback()
             flash(f"Erro ao adicionar item: {str(e)}", "error")
 
-    return render_template("detalhar_nf.html", nota_fiscal=nota_fiscal)
+    grupos = Grupo.query.order_by(Grupo.nome).all()
+    mercadorias = Mercadoria.query.order_by(Mercadoria.nome).all()
+    itens = db.session.execute(consulta_itens_nf(nota_fiscal.id)).scalars().all()
+    totais = db.session.execute(consulta_totais_nf(nota_fiscal.id)).one()
+    pendentes = [item for item in itens if item.mercadoria_id is None]
+    sugestoes = dict(zip((item.id for item in pendentes), sugerir_mercadorias([item.descricao for item in pendentes])))
+    return render_template(
+        "detalhar_nf.html", nota_fiscal=nota_fiscal, itens=itens, grupos=grupos, mercadorias=mercadorias,
+        totais=totais, sugestoes=sugestoes,
+    )
 
 @app.route("/nota_fiscal/<int:nf_id>/editar", methods=["GET", "POST"])
 @login_required
@@ -797,10 +3692,39 @@ def editar_nota_fiscal(nf_id):
 
     if request.method == "POST":
         # Lógica de edição da Nota Fiscal
-        nota_fiscal.numero_nf = request.form["numero_nf"]
-        nota_fiscal.data_emissao = request.form["data_emissao"]
-        nota_fiscal.data_entrega = request.form["data_entrega"]
-        db.session.commit()
+        numero_nf = request.form.get("numero_nf", "").strip()
+        try:
+            data_emissao = _data_do_formulario("data_emissao")
+            data_entrega = _data_do_formulario("data_entrega")
+        except ValueError:
+            data_emissao = data_entrega = None
+        if not numero_nf or not data_emissao or not data_entrega:
+            flash("Informe o número e datas válidas de emissão e de entrega.", "error")
+            return redirect(url_for("editar_nota_fiscal", nf_id=nota_fiscal.id))
+        if NotaFiscal.query.filter(NotaFiscal.numero_nf == numero_nf, NotaFiscal.id != nota_fiscal.id).first():
+            flash("Já existe uma Nota Fiscal com esse número!", "error")
+            return redirect(url_for("editar_nota_fiscal", nf_id=nota_fiscal.id))
+        try:
+            muda_mes = data_emissao.replace(day=1) != nota_fiscal.data_emissao.replace(day=1)
+            if muda_mes:
+                for item in nota_fiscal.itens:
+                    acumular_gasto(item, -1)
+            nota_fiscal.numero_nf = numero_nf
+            nota_fiscal.data_emissao = data_emissao
+            nota_fiscal.data_entrega = data_entrega
+            if muda_mes:
+                for item in nota_fiscal.itens:
+                    acumular_gasto(item)
+            db.session.commit()
+        except IntegrityError:
+            # Outra nota recebeu o mesmo número entre a verificação e o commit
+            db.session.rollback()
+            flash("Já existe uma Nota Fiscal com esse número!", "error")
+            return redirect(url_for("editar_nota_fiscal", nf_id=nota_fiscal.id))
+        except Exception as e:
+            db.session.rollback()
+            flash(f"Erro ao editar Nota Fiscal: {str(e)}", "error")
+            return redirect(url_for("editar_nota_fiscal", nf_id=nota_fiscal.id))
         flash("Nota Fiscal editada com sucesso!", "success")
         return redirect(url_for("listar_notas_fiscais", fornecedor_id=nota_fiscal.fornecedor_id))
 
@@ -811,6 +3735,10 @@ def editar_nota_fiscal(nf_id):
 def excluir_nota_fiscal(nf_id):
     nota_fiscal = NotaFiscal.query.get_or_404(nf_id)
     try:
+        for item in nota_fiscal.itens:
+            conferir_lotes(_estornar_lote_item(item))
+            acumular_gasto(item, -1)
+            db.session.delete(item)
         db.session.delete(nota_fiscal)
         db.session.commit()
         flash("Nota Fiscal excluída com sucesso!", "success")
@@ -827,11 +3755,19 @@ def editar_item_nf(nf_id, item_id):
     item = ItemNotaFiscal.query.get_or_404(item_id)
 
     if request.method == "POST":
-        item.descricao = request.form['descricao']
-        item.quantidade = int(request.form['quantidade'])
-        item.preco_unitario = float(request.form['preco_unitario'])
-
         try:
+            anterior = _estornar_lote_item(item)
+            acumular_gasto(item, -1)
+            item.descricao = request.form['descricao']
+            item.quantidade = int(request.form['quantidade'])
+            item.preco_unitario = float(request.form['preco_unitario'])
+            item.grupo = _grupo_do_formulario(item.grupo_id)
+            item.mercadoria_id = request.form.get('mercadoria_id', type=int)
+            item.lote = request.form.get('lote', '').strip() or None
+            item.validade = _data_do_formulario('validade')
+            _aplicar_lote_item(item)
+            conferir_lotes(anterior, item.lote_estoque)
+            acumular_gasto(item)
             db.session.commit()
             flash('Item da Nota Fiscal editado com sucesso!', 'success')
             return redirect(url_for('detalhar_nota_fiscal', nf_id=nota_fiscal.id))
@@ -840,13 +3776,17 @@ def editar_item_nf(nf_id, item_id):
             flash(f"Erro ao editar item: {str(e)}", "error")
             return redirect(url_for('editar_item_nf', nf_id=nota_fiscal.id, item_id=item.id))
 
-    return render_template("editar_item_nf.html", nota_fiscal=nota_fiscal, item=item)
+    grupos = Grupo.query.order_by(Grupo.nome).all()
+    mercadorias = Mercadoria.query.order_by(Mercadoria.nome).all()
+    return render_template("editar_item_nf.html", nota_fiscal=nota_fiscal, item=item, grupos=grupos, mercadorias=mercadorias)
 
 @app.route("/nota_fiscal/<int:nf_id>/item/<int:item_id>/excluir", methods=["POST"])
 @login_required
 def excluir_item_nf(nf_id, item_id):
     item = ItemNotaFiscal.query.get_or_404(item_id)
     try:
+        conferir_lotes(_estornar_lote_item(item))
+        acumular_gasto(item, -1)
         db.session.delete(item)
         db.session.commit()
         flash('Item da Nota Fiscal excluído com sucesso!', 'success')
@@ -855,9 +3795,41 @@ def excluir_item_nf(nf_id, item_id):
         flash(f"Erro ao excluir item: {str(e)}", "error")
     return redirect(url_for('detalhar_nota_fiscal', nf_id=nf_id))
 
+@app.route("/nota_fiscal/<int:nf_id>/item/<int:item_id>/vincular", methods=["POST"])
+@login_required
+def vincular_item_nf(nf_id, item_id):
+    item = ItemNotaFiscal.query.get_or_404(item_id)
+    mercadoria = db.session.get(Mercadoria, request.form.get('mercadoria_id', type=int) or 0)
+    if not mercadoria:
+        flash("Mercadoria não encontrada.", "error")
+        return redirect(url_for('detalhar_nota_fiscal', nf_id=nf_id))
+    try:
+        vincular_item(item, mercadoria.id)
+        db.session.commit()
+        flash(f"Item vinculado a {mercadoria.codigo}.", "success")
+    except Exception as e:
+        db.session.rollback()
+        flash(f"Erro ao vincular item: {str(e)}", "error")
+    return redirect(url_for('detalhar_nota_fiscal', nf_id=nf_id))
+
+@app.route("/nota_fiscal/<int:nf_id>/conciliar", methods=["POST"])
+@login_required
+def conciliar_nota_fiscal(nf_id):
+    nota_fiscal = NotaFiscal.query.get_or_404(nf_id)
+    try:
+        pendentes = [item for item in nota_fiscal.itens if item.mercadoria_id is None]
+        vinculados = conciliar_itens(pendentes)
+        db.session.commit()
+        flash(f"{len(vinculados)} de {len(pendentes)} itens vinculados automaticamente.", "success")
+    except Exception as e:
+        db.session.rollback()
+        flash(f"Erro ao conciliar itens: {str(e)}", "error")
+    return redirect(url_for('detalhar_nota_fiscal', nf_id=nf_id))
+
 
 @app.route("/usuarios", methods=["GET"])
 @gerente_required
+@leitura
 def listar_usuarios():
     """Lista todos os usuários (apenas gerentes)."""
     usuarios = Usuario.query.all()
@@ -892,9 +3864,8 @@ def criar_usuario():
         novo_usuario = Usuario(username=username, email=email, role=role)
         novo_usuario.set_password(password)
         db.session.add(novo_usuario)
-        db.session.commit()
-        
         registrar_log("Criação de Usuário", f"Usuário '{username}' criado com role '{role}'.")
+        db.session.commit()
         flash(f"Usuário '{username}' criado com sucesso!", "success")
         return redirect(url_for("listar_usuarios"))
     
@@ -909,6 +3880,7 @@ def editar_usuario(user_id):
     
     if request.method == "POST":
         usuario.email = request.form["email"].strip()
+        role_anterior = usuario.role
         usuario.role = request.form.get("role", usuario.role)
         password = request.form.get("password", "").strip()
         
@@ -916,8 +3888,13 @@ def editar_usuario(user_id):
         if password:
             usuario.set_password(password)
         
-        db.session.commit()
         registrar_log("Edição de Usuário", f"Usuário '{usuario.username}' editado.")
+        db.session.commit()
+        if password or usuario.role != role_anterior:
+            # O papel fica gravado na sessão: as outras sessões do usuário precisam de novo login
+            armazem_sessao.excluir_do_usuario(usuario.id, exceto=session.sid)
+            if usuario.id == session.get("user_id"):
+                session["role"] = usuario.role
         flash(f"Usuário '{usuario.username}' atualizado com sucesso!", "success")
         return redirect(url_for("listar_usuarios"))
     
@@ -936,9 +3913,11 @@ def excluir_usuario(user_id):
     
     username = usuario.username
     try:
+        user_id = usuario.id
         db.session.delete(usuario)
-        db.session.commit()
         registrar_log("Exclusão de Usuário", f"Usuário '{username}' excluído.")
+        db.session.commit()
+        armazem_sessao.excluir_do_usuario(user_id)
         flash(f"Usuário '{username}' excluído com sucesso!", "success")
     except Exception as e:
         db.session.rollback()
@@ -949,6 +3928,7 @@ def excluir_usuario(user_id):
 
 @app.route('/grupos')
 @gerente_required
+@leitura
 def listar_grupos():
     grupos = Grupo.query.order_by(Grupo.nome).all()
     return render_template('listar_grupos.html', grupos=grupos)
@@ -968,8 +3948,8 @@ def criar_grupo():
             return redirect(url_for('criar_grupo'))
         g = Grupo(nome=nome, descricao=descricao)
         db.session.add(g)
-        db.session.commit()
         registrar_log('Criação de Grupo', f"Grupo '{nome}' criado.")
+        db.session.commit()
         flash('Grupo criado com sucesso!', 'success')
         return redirect(url_for('listar_grupos'))
     return render_template('criar_grupo.html')
@@ -989,37 +3969,37 @@ def editar_grupo(id):
         if existente:
             flash('Já existe outro grupo com esse nome!', 'error')
             return redirect(url_for('editar_grupo', id=id))
-        old_name = grupo.nome
+        # Mercadorias referenciam o grupo pelo id: renomear altera só esta linha
         grupo.nome = nome
         grupo.descricao = descricao
-        # Atualiza mercadorias vinculadas para manter consistência
-        try:
-            Mercadoria.query.filter_by(grupo=old_name).update({"grupo": nome})
-        except Exception:
-            db.session.rollback()
-            flash('Erro ao atualizar mercadorias vinculadas ao grupo.', 'error')
-            return redirect(url_for('editar_grupo', id=id))
-        db.session.commit()
         registrar_log('Edição de Grupo', f"Grupo '{nome}' editado.")
+        db.session.commit()
         flash('Grupo atualizado com sucesso!', 'success')
         return redirect(url_for('listar_grupos'))
     return render_template('editar_grupo.html', grupo=grupo)
 
 
+def consulta_uso_grupo(modelo, grupo_id):
+    """Algum registro de `modelo` (Mercadoria ou ItemNotaFiscal) ainda ligado ao grupo."""
+    return db.select(modelo.id).where(modelo.grupo_id == grupo_id).limit(1)
+
+
 @app.route('/grupos/<int:id>/excluir', methods=['POST'])
 @gerente_required
 def excluir_grupo(id):
     grupo = Grupo.query.get_or_404(id)
     # Antes de excluir, garantir que nenhuma mercadoria esteja ligada a esse grupo
-    vinculadas = Mercadoria.query.filter_by(grupo=grupo.nome).first()
-    if vinculadas:
+    if db.session.execute(consulta_uso_grupo(Mercadoria, grupo.id)).first():
         flash('Não é possível excluir o grupo: existem mercadorias vinculadas a ele.', 'error')
         return redirect(url_for('listar_grupos'))
+    if db.session.execute(consulta_uso_grupo(ItemNotaFiscal, grupo.id)).first():
+        flash('Não é possível excluir o grupo: existem itens de nota fiscal vinculados a ele.', 'error')
+        return redirect(url_for('listar_grupos'))
     nome = grupo.nome
     try:
         db.session.delete(grupo)
-        db.session.commit()
         registrar_log('Exclusão de Grupo', f"Grupo '{nome}' excluído.")
+        db.session.commit()
         flash('Grupo excluído com sucesso!', 'success')
     except Exception as e:
         db.session.rollback()
@@ -1027,13 +4007,250 @@ def excluir_grupo(id):
     return redirect(url_for('listar_grupos'))
 
 
+# ========== ROTAS DE LOCAIS DE ESTOQUE ==========
+
+@app.route('/locais')
+@login_required
+@leitura
+def listar_locais():
+    locais = LocalEstoque.query.order_by(LocalEstoque.nome).all()
+    return render_template('listar_locais.html', locais=locais)
+
+
+@app.route('/locais/criar', methods=['GET', 'POST'])
+@gerente_required
+def criar_local():
+    if request.method == 'POST':
+        nome = request.form.get('nome', '').strip()
+        descricao = request.form.get('descricao', '').strip()
+        if not nome:
+            flash('Nome do local é obrigatório!', 'error')
+            return redirect(url_for('criar_local'))
+        if LocalEstoque.query.filter_by(nome=nome).first():
+            flash('Já existe um local com esse nome!', 'error')
+            return redirect(url_for('criar_local'))
+        db.session.add(LocalEstoque(nome=nome, descricao=descricao))
+        registrar_log('Criação de Local', f"Local '{nome}' criado.")
+        db.session.commit()
+        flash('Local criado com sucesso!', 'success')
+        return redirect(url_for('listar_locais'))
+    return render_template('criar_local.html')
+
+
+def consulta_saldos_local(local_id):
+    return (
+        db.select(Mercadoria.codigo, Mercadoria.nome, Grupo.nome, EstoqueLocal.quantidade)
+        .join(Mercadoria, EstoqueLocal.mercadoria_id == Mercadoria.id)
+        .join(Grupo, Mercadoria.grupo_id == Grupo.id)
+        .where(EstoqueLocal.local_id == local_id, EstoqueLocal.quantidade != 0)
+        .order_by(Mercadoria.nome)
+    )
+
+
+def consulta_logs_local(local_id):
+    return (
+        db.select(LogMovimentacao)
+        .where(LogMovimentacao.local_id == local_id)
+        .order_by(LogMovimentacao.data_hora.desc())
+        .limit(100)
+    )
+
+
+@app.route('/locais/<int:id>')
+@login_required
+@leitura
+def detalhar_local(id):
+    """Saldos e movimentações de um único local (só a faixa dele nos índices)."""
+    local = LocalEstoque.query.get_or_404(id)
+    saldos = db.session.execute(consulta_saldos_local(id)).all()
+    logs = db.session.execute(consulta_logs_local(id)).scalars().all()
+    return render_template('detalhar_local.html', local=local, saldos=saldos, logs=logs)
+
+
+@app.route('/locais/<int:id>/excluir', methods=['POST'])
+@gerente_required
+def excluir_local(id):
+    local = LocalEstoque.query.get_or_404(id)
+    if local.nome == LOCAL_PADRAO:
+        flash('O local padrão não pode ser excluído.', 'error')
+        return redirect(url_for('listar_locais'))
+    if EstoqueLocal.query.filter(EstoqueLocal.local_id == id, EstoqueLocal.quantidade != 0).first():
+        flash('Não é possível excluir o local: ainda há mercadorias nele.', 'error')
+        return redirect(url_for('listar_locais'))
+    if LogMovimentacao.query.filter_by(local_id=id).first():
+        flash('Não é possível excluir o local: existem movimentações registradas nele.', 'error')
+        return redirect(url_for('listar_locais'))
+    nome = local.nome
+    try:
+        EstoqueLocal.query.filter_by(local_id=id).delete()
+        db.session.delete(local)
+        registrar_log('Exclusão de Local', f"Local '{nome}' excluído.")
+        db.session.commit()
+        flash('Local excluído com sucesso!', 'success')
+    except Exception as e:
+        db.session.rollback()
+        flash(f'Erro ao excluir local: {e}', 'error')
+    return redirect(url_for('listar_locais'))
+
+
+# ========== ROTAS DE LOTES ==========
+
+LOTES_VENCENDO_DIAS = 30
+LOTES_VENCENDO_LIMITE = 500
+
+
+def consulta_lotes_vencendo(limite, busca=""):
+    """Lotes com saldo e validade até `limite`; com `busca`, só os de número com esse prefixo."""
+    # Só colunas do índice parcial ix_lote_validade + o código/nome da mercadoria
+    consulta = (
+        db.select(Lote.id, Lote.lote, Lote.validade, Lote.quantidade, Mercadoria.codigo, Mercadoria.nome)
+        .join(Mercadoria, Lote.mercadoria_id == Mercadoria.id)
+        .where(Lote.quantidade > 0, Lote.validade.isnot(None), Lote.validade <= limite)
+        .order_by(Lote.validade, Lote.id)
+        .limit(LOTES_VENCENDO_LIMITE)
+    )
+    if busca:
+        consulta = consulta.where(Lote.lote.startswith(busca, autoescape=True))
+    return consulta
+
+
+@app.route('/lotes/vencendo')
+@login_required
+@leitura
+def lotes_vencendo():
+    """Lotes com saldo que vencem nos próximos N dias (os já vencidos vêm primeiro)."""
+    dias = max(request.args.get('dias', LOTES_VENCENDO_DIAS, type=int) or 0, 0)
+    busca = request.args.get('lote', '').strip()
+    limite = date.today() + timedelta(days=dias)
+    lotes = db.session.execute(consulta_lotes_vencendo(limite, busca)).all()
+    return render_template('lotes_vencendo.html', lotes=lotes, dias=dias, busca=busca, hoje=date.today())
+
+
+def consulta_entradas_lote(lote_id):
+    return (
+        db.select(ItemNotaFiscal.quantidade, NotaFiscal.id, NotaFiscal.numero_nf, NotaFiscal.data_entrega, Fornecedor.nome)
+        .join(NotaFiscal, ItemNotaFiscal.nota_fiscal_id == NotaFiscal.id)
+        .join(Fornecedor, NotaFiscal.fornecedor_id == Fornecedor.id)
+        .where(ItemNotaFiscal.lote_id == lote_id)
+    )
+
+
+def consulta_consumos_lote(lote_id):
+    return (
+        db.select(ConsumoLote.data_hora, ConsumoLote.quantidade, Cirurgia.id, Cirurgia.data_cirurgia, Cirurgia.nome_paciente)
+        .outerjoin(Cirurgia, ConsumoLote.cirurgia_id == Cirurgia.id)
+        .where(ConsumoLote.lote_id == lote_id)
+        .order_by(ConsumoLote.data_hora.desc())
+    )
+
+
+@app.route('/lotes/<int:id>')
+@login_required
+@leitura
+def detalhar_lote(id):
+    """Rastreabilidade: de quais NFs o lote veio e em quais cirurgias foi usado."""
+    lote = Lote.query.get_or_404(id)
+    entradas = db.session.execute(consulta_entradas_lote(id)).all()
+    consumos = db.session.execute(consulta_consumos_lote(id)).all()
+    return render_template('detalhar_lote.html', lote=lote, entradas=entradas, consumos=consumos)
+
+
+# ========== ROTAS DE KITS CIRÚRGICOS ==========
+
+@app.route('/kits')
+@login_required
+@leitura
+def listar_kits():
+    kits = KitCirurgico.query.order_by(KitCirurgico.nome).all()
+    return render_template('listar_kits.html', kits=kits)
+
+
+def _salvar_kit(kit):
+    """Preenche o kit com o formulário; retorna a mensagem de erro ou None."""
+    nome = request.form.get('nome', '').strip()
+    if not nome:
+        return 'Nome do kit é obrigatório!'
+    if KitCirurgico.query.filter(KitCirurgico.nome == nome, KitCirurgico.id != kit.id).first():
+        return 'Já existe um kit com esse nome!'
+    try:
+        itens = _itens_do_formulario()
+    except ValueError as e:
+        return str(e)
+    if not itens:
+        return 'Informe ao menos um item.'
+    kit.nome = nome
+    kit.descricao = request.form.get('descricao', '').strip()
+    kit.itens = [ItemKit(mercadoria_id=m, quantidade=q) for m, q in sorted(itens.items())]
+    return None
+
+
+@app.route('/kits/criar', methods=['GET', 'POST'])
+@gerente_required
+def criar_kit():
+    kit = KitCirurgico()
+    if request.method == 'POST':
+        erro = _salvar_kit(kit)
+        if erro:
+            flash(erro, 'error')
+        else:
+            db.session.add(kit)
+            registrar_log('Criação de Kit', f"Kit '{kit.nome}' criado com {len(kit.itens)} itens.")
+            db.session.commit()
+            flash('Kit criado com sucesso!', 'success')
+            return redirect(url_for('listar_kits'))
+    mercadorias = db.session.execute(
+        db.select(Mercadoria.id, Mercadoria.codigo, Mercadoria.nome).order_by(Mercadoria.nome)
+    ).all()
+    return render_template('kit.html', kit=None, mercadorias=mercadorias, itens_form=[])
+
+
+@app.route('/kits/<int:id>/editar', methods=['GET', 'POST'])
+@gerente_required
+def editar_kit(id):
+    kit = KitCirurgico.query.get_or_404(id)
+    if request.method == 'POST':
+        erro = _salvar_kit(kit)
+        if erro:
+            db.session.rollback()
+            flash(erro, 'error')
+        else:
+            registrar_log('Edição de Kit', f"Kit '{kit.nome}' atualizado ({len(kit.itens)} itens).")
+            db.session.commit()
+            flash('Kit atualizado com sucesso!', 'success')
+            return redirect(url_for('listar_kits'))
+    mercadorias = db.session.execute(
+        db.select(Mercadoria.id, Mercadoria.codigo, Mercadoria.nome).order_by(Mercadoria.nome)
+    ).all()
+    itens_form = [(item.mercadoria_id, item.quantidade) for item in kit.itens]
+    return render_template('kit.html', kit=kit, mercadorias=mercadorias, itens_form=itens_form)
+
+
+@app.route('/kits/<int:id>/excluir', methods=['POST'])
+@gerente_required
+def excluir_kit(id):
+    kit = KitCirurgico.query.get_or_404(id)
+    nome = kit.nome
+    db.session.delete(kit)
+    registrar_log('Exclusão de Kit', f"Kit '{nome}' excluído.")
+    db.session.commit()
+    flash('Kit excluído com sucesso!', 'success')
+    return redirect(url_for('listar_kits'))
+
+
 # ========== ROTAS DE CIRURGIA ==========
 
 @app.route("/cirurgias")
 @login_required
+@leitura
 def listar_cirurgias():
-    cirurgias = Cirurgia.query.order_by(Cirurgia.data_cirurgia.desc()).all()
-    return render_template("listar_cirurgias.html", cirurgias=cirurgias)
+    pagina = max(request.args.get("pagina", 1, type=int), 1)
+    cirurgias = linhas_cirurgias(pagina)
+    return render_template(
+        "listar_cirurgias.html",
+        cirurgias=cirurgias[:CIRURGIAS_POR_PAGINA],
+        tem_proxima=len(cirurgias) > CIRURGIAS_POR_PAGINA,
+        pagina=pagina,
+    )
 
 
 @app.route("/cirurgias/criar", methods=["GET", "POST"])
@@ -1041,11 +4258,20 @@ def listar_cirurgias():
 def criar_cirurgia():
     if request.method == "POST":
         try:
-            data_cirurgia = request.form.get("data_cirurgia")
+            data_cirurgia = _data_do_formulario("data_cirurgia")
             nome_paciente = request.form.get("nome_paciente")
             referencia_produto = request.form.get("referencia_produto")
-            mercadoria_id = request.form.get("mercadoria_id") or None
             descricao = request.form.get("descricao", "")
+
+            # Itens consumidos: os do kit escolhido mais os informados linha a linha
+            quantidades = _itens_do_formulario()
+            kit_id = request.form.get("kit_id", type=int)
+            if kit_id:
+                kit = db.session.get(KitCirurgico, kit_id)
+                if not kit:
+                    raise ValueError("Kit não encontrado.")
+                for item in kit.itens:
+                    quantidades[item.mercadoria_id] = quantidades.get(item.mercadoria_id, 0) + item.quantidade
             
             foto_path = None
             if 'foto' in request.files:
@@ -1058,34 +4284,59 @@ def criar_cirurgia():
                     file.save(str(file_path))
                     foto_path = filename
             
-            # Converte mercadoria_id para inteiro se não for None
-            if mercadoria_id:
-                try:
-                    mercadoria_id = int(mercadoria_id)
-                except:
-                    mercadoria_id = None
-            
             cirurgia = Cirurgia(
                 data_cirurgia=data_cirurgia,
                 nome_paciente=nome_paciente,
                 referencia_produto=referencia_produto,
-                mercadoria_id=mercadoria_id,
                 usuario_id=session["user_id"],
                 descricao=descricao,
                 foto_path=foto_path
             )
             
             db.session.add(cirurgia)
-            db.session.commit()
             registrar_log("Criação de Cirurgia", f"Nova cirurgia para paciente '{nome_paciente}' criada.")
+
+            # Baixa de todos os itens na mesma transação: um UPDATE condicional para os
+            # saldos, um para os totais, e os itens/logs inseridos juntos na flush do commit
+            if quantidades:
+                local = _local_do_formulario()
+                if not local:
+                    raise ValueError("Local inválido.")
+                codigos = dict(db.session.execute(
+                    db.select(Mercadoria.id, Mercadoria.codigo).where(Mercadoria.id.in_(list(quantidades)))
+                ).all())
+                if len(codigos) != len(quantidades):
+                    raise ValueError("Mercadoria não encontrada.")
+                consumidos = baixar_estoque_varios(local.id, quantidades, cirurgia)
+                for mercadoria_id, quantidade in sorted(quantidades.items()):
+                    cirurgia.itens.append(
+                        ItemCirurgia(mercadoria_id=mercadoria_id, local_id=local.id, quantidade=quantidade)
+                    )
+                    descricao_log = (
+                        f"Saída de {quantidade} da mercadoria '{codigos[mercadoria_id]}' em '{local.nome}'. "
+                        f"Cirurgia de '{nome_paciente}'."
+                    )
+                    if consumidos[mercadoria_id]:
+                        descricao_log += f" Lotes: {descrever_lotes(consumidos[mercadoria_id])}."
+                    registrar_log(
+                        "Saída", descricao_log, mercadoria_id=mercadoria_id, quantidade=quantidade, local_id=local.id
+                    )
+
+            db.session.commit()
             flash(f"Cirurgia registrada com sucesso!", "success")
             return redirect(url_for("listar_cirurgias"))
         except Exception as e:
             db.session.rollback()
             flash(f"Erro ao registrar cirurgia: {str(e)}", "error")
     
-    mercadorias = Mercadoria.query.all()
-    return render_template("criar_cirurgia.html", mercadorias=mercadorias)
+    mercadorias = db.session.execute(
+        db.select(Mercadoria.id, Mercadoria.codigo, Mercadoria.nome).order_by(Mercadoria.nome)
+    ).all()
+    locais = LocalEstoque.query.order_by(LocalEstoque.nome).all()
+    kits = KitCirurgico.query.order_by(KitCirurgico.nome).all()
+    return render_template(
+        "criar_cirurgia.html", mercadorias=mercadorias, locais=locais, kits=kits, local_padrao=LOCAL_PADRAO
+    )
 
 
 @app.route("/cirurgias/<int:id>/editar", methods=["GET", "POST"])
@@ -1095,7 +4346,7 @@ def editar_cirurgia(id):
     
     if request.method == "POST":
         try:
-            cirurgia.data_cirurgia = request.form.get("data_cirurgia")
+            cirurgia.data_cirurgia = _data_do_formulario("data_cirurgia")
             cirurgia.nome_paciente = request.form.get("nome_paciente")
             cirurgia.referencia_produto = request.form.get("referencia_produto")
             mercadoria_id = request.form.get("mercadoria_id")
@@ -1125,8 +4376,8 @@ def editar_cirurgia(id):
                     file.save(str(file_path))
                     cirurgia.foto_path = filename
             
-            db.session.commit()
             registrar_log("Edição de Cirurgia", f"Cirurgia de '{cirurgia.nome_paciente}' atualizada.")
+            db.session.commit()
             flash("Cirurgia atualizada com sucesso!", "success")
             return redirect(url_for("listar_cirurgias"))
         except Exception as e:
@@ -1134,7 +4385,11 @@ def editar_cirurgia(id):
             flash(f"Erro ao atualizar cirurgia: {str(e)}", "error")
     
     mercadorias = Mercadoria.query.all()
-    return render_template("editar_cirurgia.html", cirurgia=cirurgia, mercadorias=mercadorias)
+    consumos = ConsumoLote.query.filter_by(cirurgia_id=cirurgia.id).all()
+    itens = ItemCirurgia.query.filter_by(cirurgia_id=cirurgia.id).all()
+    return render_template(
+        "editar_cirurgia.html", cirurgia=cirurgia, mercadorias=mercadorias, consumos=consumos, itens=itens
+    )
 
 
 @app.route("/cirurgias/<int:id>/excluir", methods=["POST"])
@@ -1142,7 +4397,16 @@ def editar_cirurgia(id):
 def excluir_cirurgia(id):
     cirurgia = Cirurgia.query.get_or_404(id)
     nome_paciente = cirurgia.nome_paciente
-    
+    # A baixa dos itens e os lotes usados no paciente fazem parte da rastreabilidade;
+    # correções de estoque são feitas por movimentação, não apagando a cirurgia
+    if db.session.execute(db.select(ItemCirurgia.mercadoria_id).filter_by(cirurgia_id=id).limit(1)).first():
+        flash(
+            "Não é possível excluir a cirurgia: ela baixou itens do estoque. "
+            "Para corrigir o saldo, registre a entrada dos itens em Movimentação.",
+            "error",
+        )
+        return redirect(url_for("listar_cirurgias"))
+
     try:
         # Remove foto do servidor se existir
         if cirurgia.foto_path:
@@ -1150,9 +4414,11 @@ def excluir_cirurgia(id):
             if os.path.exists(foto_path):
                 os.remove(foto_path)
         
+        # O consumo dos lotes continua valendo; só perde o vínculo com a cirurgia
+        ConsumoLote.query.filter_by(cirurgia_id=cirurgia.id).update({"cirurgia_id": None})
         db.session.delete(cirurgia)
-        db.session.commit()
         registrar_log("Exclusão de Cirurgia", f"Cirurgia de '{nome_paciente}' excluída.")
+        db.session.commit()
         flash(f"Cirurgia de '{nome_paciente}' excluída com sucesso!", "success")
     except Exception as e:
         db.session.rollback()
@@ -1178,7 +4444,10 @@ def login():
         user = Usuario.query.filter_by(username=username).first()
 
         if user and user.check_password(password):
+            session.clear()
+            session.renovar_id()
             session["user_id"] = user.id
+            session["role"] = user.role  # usado por gerente_required sem consultar o banco
             session.permanent = True  # Configura a sessão como permanente para respeitar a expiração configurada
             flash("Login realizado com sucesso!", "success")
             return redirect(url_for("index"))
@@ -1190,9 +4459,71 @@ def login():
 @app.route("/logout")
 @login_required
 def logout():
-    session.pop("user_id", None)
+    session.clear()
+    session.renovar_id()
     flash("Logout realizado com sucesso!", "success")
     return redirect(url_for("login"))
 
+# ========== AQUECIMENTO DO WORKER ==========
+# Chamado pelo gunicorn (gunicorn.conf.py) em cada worker, depois do fork e
+# antes de aceitar conexões, para que o primeiro usuário não pague a abertura
+# do pool, a montagem dos caches nem a compilação dos templates.
+
+def aquecer():
+    """Prepara o processo para receber tráfego; retorna os segundos gastos."""
+    inicio = time.monotonic()
+    for nome in app.jinja_env.list_templates():
+        app.jinja_env.get_template(nome)
+    with app.app_context():
+        # Conexões herdadas do processo mestre (preload) não podem ser reutilizadas
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+        try:
+            for engine in db.engines.values():
+                conexoes = [engine.connect() for _ in range(max(app.config['DB_POOL_SIZE'], 1))]
+                for conn in conexoes:
+                    conn.execute(text("SELECT 1"))
+                    conn.close()
+            versoes = versoes_tabelas(*TABELAS_VERSIONADAS)
+            _tabela_estoque_html((versoes["mercadoria"], versoes["grupo"]))
+            _opcoes_fornecedores_html(versoes["fornecedor"])
+            indice_codigo.carregar()
+            indice_codigo.iniciar()
+            if pd is not None:
+                avaliar_estoque()
+            replica_disponivel()
+        except Exception as e:
+            print("Warning: aquecimento incompleto, o worker segue sem cache:", e)
+        finally:
+            db.session.remove()
+    return time.monotonic() - inicio
+
+
+@app.cli.command("conciliar-itens")
+@click.option("--reindexar", is_flag=True, help="Regera o índice de tokens das mercadorias antes.")
+def conciliar_itens_pendentes(reindexar):
+    """Vincula a mercadorias os itens de NF que ainda não têm uma (com folga clara)."""
+    inicio = time.perf_counter()
+    if reindexar:
+        indexar_mercadorias()
+        db.session.commit()
+    ultimo, total, vinculados = 0, 0, 0
+    while True:
+        itens = (
+            ItemNotaFiscal.query
+            .filter(ItemNotaFiscal.mercadoria_id.is_(None), ItemNotaFiscal.id > ultimo)
+            .order_by(ItemNotaFiscal.id)
+            .limit(CONCILIACAO_LOTE)
+            .all()
+        )
+        if not itens:
+            break
+        vinculados += len(conciliar_itens(itens))
+        total += len(itens)
+        ultimo = itens[-1].id
+        db.session.commit()
+    click.echo(f"{vinculados} de {total} itens vinculados em {time.perf_counter() - inicio:.1f} s.")
+
+
 if __name__ == "__main__":
     app.run(debug=True)
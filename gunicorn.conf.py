@@ -0,0 +1,81 @@
+"""
+Servidor de produção fora da Vercel: gunicorn com vários processos (workers),
+várias threads por processo e o app pré-carregado no processo mestre.
+
+    pip install -r requirements.txt
+    gunicorn                         # lê este arquivo do diretório atual
+    WEB_WORKERS=4 WEB_THREADS=8 gunicorn
+
+Cada worker descarta as conexões herdadas do mestre, abre o seu pool (uma
+conexão por thread) e aquece caches e templates antes de aceitar conexões
+(`aquecer` em api/app.py). Com SIGTERM o worker para de aceitar conexões,
+fecha os streams SSE (os navegadores reconectam em outro worker), termina as
+requisições em andamento em até WEB_GRACEFUL_TIMEOUT segundos e grava o log de
+auditoria pendente.
+
+Streams SSE (/eventos/estoque): no worker gthread cada aba aberta na página
+inicial prende uma thread enquanto o stream durar. Por isso cada worker aceita
+no máximo EVENTOS_MAX_STREAMS streams (padrão: metade de WEB_THREADS; precisa
+ser menor que WEB_THREADS). As abas além disso recebem 503 e passam a consultar
+/estoque/quantidades a cada 15 s. Ao todo, até WEB_WORKERS × EVENTOS_MAX_STREAMS
+abas recebem eventos em tempo real, e cada worker mantém sempre
+WEB_THREADS − EVENTOS_MAX_STREAMS threads livres para as demais requisições.
+Para mais abas ao vivo, aumente WEB_THREADS junto.
+
+O banco recebe até WEB_WORKERS × (WEB_THREADS + DB_MAX_OVERFLOW) conexões.
+Com mais de um worker use EVENTOS_BACKEND=postgres e SESSION_BACKEND=banco.
+Para conferir a configuração sob carga, suba o servidor e rode
+`python scripts/carga.py --url http://127.0.0.1:8000`.
+"""
+import multiprocessing
+import os
+import signal
+
+wsgi_app = "app:app"
+pythonpath = os.path.join(os.path.dirname(os.path.abspath(__file__)), "api")
+bind = os.getenv("WEB_BIND", f"0.0.0.0:{os.getenv('PORT', '8000')}")
+
+worker_class = "gthread"
+workers = int(os.getenv("WEB_WORKERS", multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.getenv("WEB_THREADS", 4))
+preload_app = True
+
+timeout = int(os.getenv("WEB_TIMEOUT", 60))  # segundos sem resposta do worker até reiniciá-lo
+graceful_timeout = int(os.getenv("WEB_GRACEFUL_TIMEOUT", 30))
+keepalive = int(os.getenv("WEB_KEEPALIVE", 5))
+# Reinicia cada worker após N requisições (0 = nunca); o jitter evita reinícios simultâneos
+max_requests = int(os.getenv("WEB_MAX_REQUESTS", 0))
+max_requests_jitter = max_requests // 10
+
+accesslog = os.getenv("WEB_ACCESS_LOG", "-") or None
+loglevel = os.getenv("WEB_LOG_LEVEL", "info")
+
+# Lido pelo app no preload: um pool por worker, do tamanho das threads
+os.environ.setdefault("DB_POOL_SIZE", str(threads))
+# Streams SSE por worker: nunca todas as threads, para sobrar vazão às páginas
+os.environ.setdefault("EVENTOS_MAX_STREAMS", str(threads // 2))  # 0: só polling
+if int(os.environ["EVENTOS_MAX_STREAMS"]) >= threads:
+    raise RuntimeError("EVENTOS_MAX_STREAMS deve ser menor que WEB_THREADS.")
+
+
+def post_worker_init(worker):
+    import app as estoque
+
+    segundos = estoque.aquecer()
+    worker.log.info("Worker %s aquecido em %.2fs", worker.pid, segundos)
+
+    # SIGTERM: além de parar de aceitar conexões, libera as threads presas em streams SSE
+    parar = worker.handle_exit
+
+    def handle_exit(sig, frame):
+        estoque.canal_estoque.encerrar()
+        parar(sig, frame)
+
+    signal.signal(signal.SIGTERM, handle_exit)
+
+
+def worker_exit(server, worker):
+    import app as estoque
+
+    if estoque.auditoria:
+        estoque.auditoria.encerrar()
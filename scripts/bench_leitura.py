@@ -0,0 +1,135 @@
+"""
+Benchmark das leituras das listagens: entidades do ORM x colunas em tuplas.
+
+Popula --linhas mercadorias (se ainda não houver) e lê o relatório de estoque
+pelos dois caminhos, tocando os mesmos campos que a exportação usa:
+
+  orm      select(Mercadoria, Mercadoria.quantidade) — o caminho antigo, com
+           identity map, cópia de estado por entidade e o grupo carregado junto
+  colunas  linhas_relatorio() — só as colunas exibidas, em `Row`
+
+Mostra tempo de parede, CPU e pico de memória alocada (tracemalloc) de cada
+caminho; vale a melhor de --repeticoes execuções. Sem DATABASE_URL usa um
+SQLite temporário:
+
+    python scripts/bench_leitura.py --linhas 100000
+    DATABASE_URL=postgresql://localhost/estoque_bench python scripts/bench_leitura.py
+"""
+import argparse
+import gc
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+if not os.getenv("DATABASE_URL"):
+    os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.gettempdir(), "estoque_bench.db")
+os.environ.setdefault("SECRET_KEY", "bench")
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "api"))
+
+import app as estoque  # noqa: E402
+
+LOTE_INSERCAO = 10000
+
+
+def preparar_dados(linhas):
+    """Garante pelo menos `linhas` mercadorias, distribuídas em 20 grupos."""
+    db = estoque.db
+    estoque.aplicar_migracoes()  # mesmo esquema (índices, gatilhos, dados iniciais) do app
+    existentes = db.session.query(db.func.count(estoque.Mercadoria.id)).scalar()
+    if existentes >= linhas:
+        return existentes
+    grupos = []
+    for i in range(20):
+        nome = f"Bench {i}"
+        grupo = estoque.Grupo.query.filter_by(nome=nome).first() or estoque.Grupo(nome=nome)
+        db.session.add(grupo)
+        grupos.append(grupo)
+    db.session.flush()
+    ids_grupos = [g.id for g in grupos]
+    for inicio in range(existentes, linhas, LOTE_INSERCAO):
+        db.session.execute(
+            estoque.Mercadoria.__table__.insert(),
+            [
+                {
+                    "nome": f"Mercadoria bench {i:07d}",
+                    "codigo": f"BENCH-{i:07d}",
+                    "grupo_id": ids_grupos[i % len(ids_grupos)],
+                    "quantidade": i % 500,
+                    "descricao": f"Descrição da mercadoria {i}",
+                    "preco": round(1 + (i % 1000) / 10, 2),
+                }
+                for i in range(inicio, min(inicio + LOTE_INSERCAO, linhas))
+            ],
+        )
+    db.session.commit()
+    return linhas
+
+
+def ler_orm():
+    linhas = estoque.db.session.execute(
+        estoque.db.select(estoque.Mercadoria, estoque.Mercadoria.quantidade).order_by(estoque.Mercadoria.nome)
+    ).all()
+    return [(m.id, m.codigo, m.nome, m.grupo.nome, q, m.descricao, m.preco) for m, q in linhas]
+
+
+def ler_colunas():
+    linhas = estoque.linhas_relatorio()
+    return [(m.id, m.codigo, m.nome, m.grupo, m.quantidade, m.descricao, m.preco) for m in linhas]
+
+
+def medir(funcao):
+    """
+    Executa `funcao` numa sessão limpa; retorna (linhas, parede, cpu, pico de
+    memória). O pico vem de uma segunda execução, para o tracemalloc não
+    atrasar a medida de tempo.
+    """
+    estoque.db.session.remove()
+    gc.collect()
+    inicio, inicio_cpu = time.perf_counter(), time.process_time()
+    linhas = len(funcao())
+    parede, cpu = time.perf_counter() - inicio, time.process_time() - inicio_cpu
+    estoque.db.session.remove()
+    gc.collect()
+    tracemalloc.start()
+    resultado = funcao()
+    _, pico = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del resultado
+    estoque.db.session.remove()
+    return linhas, parede, cpu, pico
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--linhas", type=int, default=100000, help="mercadorias no banco de teste")
+    parser.add_argument("--repeticoes", type=int, default=3)
+    args = parser.parse_args()
+
+    with estoque.app.app_context():
+        total = preparar_dados(args.linhas)
+        print(f"{total} mercadorias em {estoque.db.engine.url.render_as_string(hide_password=True)}")
+        medidas = {}
+        for nome, funcao in (("orm", ler_orm), ("colunas", ler_colunas)):
+            execucoes = [medir(funcao) for _ in range(args.repeticoes)]
+            medidas[nome] = (
+                execucoes[0][0],
+                min(e[1] for e in execucoes),
+                min(e[2] for e in execucoes),
+                min(e[3] for e in execucoes),
+            )
+
+    print(f"{'caminho':<10}{'linhas':>10}{'parede (s)':>12}{'CPU (s)':>10}{'pico (MB)':>12}")
+    for nome, (linhas, parede, cpu, pico) in medidas.items():
+        print(f"{nome:<10}{linhas:>10}{parede:>12.3f}{cpu:>10.3f}{pico / 2**20:>12.1f}")
+    orm, colunas = medidas["orm"], medidas["colunas"]
+    print(
+        f"colunas/orm: tempo {colunas[1] / orm[1]:.2f}x, CPU {colunas[2] / orm[2]:.2f}x, "
+        f"memória {colunas[3] / orm[3]:.2f}x"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,320 @@
+"""
+Teste de carga do estoque.
+
+Sobe o app WSGI localmente (servidor do Werkzeug com threads) ou usa --url, e
+dispara uma carga mista — buscas, movimentações, itens de NF e relatórios —
+com N usuários concorrentes durante --duracao segundos. No fim mostra vazão,
+latências (p50/p95/p99) e erros por operação, quantas conexões o NullPool abriu
+e confere se o estoque final da mercadoria "quente" é o inicial mais a soma das
+movimentações aceitas.
+
+Rode contra um banco descartável (o script aplica as migrações e cria dados de teste):
+
+    DATABASE_URL=postgresql://localhost/estoque_carga SECRET_KEY=x \\
+        python scripts/carga.py --usuarios 50 --duracao 60
+
+Sai com código 1 se o estoque não fechar. Use PostgreSQL: o SQLite ignora
+SELECT ... FOR UPDATE e perde atualizações concorrentes do mesmo item.
+
+Com --url o log de auditoria é do outro processo: se ele usar AUDIT_LOG_MODE=buffer,
+a conferência do log espera até --espera-log segundos pela gravação do buffer.
+"""
+import argparse
+import http.client
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from collections import defaultdict
+from http.cookies import SimpleCookie
+from urllib.parse import urlencode, urlsplit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "api"))
+
+from sqlalchemy import event  # noqa: E402
+from werkzeug.serving import make_server  # noqa: E402
+
+import app as estoque  # noqa: E402
+
+USUARIO = "carga"
+SENHA = "carga"
+CODIGO_QUENTE = "CARGA-QUENTE"
+MIX_PADRAO = "busca=25,codigo=15,saida=25,entrada=10,item_nf=10,relatorio=5,index=10"
+
+
+class Cliente:
+    """Um usuário virtual: guarda os cookies da sessão entre as requisições."""
+
+    def __init__(self, host, port, timeout):
+        self.host, self.port, self.timeout = host, port, timeout
+        self.cookies = {}
+
+    def requisitar(self, metodo, caminho, dados=None):
+        headers = {}
+        if self.cookies:
+            headers["Cookie"] = "; ".join(f"{k}={v}" for k, v in self.cookies.items())
+        corpo = None
+        if dados is not None:
+            corpo = urlencode(dados)
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        try:
+            conn.request(metodo, caminho, body=corpo, headers=headers)
+            resp = conn.getresponse()
+            resp.read()
+            for valor in resp.headers.get_all("Set-Cookie") or []:
+                for nome, morsel in SimpleCookie(valor).items():
+                    self.cookies[nome] = morsel.value
+            return resp.status, urlsplit(resp.getheader("Location", "")).path
+        finally:
+            conn.close()
+
+
+def preparar_dados(estoque_inicial, mercadorias):
+    """Cria (se faltarem) usuário, local, grupo, mercadorias, fornecedor e NF de teste."""
+    db = estoque.db
+    with estoque.app.app_context():
+        estoque.aplicar_migracoes()  # mesmo esquema (índices, gatilhos, dados iniciais) do app
+        if not estoque.LocalEstoque.query.filter_by(nome=estoque.LOCAL_PADRAO).first():
+            db.session.add(estoque.LocalEstoque(nome=estoque.LOCAL_PADRAO))
+        grupo = estoque.Grupo.query.filter_by(nome="Geral").first()
+        if not grupo:
+            grupo = estoque.Grupo(nome="Geral")
+            db.session.add(grupo)
+        if not estoque.Usuario.query.filter_by(username=USUARIO).first():
+            usuario = estoque.Usuario(username=USUARIO, role="gerente")
+            usuario.set_password(SENHA)
+            db.session.add(usuario)
+        fornecedor = estoque.Fornecedor.query.filter_by(cnpj="carga").first()
+        if not fornecedor:
+            fornecedor = estoque.Fornecedor(cnpj="carga", nome="Fornecedor Carga", endereco="-", telefone="-", email="-")
+            db.session.add(fornecedor)
+        db.session.flush()
+        if not estoque.NotaFiscal.query.filter_by(numero_nf="CARGA-NF").first():
+            hoje = estoque.date.today()
+            db.session.add(estoque.NotaFiscal(
+                numero_nf="CARGA-NF", data_emissao=hoje, data_entrega=hoje, fornecedor_id=fornecedor.id,
+            ))
+        existentes = set(db.session.execute(
+            db.select(estoque.Mercadoria.codigo).where(estoque.Mercadoria.codigo.like("CARGA-%"))
+        ).scalars())
+        for codigo in [CODIGO_QUENTE] + [f"CARGA-{i}" for i in range(mercadorias)]:
+            if codigo not in existentes:
+                db.session.add(estoque.Mercadoria(nome=f"Mercadoria {codigo}", codigo=codigo, quantidade=0, grupo=grupo, preco=1.0))
+        db.session.commit()
+
+        local = estoque.LocalEstoque.query.filter_by(nome=estoque.LOCAL_PADRAO).one()
+        quente = estoque.Mercadoria.query.filter_by(codigo=CODIGO_QUENTE).one()
+        if quente.quantidade < estoque_inicial:
+            estoque.ajustar_estoque(quente.id, local.id, estoque_inicial - quente.quantidade)
+            db.session.commit()
+        nf = estoque.NotaFiscal.query.filter_by(numero_nf="CARGA-NF").one()
+        ultimo_log = db.session.query(db.func.max(estoque.LogMovimentacao.id)).scalar() or 0
+        return {
+            "quente": quente.id,
+            "local": local.id,
+            "grupo": grupo.id,
+            "nf": nf.id,
+            "inicial": quente.quantidade,
+            "ultimo_log": ultimo_log,
+            "codigos": [f"CARGA-{i}" for i in range(mercadorias)],
+        }
+
+
+def delta_dos_logs(dados):
+    """Entradas menos saídas da mercadoria quente registradas no log desde a preparação."""
+    m = estoque
+    with m.app.app_context():
+        logs = dict(m.db.session.execute(
+            m.db.select(m.LogMovimentacao.acao, m.db.func.sum(m.LogMovimentacao.quantidade))
+            .where(
+                m.LogMovimentacao.id > dados["ultimo_log"],
+                m.LogMovimentacao.mercadoria_id == dados["quente"],
+                m.LogMovimentacao.acao.in_(("Entrada", "Saída")),
+            )
+            .group_by(m.LogMovimentacao.acao)
+        ).all())
+    return (logs.get("Entrada") or 0) - (logs.get("Saída") or 0)
+
+
+def conferir_estoque(dados, delta_aceito, espera_log=0.0):
+    """
+    Compara o estoque final com o esperado; retorna a lista de divergências.
+    Com `espera_log` (servidor remoto) relê o log até ele fechar ou o prazo acabar,
+    já que o buffer de auditoria do servidor não é deste processo.
+    """
+    m = estoque
+    if not espera_log and m.auditoria is not None:
+        m.auditoria.descarregar()  # AUDIT_LOG_MODE=buffer: grava o log pendente antes de conferir
+    with m.app.app_context():
+        m.db.session.expire_all()
+        total = m.db.session.get(m.Mercadoria, dados["quente"]).quantidade
+        por_local = m.db.session.query(m.db.func.sum(m.EstoqueLocal.quantidade)).filter_by(
+            mercadoria_id=dados["quente"]
+        ).scalar() or 0
+    delta_logs = delta_dos_logs(dados)
+    prazo = time.monotonic() + espera_log
+    while delta_logs != delta_aceito and time.monotonic() < prazo:
+        time.sleep(0.5)
+        delta_logs = delta_dos_logs(dados)
+    esperado = dados["inicial"] + delta_aceito
+    print(f"\nEstoque de {CODIGO_QUENTE}: inicial {dados['inicial']}, "
+          f"movimentações aceitas {delta_aceito:+d}, esperado {esperado}, final {total}")
+    divergencias = []
+    if total != esperado:
+        divergencias.append(f"total {total} != esperado {esperado}")
+    if por_local != total:
+        divergencias.append(f"soma dos locais {por_local} != total {total}")
+    if delta_logs != delta_aceito:
+        divergencias.append(f"log registra {delta_logs:+d}, aceitas {delta_aceito:+d}")
+    return divergencias
+
+
+def percentil(valores, p):
+    if not valores:
+        return 0.0
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(round(p / 100 * (len(ordenados) - 1))))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--usuarios", type=int, default=20, help="usuários concorrentes")
+    parser.add_argument("--duracao", type=float, default=30, help="segundos de carga")
+    parser.add_argument("--mix", default=MIX_PADRAO, help="pesos das operações (ex.: busca=25,saida=25)")
+    parser.add_argument("--estoque-inicial", type=int, default=1000, help="estoque da mercadoria quente")
+    parser.add_argument("--max-qtd", type=int, default=3, help="quantidade máxima por movimentação")
+    parser.add_argument("--mercadorias", type=int, default=200, help="mercadorias extras para as buscas")
+    parser.add_argument("--url", help="servidor já em execução (ex.: http://127.0.0.1:8000)")
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--espera-log", type=float, default=10,
+                        help="com --url: segundos de espera pelo log de auditoria do servidor")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    rng_base = random.Random(args.seed)
+    mix = {}
+    for parte in args.mix.split(","):
+        nome, peso = parte.split("=")
+        mix[nome.strip()] = float(peso)
+    desconhecidas = set(mix) - {"busca", "codigo", "saida", "entrada", "item_nf", "relatorio", "index"}
+    if desconhecidas:
+        parser.error(f"operações desconhecidas no --mix: {', '.join(sorted(desconhecidas))}")
+
+    dados = preparar_dados(args.estoque_inicial, args.mercadorias)
+    with estoque.app.app_context():
+        if estoque.db.engine.dialect.name == "sqlite":
+            print("Aviso: SQLite não trava linhas; a conferência de estoque deve falhar sob concorrência.")
+
+    conexoes = [0]
+    servidor = None
+    if args.url:
+        alvo = urlsplit(args.url)
+        host, port = alvo.hostname, alvo.port or 80
+    else:
+        with estoque.app.app_context():
+            engine = estoque.db.engine
+
+        @event.listens_for(engine, "connect")
+        def _contar_conexao(dbapi_conn, registro):
+            conexoes[0] += 1
+
+        logging.getLogger("werkzeug").setLevel(logging.WARNING)
+        servidor = make_server("127.0.0.1", 0, estoque.app, threaded=True)
+        host, port = "127.0.0.1", servidor.server_port
+        threading.Thread(target=servidor.serve_forever, daemon=True).start()
+
+    latencias = defaultdict(list)
+    erros = defaultdict(int)
+    recusadas = defaultdict(int)
+    delta_aceito = [0]
+    lock = threading.Lock()
+    fim = time.monotonic() + args.duracao
+    nomes, pesos = list(mix), list(mix.values())
+
+    def operacao(cli, rng, nome):
+        """Executa uma operação; retorna (status, destino do redirect, delta de estoque aceito)."""
+        if nome == "busca":
+            return cli.requisitar("GET", f"/buscar_ajax?query={rng.choice(dados['codigos'])[:7]}") + (0,)
+        if nome == "codigo":
+            return cli.requisitar("GET", f"/mercadorias/by-codigo/{rng.choice(dados['codigos'])}") + (0,)
+        if nome == "relatorio":
+            return cli.requisitar("GET", rng.choice(["/relatorios", "/relatorios/reposicao", "/informacoes"])) + (0,)
+        if nome == "index":
+            return cli.requisitar("GET", "/") + (0,)
+        if nome == "item_nf":
+            return cli.requisitar("POST", f"/nota_fiscal/{dados['nf']}", {
+                "descricao": "Item carga", "quantidade": rng.randint(1, 10), "preco_unitario": "2.50",
+                "grupo_id": dados["grupo"], "mercadoria_id": rng.choice([dados["quente"], ""]),
+            }) + (0,)
+        qtd = rng.randint(1, args.max_qtd)
+        status, destino = cli.requisitar("POST", "/adicionar", {
+            "form_type": "movimentar", "mercadoria_id": dados["quente"], "local_id": dados["local"],
+            "mov_type": nome, "mov_quantidade": qtd, "mov_descricao": "carga",
+        })
+        # Sucesso redireciona para o index; recusa (ex.: saldo insuficiente) volta ao formulário
+        aceita = status == 302 and destino == "/"
+        return status, destino, (qtd if nome == "entrada" else -qtd) if aceita else 0
+
+    def usuario(indice):
+        rng = random.Random(rng_base.random())
+        cli = Cliente(host, port, args.timeout)
+        cli.requisitar("POST", "/login", {"username": USUARIO, "password": SENHA})
+        while time.monotonic() < fim:
+            nome = rng.choices(nomes, pesos)[0]
+            inicio = time.perf_counter()
+            try:
+                status, destino, delta = operacao(cli, rng, nome)
+            except Exception:
+                with lock:
+                    erros[nome] += 1
+                continue
+            duracao = time.perf_counter() - inicio
+            with lock:
+                latencias[nome].append(duracao)
+                delta_aceito[0] += delta
+                if status >= 400:
+                    erros[nome] += 1
+                elif nome in ("entrada", "saida") and not delta:
+                    recusadas[nome] += 1
+            if status == 302 and destino:
+                # Como o navegador: segue o redirect (e consome a mensagem flash)
+                try:
+                    cli.requisitar("GET", destino)
+                except Exception:
+                    pass
+
+    threads = [threading.Thread(target=usuario, args=(i,)) for i in range(args.usuarios)]
+    inicio = time.monotonic()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    decorrido = time.monotonic() - inicio
+    if servidor is not None:
+        servidor.shutdown()
+
+    total = sum(len(v) for v in latencias.values())
+    print(f"{args.usuarios} usuários, {decorrido:.1f}s, {total} operações, {total / decorrido:.1f} op/s")
+    print(f"{'operação':<10} {'n':>7} {'op/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'máx ms':>8} {'erros':>6} {'recus.':>6}")
+    for nome in nomes:
+        v = latencias.get(nome, [])
+        print(
+            f"{nome:<10} {len(v):>7} {len(v) / decorrido:>8.1f} "
+            f"{percentil(v, 50) * 1000:>8.1f} {percentil(v, 95) * 1000:>8.1f} {percentil(v, 99) * 1000:>8.1f} "
+            f"{(max(v) if v else 0) * 1000:>8.1f} {erros[nome]:>6} {recusadas[nome]:>6}"
+        )
+    if servidor is not None:
+        print(f"\nConexões abertas com o banco: {conexoes[0]} ({conexoes[0] / max(total, 1):.2f} por operação)")
+
+    divergencias = conferir_estoque(dados, delta_aceito[0], args.espera_log if args.url else 0.0)
+    if divergencias:
+        print("ESTOQUE NÃO FECHA: " + "; ".join(divergencias))
+        raise SystemExit(1)
+    print("Estoque confere.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+import os
+import sys
+
+import pytest
+from sqlalchemy import text
+
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+os.environ.setdefault("SECRET_KEY", "teste")
+# A thread do índice de códigos não concorre com os testes; eles chamam `atualizar()`
+os.environ.setdefault("CODIGO_INDEX_INTERVALO", "3600")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "api"))
+
+import app as estoque  # noqa: E402
+
+SENHA = "senha-teste"
+
+
+@pytest.fixture
+def banco():
+    """Banco vazio migrado até a última versão, recriado a cada teste."""
+    with estoque.app.app_context():
+        estoque.db.session.remove()
+        estoque.db.drop_all()
+        with estoque.db.engine.begin() as conn:
+            conn.execute(text("DROP TABLE IF EXISTS schema_version"))
+        estoque.aplicar_migracoes()
+        estoque.indice_codigo.carregar()
+        yield estoque.db
+        estoque.db.session.remove()
+
+
+@pytest.fixture
+def gerente(banco):
+    usuario = estoque.Usuario(username="gerente", email="gerente@teste", role="gerente")
+    usuario.set_password(SENHA)
+    banco.session.add(usuario)
+    banco.session.commit()
+    return usuario
+
+
+@pytest.fixture
+def cliente(gerente):
+    """Cliente de teste já logado como gerente."""
+    cliente = estoque.app.test_client()
+    resposta = cliente.post("/login", data={"username": gerente.username, "password": SENHA})
+    assert resposta.status_code == 302
+    return cliente
+
+
+@pytest.fixture
+def mercadoria(banco):
+    """Mercadoria com 10 unidades no local padrão."""
+    local = estoque.LocalEstoque.query.filter_by(nome=estoque.LOCAL_PADRAO).one()
+    grupo = estoque.Grupo.query.filter_by(nome="Geral").one()
+    item = estoque.Mercadoria(nome="Parafuso", codigo="PRF-1", quantidade=0, grupo=grupo, preco=2.0)
+    banco.session.add(item)
+    banco.session.flush()
+    estoque.ajustar_estoque(item.id, local.id, 10)
+    banco.session.commit()
+    return item
@@ -0,0 +1,73 @@
+import gzip
+import io
+
+import pytest
+from flask import send_file
+
+import app as estoque
+
+
+def _pagina(cliente, codificacao):
+    # A tela de login passa de COMPRESS_MIN_SIZE e não exige sessão
+    return cliente.get("/login", headers={"Accept-Encoding": codificacao})
+
+
+@pytest.fixture
+def original(banco):
+    return estoque.app.test_client().get("/login", headers={"Accept-Encoding": "identity"}).data
+
+
+@pytest.mark.skipif(estoque.brotli is None, reason="brotli não instalado")
+def test_brotli(banco, original):
+    resposta = _pagina(estoque.app.test_client(), "br, gzip")
+    assert resposta.headers["Content-Encoding"] == "br"
+    assert "Accept-Encoding" in resposta.headers["Vary"]
+    assert estoque.brotli.decompress(resposta.data) == original
+
+
+def test_gzip(banco, original):
+    resposta = _pagina(estoque.app.test_client(), "gzip")
+    assert resposta.headers["Content-Encoding"] == "gzip"
+    assert len(resposta.data) < len(original)
+    assert gzip.decompress(resposta.data) == original
+
+
+def test_identity_segue_sem_compressao(banco, original):
+    resposta = _pagina(estoque.app.test_client(), "identity")
+    assert "Content-Encoding" not in resposta.headers
+    assert "Accept-Encoding" in resposta.headers["Vary"]
+    assert len(original) >= estoque.app.config["COMPRESS_MIN_SIZE"]
+
+
+def test_corpo_pequeno_segue_sem_compressao(cliente):
+    resposta = cliente.get("/buscar_ajax?query=x", headers={"Accept-Encoding": "gzip"})
+    assert resposta.status_code == 200
+    assert "Content-Encoding" not in resposta.headers
+
+
+def test_csv_em_streaming_e_comprimido(cliente):
+    resposta = cliente.get("/informacoes/export", headers={"Accept-Encoding": "gzip"})
+    assert resposta.headers["Content-Encoding"] == "gzip"
+    assert "Content-Length" not in resposta.headers
+    csv = gzip.decompress(resposta.data).decode("utf-8-sig")
+    assert csv.startswith(";".join(estoque.CABECALHO_EXPORT_LOG))
+
+
+@pytest.mark.skipif(estoque.Workbook is None, reason="openpyxl não instalado")
+def test_download_xlsx_nao_e_comprimido(cliente):
+    resposta = cliente.get("/informacoes/export?formato=xlsx", headers={"Accept-Encoding": "gzip, br"})
+    assert resposta.status_code == 200
+    assert "Content-Encoding" not in resposta.headers
+    assert resposta.data[:2] == b"PK"  # zip do XLSX intacto
+
+
+def test_send_file_nao_e_comprimido_mesmo_com_tipo_compressivel(banco):
+    # Um arquivo em texto enviado por send_file também segue como está
+    corpo = b"codigo;nome\n" * 500
+    with estoque.app.test_request_context(headers={"Accept-Encoding": "gzip"}):
+        resposta = send_file(io.BytesIO(corpo), mimetype="text/csv", download_name="x.csv")
+        resposta = estoque.comprimir_resposta(resposta)
+        assert resposta.direct_passthrough
+        assert "Content-Encoding" not in resposta.headers
+        resposta.direct_passthrough = False
+        assert resposta.get_data() == corpo
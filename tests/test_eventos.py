@@ -0,0 +1,77 @@
+import os
+import queue
+import threading
+import time
+
+import pytest
+from flask import has_app_context
+from sqlalchemy.exc import OperationalError
+
+import app as estoque
+
+
+def test_canal_local_entrega_a_todos_e_respeita_o_limite():
+    canal = estoque.CanalLocal(2)
+    a, b = canal.assinar(), canal.assinar()
+    assert canal.assinar() is None  # limite de streams: a página passa ao polling
+
+    canal.publicar([{"id": 1, "quantidade": 5}])
+    assert a.get_nowait() == b.get_nowait() == {"id": 1, "quantidade": 5}
+
+    canal.cancelar(a)
+    assert canal.assinar() is not None
+
+
+def test_commit_publica_o_saldo_e_rollback_descarta(banco, mercadoria, monkeypatch):
+    canal = estoque.CanalLocal(1)
+    monkeypatch.setattr(estoque, "canal_estoque", canal)
+    fila = canal.assinar()
+    local = estoque.LocalEstoque.query.filter_by(nome=estoque.LOCAL_PADRAO).one()
+
+    estoque.ajustar_estoque(mercadoria.id, local.id, -3)
+    banco.session.rollback()
+    assert fila.empty()
+
+    estoque.ajustar_estoque(mercadoria.id, local.id, -3)
+    banco.session.commit()
+    assert fila.get_nowait() == {"id": mercadoria.id, "quantidade": 7}
+
+
+def test_ouvinte_postgres_tem_contexto_do_app_e_reconecta(banco, monkeypatch):
+    tentativas = []
+    parado = threading.Event()
+
+    def conexao_recusada():
+        tentativas.append(has_app_context())
+        if len(tentativas) > 2:
+            parado.wait()  # fim do teste: a thread fica parada aqui
+        raise OperationalError("LISTEN estoque", {}, Exception("conexão recusada"))
+
+    monkeypatch.setattr(banco.engine, "raw_connection", conexao_recusada)
+    canal = estoque.CanalPostgres(1)
+    canal.ESPERA_MINIMA = 0.01
+    assert canal.assinar() is not None
+
+    prazo = time.monotonic() + 5
+    while len(tentativas) < 3 and time.monotonic() < prazo:
+        time.sleep(0.01)
+    assert tentativas[:3] == [True, True, True]
+    assert canal._ouvinte.is_alive()
+
+
+@pytest.mark.skipif(
+    not os.getenv("DATABASE_URL", "").startswith("postgresql"), reason="LISTEN/NOTIFY exige PostgreSQL"
+)
+def test_notify_chega_ao_assinante(banco):
+    canal = estoque.CanalPostgres(1)
+    fila = canal.assinar()
+    evento = {"id": 42, "quantidade": 3}
+    # O LISTEN sobe em segundo plano: publica até o primeiro evento chegar
+    for _ in range(50):
+        canal.publicar([evento])
+        try:
+            assert fila.get(timeout=0.1) == evento
+            return
+        except queue.Empty:
+            continue
+    pytest.fail("nenhum evento recebido por LISTEN")
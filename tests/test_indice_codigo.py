@@ -0,0 +1,55 @@
+import pytest
+from sqlalchemy import event
+
+import app as estoque
+
+
+@pytest.fixture
+def consultas(banco):
+    """SQL executado no banco durante o teste."""
+    executadas = []
+
+    def registrar(conn, cursor, sql, *args):
+        executadas.append(sql)
+
+    event.listen(banco.engine, "before_cursor_execute", registrar)
+    yield executadas
+    event.remove(banco.engine, "before_cursor_execute", registrar)
+
+
+def test_busca_com_indice_carregado_nao_consulta_o_banco(cliente, mercadoria, consultas):
+    resposta = cliente.get("/mercadorias/by-codigo/prf-1")
+    assert resposta.status_code == 200
+    assert resposta.get_json()["quantidade"] == 10
+    assert not [sql for sql in consultas if "mercadoria" in sql or "versao_tabela" in sql]
+
+
+def test_commit_deste_processo_aparece_na_hora(cliente, mercadoria, banco):
+    mercadoria.codigo = "PRF-2"
+    banco.session.commit()
+    assert cliente.get("/mercadorias/by-codigo/PRF-1").status_code == 404
+    assert cliente.get("/mercadorias/by-codigo/prf-2").get_json()["id"] == mercadoria.id
+
+    banco.session.delete(mercadoria)
+    banco.session.commit()
+    assert cliente.get("/mercadorias/by-codigo/PRF-2").status_code == 404
+
+
+def test_alteracao_fora_do_processo_chega_na_atualizacao(cliente, mercadoria, banco):
+    # UPDATE em massa: não passa pelos objetos da sessão, só pela sequência de sincronização
+    banco.session.execute(
+        estoque.db.update(estoque.Mercadoria).where(estoque.Mercadoria.id == mercadoria.id).values(quantidade=4)
+    )
+    estoque.marcar_sincronizacao("mercadoria", [mercadoria.id], banco.session)
+    banco.session.commit()
+    assert cliente.get("/mercadorias/by-codigo/PRF-1").get_json()["quantidade"] == 10
+
+    estoque.indice_codigo.atualizar()
+    assert cliente.get("/mercadorias/by-codigo/PRF-1").get_json()["quantidade"] == 4
+
+
+def test_indice_vazio_consulta_o_banco(cliente, mercadoria, monkeypatch):
+    monkeypatch.setattr(estoque.indice_codigo, "iniciar", lambda: None)
+    estoque.indice_codigo.limpar()
+    encontrado, linha = estoque.indice_codigo.buscar("prf-1")
+    assert (encontrado, linha["id"]) == (False, mercadoria.id)
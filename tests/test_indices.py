@@ -0,0 +1,167 @@
+"""
+EXPLAIN nas consultas das rotas: falha se alguma fizer Seq Scan em tabela grande.
+
+Roda só contra PostgreSQL (o plano do SQLite não diz nada sobre produção):
+
+    DATABASE_URL=postgresql://localhost/estoque_explain python -m pytest tests/test_indices.py
+
+Num banco vazio o teste aplica as migrações e popula dados sintéticos
+(INDICES_LINHAS, padrão 100000); num banco com dados usa os que houver.
+"""
+import os
+from datetime import date, datetime, timedelta
+
+import pytest
+from sqlalchemy import text
+
+import app as estoque
+
+pytestmark = pytest.mark.skipif(
+    not os.getenv("DATABASE_URL", "").startswith("postgresql"), reason="EXPLAIN exige PostgreSQL"
+)
+
+LIMIAR_TABELA_GRANDE = 10000  # linhas estimadas (pg_class.reltuples)
+
+
+def _consultas_das_rotas():
+    """Os mesmos construtores de consulta que as rotas executam, com valores típicos."""
+    m = estoque
+    inicio = datetime(2024, 1, 1)
+    vencendo = date.today() + timedelta(days=30)
+    return [
+        ("index", "versões das tabelas em cache", m.consulta_versoes(m.TABELAS_VERSIONADAS)),
+        ("buscar_ajax", "busca por nome ou código", m.consulta_busca_mercadorias("seed-123")),
+        ("adicionar", "código duplicado", m.consulta_codigo_existente("seed-123")),
+        ("relatorios", "filtro por grupo", m.consulta_relatorio(grupo_id=7)),
+        ("relatorios", "filtro por local", m.consulta_relatorio(local_id=3)),
+        ("relatorios", "filtro por grupo e local", m.consulta_relatorio(grupo_id=7, local_id=3)),
+        ("excluir_grupo", "mercadorias vinculadas", m.consulta_uso_grupo(m.Mercadoria, 7)),
+        ("excluir_grupo", "itens de NF vinculados", m.consulta_uso_grupo(m.ItemNotaFiscal, 7)),
+        ("excluir_fornecedor", "notas do fornecedor", m.consulta_notas_do_fornecedor(7)),
+        ("listar_notas_fiscais", "página de notas com totais", m.consulta_pagina_nfs(7)),
+        ("listar_notas_fiscais", "página distante de notas", m.consulta_pagina_nfs(7, pagina=20)),
+        ("gastos_fornecedor", "gasto por mês", m.consulta_gastos_por_mes(7)),
+        ("gastos_fornecedor", "gasto por grupo no ano", m.consulta_gastos_por_grupo(7, ano=2024)),
+        ("detalhar_nota_fiscal", "itens da nota", m.consulta_itens_nf(7)),
+        ("detalhar_nota_fiscal", "totais da nota", m.consulta_totais_nf(7)),
+        ("detalhar_nota_fiscal", "frequência dos tokens da descrição",
+         m.consulta_frequencia_tokens(["p:luva", "t:luv", "c:seed123"])),
+        ("detalhar_nota_fiscal", "candidatos pelos tokens da descrição",
+         m.consulta_postings(["p:luva", "c:seed123"])),
+        ("informacoes", "logs mais recentes", m.consulta_logs(m.condicoes_log())),
+        ("informacoes", "logs do usuário no período", m.consulta_logs(m.condicoes_log(inicio=inicio, usuario_id=7))),
+        ("informacoes", "logs da ação", m.consulta_logs(m.condicoes_log(acao="Entrada"))),
+        ("informacoes", "logs da mercadoria", m.consulta_logs(m.condicoes_log(mercadoria_id=7))),
+        ("detalhar_local", "saldos do local", m.consulta_saldos_local(3)),
+        ("detalhar_local", "movimentações do local", m.consulta_logs_local(3)),
+        ("listar_cirurgias", "cirurgias mais recentes", m.consulta_cirurgias()),
+        ("lotes_vencendo", "lotes vencendo em 30 dias", m.consulta_lotes_vencendo(vencendo)),
+        ("lotes_vencendo", "busca por número de lote", m.consulta_lotes_vencendo(vencendo, busca="L7-")),
+        ("baixar_estoque", "lotes FEFO das mercadorias", m.consulta_lotes_fefo([7, 8, 9])),
+        ("detalhar_lote", "entradas do lote", m.consulta_entradas_lote(7)),
+        ("detalhar_lote", "consumo do lote", m.consulta_consumos_lote(7)),
+    ]
+
+
+# A página inicial monta a tabela e o select de fornecedores com o catálogo
+# inteiro (em cache até a versão mudar): a varredura completa é o plano certo.
+LEITURAS_COMPLETAS = [
+    ("index", "tabela de estoque", lambda: estoque.consulta_tabela_estoque(), {"mercadoria"}),
+    ("index", "opções de fornecedores", lambda: estoque.consulta_opcoes_fornecedores(), {"fornecedor"}),
+]
+
+
+def _popular_dados_sinteticos(db, linhas):
+    """Insere dados sintéticos proporcionais a `linhas` (banco vazio)."""
+    fornecedores = max(linhas // 200, 10)
+    notas = max(linhas // 2, 10)
+    comandos = [
+        ("INSERT INTO usuario (username, password_hash, email, role) "
+         "SELECT 'seed', 'x', 'seed@estoque.local', 'funcionario' "
+         "WHERE NOT EXISTS (SELECT 1 FROM usuario)"),
+        ("INSERT INTO fornecedor (cnpj, nome, endereco, telefone, email) "
+         "SELECT 'seed-' || i, 'Fornecedor ' || i, '-', '-', '-' FROM generate_series(1, :fornecedores) i"),
+        ("INSERT INTO grupo (nome) SELECT 'Grupo ' || i FROM generate_series(0, 199) i"),
+        ("INSERT INTO mercadoria (nome, codigo, grupo_id, quantidade, preco) "
+         "SELECT 'Mercadoria ' || i, 'seed-' || i, g.id, i % 50, 1.0 "
+         "FROM generate_series(1, :linhas) i JOIN grupo g ON g.nome = 'Grupo ' || (i % 200)"),
+        ("INSERT INTO local_estoque (nome) SELECT 'Local ' || i FROM generate_series(1, 20) i"),
+        ("INSERT INTO estoque_local (local_id, mercadoria_id, quantidade) "
+         "SELECT l.id, m.id, m.quantidade FROM mercadoria m JOIN local_estoque l ON l.nome = 'Local ' || (m.id % 20 + 1)"),
+        ("INSERT INTO nota_fiscal (numero_nf, data_emissao, data_entrega, fornecedor_id) "
+         "SELECT 'seed-' || i, current_date - (i % 3650), current_date - (i % 3650), f.id "
+         "FROM generate_series(1, :notas) i JOIN fornecedor f ON f.cnpj = 'seed-' || (i % :fornecedores + 1)"),
+        ("INSERT INTO item_nota_fiscal (descricao, quantidade, preco_unitario, nota_fiscal_id) "
+         "SELECT 'Item ' || i, 1 + i % 10, 2.5, n.id "
+         "FROM generate_series(1, :linhas * 2) i JOIN nota_fiscal n ON n.numero_nf = 'seed-' || (i % :notas + 1)"),
+        ("INSERT INTO lote (mercadoria_id, lote, validade, quantidade) "
+         "SELECT m.id, 'L' || m.id || '-' || j, current_date + (m.id * 7 + j * 90) % 730 - 30, (m.id + j) % 20 "
+         "FROM mercadoria m CROSS JOIN generate_series(1, 3) j"),
+        ("INSERT INTO log_movimentacao (usuario_id, acao, descricao, data_hora) "
+         "SELECT (SELECT MIN(id) FROM usuario), 'Entrada', 'seed', now() - i * interval '1 minute' "
+         "FROM generate_series(1, :linhas * 2) i"),
+        ("INSERT INTO cirurgia (data_cirurgia, nome_paciente, referencia_produto, usuario_id, data_criacao) "
+         "SELECT current_date - (i % 3650), 'Paciente ' || i, '-', (SELECT MIN(id) FROM usuario), now() "
+         "FROM generate_series(1, :notas) i"),
+        ("INSERT INTO gasto_fornecedor (fornecedor_id, mes, grupo_id, itens, quantidade, valor) "
+         "SELECT n.fornecedor_id, date_trunc('month', n.data_emissao)::date, i.grupo_id, "
+         "COUNT(*), SUM(i.quantidade), SUM(i.quantidade * i.preco_unitario) "
+         "FROM item_nota_fiscal i JOIN nota_fiscal n ON n.id = i.nota_fiscal_id "
+         "GROUP BY n.fornecedor_id, date_trunc('month', n.data_emissao), i.grupo_id"),
+    ]
+    params = {"linhas": linhas, "fornecedores": fornecedores, "notas": notas}
+    for sql in comandos:
+        db.session.execute(text(sql), params)
+    estoque.indexar_mercadorias()
+    db.session.commit()
+    db.session.execute(text("ANALYZE"))
+    db.session.commit()
+
+
+def _seq_scans(plano):
+    """Percorre o plano JSON do EXPLAIN devolvendo as relações lidas por Seq Scan."""
+    encontrados = []
+    if plano.get("Node Type") == "Seq Scan":
+        encontrados.append(plano.get("Relation Name"))
+    for filho in plano.get("Plans", []):
+        encontrados.extend(_seq_scans(filho))
+    return encontrados
+
+
+@pytest.fixture(scope="module")
+def tabelas_grandes():
+    db = estoque.db
+    with estoque.app.app_context():
+        estoque.aplicar_migracoes()
+        if estoque.Mercadoria.query.first() is None:
+            _popular_dados_sinteticos(db, int(os.getenv("INDICES_LINHAS", 100000)))
+        yield {
+            nome for nome, tuplas in db.session.execute(
+                text("SELECT relname, reltuples FROM pg_class WHERE relkind = 'r'")
+            )
+            if tuplas >= LIMIAR_TABELA_GRANDE
+        }
+        db.session.remove()
+
+
+def _varridas(consulta):
+    db = estoque.db
+    sql = str(consulta.compile(dialect=db.engine.dialect, compile_kwargs={"literal_binds": True}))
+    plano = db.session.execute(text("EXPLAIN (FORMAT JSON) " + sql)).scalar()[0]["Plan"]
+    return set(_seq_scans(plano))
+
+
+@pytest.mark.parametrize(
+    "rota, descricao, consulta", [pytest.param(*c, id=f"{c[0]}: {c[1]}") for c in _consultas_das_rotas()]
+)
+def test_consulta_da_rota_usa_indice(tabelas_grandes, rota, descricao, consulta):
+    with estoque.app.app_context():
+        assert not _varridas(consulta) & tabelas_grandes
+
+
+@pytest.mark.parametrize(
+    "rota, descricao, consulta, completas", [pytest.param(*c, id=f"{c[0]}: {c[1]}") for c in LEITURAS_COMPLETAS]
+)
+def test_leitura_completa_so_varre_a_propria_tabela(tabelas_grandes, rota, descricao, consulta, completas):
+    with estoque.app.app_context():
+        assert not (_varridas(consulta()) - completas) & tabelas_grandes
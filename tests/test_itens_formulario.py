@@ -0,0 +1,38 @@
+import os
+import sys
+
+import pytest
+from werkzeug.datastructures import MultiDict
+
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+os.environ.setdefault("SECRET_KEY", "teste")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "api"))
+
+import app as estoque  # noqa: E402
+
+
+def _itens(linhas):
+    dados = MultiDict()
+    for mercadoria_id, quantidade in linhas:
+        dados.add("item_mercadoria_id", mercadoria_id)
+        dados.add("item_quantidade", quantidade)
+    with estoque.app.test_request_context(method="POST", data=dados):
+        return estoque._itens_do_formulario()
+
+
+def test_linha_em_branco_no_meio_nao_desloca_as_seguintes():
+    assert _itens([("3", "1"), ("", "5"), ("7", "2")]) == {3: 1, 7: 2}
+
+
+def test_linha_extra_vazia_do_formulario_e_ignorada():
+    assert _itens([("7", "2"), ("", "1")]) == {7: 2}
+
+
+def test_mercadoria_repetida_soma_as_quantidades():
+    assert _itens([("7", "2"), ("7", "3")]) == {7: 5}
+
+
+@pytest.mark.parametrize("quantidade", ["", "0", "-1", "abc"])
+def test_quantidade_invalida_com_mercadoria_e_erro(quantidade):
+    with pytest.raises(ValueError, match="Item 2"):
+        _itens([("3", "1"), ("7", quantidade), ("9", "4")])
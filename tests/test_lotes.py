@@ -0,0 +1,87 @@
+from datetime import date, timedelta
+
+import pytest
+
+import app as estoque
+
+HOJE = date.today()
+
+
+@pytest.fixture
+def local(banco):
+    return estoque.LocalEstoque.query.filter_by(nome=estoque.LOCAL_PADRAO).one()
+
+
+def _lote(banco, mercadoria, numero, validade, quantidade):
+    lote = estoque.entrada_lote(mercadoria.id, numero, validade, quantidade)
+    estoque.conferir_lotes(lote)
+    banco.session.commit()
+    return lote
+
+
+def _saldos(banco, mercadoria):
+    banco.session.expire_all()
+    return {lote.lote: lote.quantidade for lote in estoque.Lote.query.filter_by(mercadoria_id=mercadoria.id)}
+
+
+def test_saida_consome_primeiro_o_lote_que_vence_antes(banco, mercadoria, local):
+    _lote(banco, mercadoria, "TARDE", HOJE + timedelta(days=90), 3)
+    _lote(banco, mercadoria, "CEDO", HOJE + timedelta(days=10), 3)
+    _lote(banco, mercadoria, "SEM-DATA", None, 2)
+
+    consumidos = estoque.baixar_estoque(mercadoria.id, local.id, 4)
+    banco.session.commit()
+
+    assert [(lote.lote, q) for lote, q in consumidos] == [("CEDO", 3), ("TARDE", 1)]
+    assert _saldos(banco, mercadoria) == {"CEDO": 0, "TARDE": 2, "SEM-DATA": 2}
+
+
+def test_lote_vencido_nao_sai_pela_fefo(banco, mercadoria, local):
+    _lote(banco, mercadoria, "VENCIDO", HOJE - timedelta(days=1), 4)
+    _lote(banco, mercadoria, "VALIDO", HOJE + timedelta(days=30), 2)
+
+    # 2 do lote válido + 4 sem lote: cabe sem tocar no vencido
+    consumidos = estoque.baixar_estoque_varios(local.id, {mercadoria.id: 6})
+    banco.session.commit()
+    assert [(lote.lote, q) for lote, q in consumidos[mercadoria.id]] == [("VALIDO", 2)]
+    assert _saldos(banco, mercadoria) == {"VENCIDO": 4, "VALIDO": 0}
+
+
+def test_saida_que_precisaria_do_lote_vencido_e_recusada(banco, mercadoria, local):
+    _lote(banco, mercadoria, "VENCIDO", HOJE - timedelta(days=1), 4)
+
+    with pytest.raises(ValueError, match="VENCIDO"):
+        estoque.baixar_estoque_varios(local.id, {mercadoria.id: 7})
+    banco.session.rollback()
+    assert _saldos(banco, mercadoria) == {"VENCIDO": 4}
+    assert banco.session.get(estoque.Mercadoria, mercadoria.id).quantidade == 10
+
+
+def test_descarte_de_vencidos_consome_o_lote_vencido(cliente, banco, mercadoria, local):
+    _lote(banco, mercadoria, "VENCIDO", HOJE - timedelta(days=1), 4)
+    dados = {
+        "form_type": "movimentar", "mercadoria_id": mercadoria.id, "local_id": local.id,
+        "mov_type": "saida", "mov_quantidade": 4,
+    }
+
+    resposta = cliente.post("/adicionar", data={**dados, "mov_quantidade": 10})
+    assert resposta.headers["Location"].endswith("/adicionar")  # recusada
+    resposta = cliente.post("/adicionar", data={**dados, "descarte_vencidos": "1"})
+    assert resposta.headers["Location"].endswith("/")
+    assert _saldos(banco, mercadoria) == {"VENCIDO": 0}
+
+
+def test_lotes_nao_passam_do_estoque_nem_ficam_negativos(banco, mercadoria):
+    _lote(banco, mercadoria, "A", HOJE + timedelta(days=30), 8)
+
+    lote = estoque.entrada_lote(mercadoria.id, "B", None, 3)
+    with pytest.raises(ValueError, match="mais que o estoque total"):
+        estoque.conferir_lotes(lote)
+    banco.session.rollback()
+
+    lote = banco.session.get(estoque.Lote, estoque.Lote.query.filter_by(lote="A").one().id)
+    lote.quantidade -= 9
+    with pytest.raises(ValueError, match="saldo em -1"):
+        estoque.conferir_lotes(lote)
+    banco.session.rollback()
+    assert _saldos(banco, mercadoria) == {"A": 8}
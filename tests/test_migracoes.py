@@ -0,0 +1,82 @@
+import os
+import sys
+
+import pytest
+from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError
+
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+os.environ.setdefault("SECRET_KEY", "teste")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "api"))
+
+import app as estoque  # noqa: E402
+
+
+def _versao():
+    with estoque.db.engine.connect() as conn:
+        return estoque.versao_esquema(conn)
+
+
+def test_banco_vazio_sai_na_ultima_versao_com_dados_iniciais():
+    with estoque.app.app_context():
+        estoque.aplicar_migracoes()
+        assert _versao() == estoque.MIGRACOES[-1][0]
+        assert estoque.LocalEstoque.query.filter_by(nome=estoque.LOCAL_PADRAO).count() == 1
+        assert estoque.Grupo.query.filter_by(nome="Geral").count() == 1
+
+
+def test_passo_com_erro_interrompe_a_inicializacao(monkeypatch):
+    def falha(conn):
+        raise ValueError("coluna inexistente")
+
+    with estoque.app.app_context():
+        estoque.aplicar_migracoes()
+        ultima = estoque.MIGRACOES[-1][0]
+        monkeypatch.setattr(estoque, "MIGRACOES", estoque.MIGRACOES + [(ultima + 1, "Passo com erro", falha)])
+        with pytest.raises(RuntimeError, match=f"Migração {ultima + 1} .*coluna inexistente"):
+            estoque.aplicar_migracoes()
+        assert _versao() == ultima
+
+
+def _voltar_para_antes_dos_indices(banco):
+    """Simula um banco anterior à migração 7: sem o índice único em lower(codigo)
+    e ainda com o nome do grupo gravado na própria mercadoria."""
+    with banco.engine.begin() as conn:
+        conn.execute(text("DROP INDEX ix_mercadoria_codigo_lower"))
+        conn.execute(text("ALTER TABLE mercadoria ADD COLUMN grupo VARCHAR(100)"))
+        conn.execute(text("DELETE FROM schema_version WHERE version >= 7"))
+
+
+def _mercadorias(banco, *codigos):
+    grupo = estoque.Grupo.query.filter_by(nome="Geral").one()
+    banco.session.add_all(estoque.Mercadoria(nome=c, codigo=c, quantidade=0, grupo=grupo) for c in codigos)
+    banco.session.commit()
+
+
+def test_codigos_repetidos_sem_caixa_interrompem_a_migracao_7(banco):
+    _voltar_para_antes_dos_indices(banco)
+    _mercadorias(banco, "ABC-1", "abc-1", "Xyz", "XYZ", "unico")
+    banco.session.remove()
+
+    with pytest.raises(RuntimeError, match="Migração 7 ") as erro:
+        estoque.aplicar_migracoes()
+    mensagem = str(erro.value)
+    for codigo in ("'ABC-1' (id 1), 'abc-1' (id 2)", "'Xyz' (id 3), 'XYZ' (id 4)"):
+        assert codigo in mensagem
+    assert "unico" not in mensagem
+    assert _versao() == 6
+    # Nada foi apagado nem fundido
+    assert estoque.Mercadoria.query.count() == 5
+
+
+def test_migracao_7_recria_o_indice_sem_repetidos(banco, monkeypatch):
+    _voltar_para_antes_dos_indices(banco)
+    _mercadorias(banco, "ABC-1", "ABC-2")
+    banco.session.remove()
+    # Os passos seguintes já estão aplicados neste esquema
+    monkeypatch.setattr(estoque, "MIGRACOES", estoque.MIGRACOES[:7])
+
+    estoque.aplicar_migracoes()
+    assert _versao() == 7
+    with pytest.raises(IntegrityError):
+        _mercadorias(banco, "abc-1")
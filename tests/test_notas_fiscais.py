@@ -0,0 +1,84 @@
+from datetime import date
+
+import pytest
+
+import app as estoque
+
+
+@pytest.fixture
+def notas(banco):
+    """Duas notas do mesmo fornecedor; a primeira, de janeiro, com um item lançado no gasto."""
+    fornecedor = estoque.Fornecedor(cnpj="1", nome="Dental", endereco="-", telefone="-", email="-")
+    banco.session.add(fornecedor)
+    banco.session.flush()
+    janeiro = date(2026, 1, 10)
+    primeira = estoque.NotaFiscal(
+        numero_nf="NF-1", data_emissao=janeiro, data_entrega=janeiro, fornecedor_id=fornecedor.id
+    )
+    segunda = estoque.NotaFiscal(
+        numero_nf="NF-2", data_emissao=janeiro, data_entrega=janeiro, fornecedor_id=fornecedor.id
+    )
+    banco.session.add_all([primeira, segunda])
+    banco.session.flush()
+    _item(banco, primeira, 2, 5.0)
+    banco.session.commit()
+    return primeira, segunda
+
+
+def _item(banco, nota, quantidade, preco):
+    grupo = estoque.Grupo.query.filter_by(nome="Geral").one()
+    item = estoque.ItemNotaFiscal(
+        descricao="Luva", quantidade=quantidade, preco_unitario=preco, grupo=grupo, nota_fiscal=nota
+    )
+    banco.session.add(item)
+    estoque.acumular_gasto(item)
+    return item
+
+
+def _gastos(banco):
+    banco.session.expire_all()
+    return [
+        (g.mes, g.itens, g.quantidade, g.valor)
+        for g in estoque.GastoFornecedor.query.order_by(estoque.GastoFornecedor.mes)
+    ]
+
+
+def test_itens_da_mesma_chave_acumulam_numa_linha(banco, notas):
+    primeira, segunda = notas
+    item = _item(banco, segunda, 3, 2.0)
+    banco.session.commit()
+    assert _gastos(banco) == [(date(2026, 1, 1), 2, 5, 16.0)]
+
+    estoque.acumular_gasto(item, -1)
+    banco.session.commit()
+    assert _gastos(banco) == [(date(2026, 1, 1), 1, 2, 10.0)]
+
+    estoque.acumular_gasto(primeira.itens[0], -1)
+    banco.session.commit()
+    assert _gastos(banco) == []  # sem itens, a linha é apagada
+
+
+@pytest.mark.parametrize("dados, mensagem", [
+    ({"numero_nf": "NF-1", "data_emissao": "", "data_entrega": "2026-03-02"}, "datas válidas"),
+    ({"numero_nf": "NF-1", "data_emissao": "02/03/2026", "data_entrega": "2026-03-02"}, "datas válidas"),
+    ({"numero_nf": "", "data_emissao": "2026-03-02", "data_entrega": "2026-03-02"}, "datas válidas"),
+    ({"numero_nf": "NF-2", "data_emissao": "2026-03-02", "data_entrega": "2026-03-02"}, "Já existe"),
+], ids=["sem-emissao", "data-em-outro-formato", "sem-numero", "numero-repetido"])
+def test_edicao_invalida_nao_altera_nota_nem_gasto(cliente, banco, notas, dados, mensagem):
+    primeira, _ = notas
+    antes = _gastos(banco)
+
+    resposta = cliente.post(f"/nota_fiscal/{primeira.id}/editar", data=dados, follow_redirects=True)
+    assert mensagem in resposta.get_data(as_text=True)
+
+    assert _gastos(banco) == antes
+    nota = banco.session.get(estoque.NotaFiscal, primeira.id)
+    assert (nota.numero_nf, nota.data_emissao) == ("NF-1", date(2026, 1, 10))
+
+
+def test_edicao_valida_move_o_gasto_de_mes(cliente, banco, notas):
+    primeira, _ = notas
+    cliente.post(f"/nota_fiscal/{primeira.id}/editar", data={
+        "numero_nf": "NF-1A", "data_emissao": "2026-03-02", "data_entrega": "2026-03-03",
+    })
+    assert _gastos(banco) == [(date(2026, 3, 1), 1, 2, 10.0)]
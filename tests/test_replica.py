@@ -0,0 +1,73 @@
+import pytest
+from sqlalchemy import create_engine, text
+
+import app as estoque
+from conftest import SENHA
+
+
+def _preparar(engines, engine, codigo):
+    """Migra o banco de `engine` e cadastra uma mercadoria com `codigo`."""
+    engines[None] = engine
+    estoque.aplicar_migracoes()
+    grupo = estoque.Grupo.query.filter_by(nome="Geral").one()
+    estoque.db.session.add(estoque.Mercadoria(nome="Luva", codigo=codigo, quantidade=5, grupo=grupo, preco=1.0))
+    estoque.db.session.commit()
+    estoque.db.session.remove()
+
+
+@pytest.fixture
+def dois_bancos(tmp_path, monkeypatch):
+    """Primário e réplica em dois arquivos SQLite; cada um com uma mercadoria que o identifica."""
+    primario = create_engine(f"sqlite:///{tmp_path / 'primario.db'}")
+    replica = create_engine(f"sqlite:///{tmp_path / 'replica.db'}")
+    with estoque.app.app_context():
+        engines = estoque.db.engines
+        monkeypatch.setitem(engines, None, engines[None])  # devolve o banco dos outros testes no fim
+        monkeypatch.setitem(engines, "replica", replica)
+        _preparar(engines, replica, "DA-REPLICA")
+        _preparar(engines, primario, "DO-PRIMARIO")
+        usuario = estoque.Usuario(username="gerente", email="gerente@teste", role="gerente")
+        usuario.set_password(SENHA)
+        estoque.db.session.add(usuario)
+        estoque.db.session.commit()
+        estoque.db.session.remove()
+    monkeypatch.setitem(estoque.app.config, "SQLALCHEMY_BINDS", {"replica": str(replica.url)})
+    monkeypatch.setitem(estoque._estado_replica, "verificado_em", None)
+    cliente = estoque.app.test_client()
+    cliente.post("/login", data={"username": "gerente", "password": SENHA})
+    yield cliente, primario, replica
+    primario.dispose()
+    replica.dispose()
+
+
+def _busca(cliente):
+    return [m["codigo"] for m in cliente.get("/buscar_ajax?query=luva").get_json()]
+
+
+def _quantidade(engine):
+    with engine.connect() as conn:
+        return conn.execute(text("SELECT quantidade FROM mercadoria WHERE id = 1")).scalar()
+
+
+def test_rota_de_leitura_vai_para_a_replica(dois_bancos):
+    cliente, _, _ = dois_bancos
+    assert _busca(cliente) == ["DA-REPLICA"]
+
+
+def test_escrita_vai_para_o_primario_e_a_leitura_seguinte_tambem(dois_bancos):
+    cliente, primario, replica = dois_bancos
+    resposta = cliente.post("/adicionar", data={
+        "form_type": "movimentar", "mercadoria_id": 1, "local_id": 1, "mov_type": "entrada", "mov_quantidade": 3,
+    })
+    assert resposta.headers["Location"].endswith("/")
+    assert (_quantidade(primario), _quantidade(replica)) == (8, 5)
+    # Read-your-writes: logo após a escrita o usuário lê do primário
+    assert _busca(cliente) == ["DO-PRIMARIO"]
+
+
+def test_replica_indisponivel_le_do_primario(dois_bancos, tmp_path, monkeypatch):
+    cliente, _, _ = dois_bancos
+    with estoque.app.app_context():
+        inexistente = create_engine(f"sqlite:///{tmp_path / 'nao-existe' / 'replica.db'}")
+        monkeypatch.setitem(estoque.db.engines, "replica", inexistente)
+    assert _busca(cliente) == ["DO-PRIMARIO"]
@@ -0,0 +1,76 @@
+from datetime import datetime, timedelta
+
+import app as estoque
+from conftest import SENHA
+
+
+def _sid(cliente):
+    cookie = cliente.get_cookie(estoque.app.config["SESSION_COOKIE_NAME"])
+    return cookie and cookie.value
+
+
+def _expira_em(banco, sid, quando=None):
+    """Lê (ou, com `quando`, altera) a validade gravada da sessão."""
+    sessao = banco.session.get(estoque.SessaoUsuario, sid, populate_existing=True)
+    if quando is not None:
+        sessao.expira_em = quando
+        banco.session.commit()
+    return sessao.expira_em
+
+
+def test_sessao_vencida_e_recusada(cliente, banco):
+    assert cliente.get("/buscar_ajax?query=x").status_code == 200
+    _expira_em(banco, _sid(cliente), datetime.utcnow() - timedelta(seconds=1))
+
+    resposta = cliente.get("/buscar_ajax?query=x")
+    assert resposta.status_code == 302
+    assert resposta.headers["Location"].endswith("/login")
+
+
+def test_login_troca_o_id_da_sessao(gerente, banco):
+    cliente = estoque.app.test_client()
+    cliente.get("/")  # sem login: a mensagem flash cria uma sessão anônima
+    anonima = _sid(cliente)
+    assert anonima
+
+    cliente.post("/login", data={"username": gerente.username, "password": SENHA})
+    assert _sid(cliente) not in (None, anonima)
+    assert banco.session.get(estoque.SessaoUsuario, anonima) is None
+
+
+def test_validade_so_e_renovada_perto_do_fim(cliente, banco):
+    sid = _sid(cliente)
+    resposta = cliente.get("/buscar_ajax?query=x")
+    assert "Set-Cookie" not in resposta.headers  # ainda longe do fim: nada é regravado
+
+    perto_do_fim = datetime.utcnow() + timedelta(minutes=5)
+    _expira_em(banco, sid, perto_do_fim)
+    resposta = cliente.get("/buscar_ajax?query=x")
+    assert "Set-Cookie" in resposta.headers
+    assert _expira_em(banco, sid) > perto_do_fim + timedelta(minutes=30)
+
+
+def test_gravacao_amostrada_apaga_sessoes_vencidas(gerente, banco, monkeypatch):
+    vencida = estoque.SessaoUsuario(id="vencida", dados="{}", expira_em=datetime.utcnow() - timedelta(hours=1))
+    banco.session.add(vencida)
+    banco.session.commit()
+    cliente = estoque.app.test_client()
+
+    monkeypatch.setitem(estoque.app.config, "SESSION_LIMPEZA_AMOSTRA", 0.0)
+    cliente.post("/login", data={"username": gerente.username, "password": SENHA})
+    assert banco.session.get(estoque.SessaoUsuario, "vencida", populate_existing=True) is not None
+
+    monkeypatch.setitem(estoque.app.config, "SESSION_LIMPEZA_AMOSTRA", 1.0)
+    cliente.post("/login", data={"username": gerente.username, "password": SENHA})
+    banco.session.expunge_all()
+    assert banco.session.get(estoque.SessaoUsuario, "vencida") is None
+    assert banco.session.get(estoque.SessaoUsuario, _sid(cliente)) is not None
+
+
+def test_armazem_local_tambem_limpa_as_vencidas():
+    armazem = estoque.ArmazemSessaoLocal()
+    armazem.gravar("vencida", 1, "{}", datetime.utcnow() - timedelta(seconds=1))
+    armazem.gravar("valida", 1, "{}", datetime.utcnow() + timedelta(hours=1))
+    armazem.limpar_vencidas()
+    assert armazem.carregar("vencida") is None
+    assert armazem.carregar("valida") is not None
@@ -0,0 +1,74 @@
+import pytest
+
+import app as estoque
+
+
+@pytest.fixture
+def sync(cliente):
+    def buscar(desde=0):
+        resposta = cliente.get(f"/sync?since={desde}")
+        assert resposta.status_code == 200
+        return resposta.get_json()
+    return buscar
+
+
+def _nova_mercadoria(banco, codigo):
+    grupo = estoque.Grupo.query.filter_by(nome="Geral").one()
+    mercadoria = estoque.Mercadoria(nome=f"Item {codigo}", codigo=codigo, quantidade=0, grupo=grupo, preco=1.0)
+    banco.session.add(mercadoria)
+    banco.session.commit()
+    return mercadoria
+
+
+def _ids(lote):
+    return [linha["id"] for linha in lote]
+
+
+def test_criar_editar_excluir_em_sequencia(banco, sync):
+    inicio = sync()["versao"]
+
+    mercadoria = _nova_mercadoria(banco, "S-1")
+    criada = sync(inicio)
+    assert criada["versao"] > inicio
+    assert _ids(criada["mercadorias"]) == [mercadoria.id]
+    assert criada["fornecedores"] == [] and criada["excluidos"]["mercadoria"] == []
+
+    mercadoria.nome = "Renomeada"
+    banco.session.commit()
+    editada = sync(criada["versao"])
+    assert editada["versao"] > criada["versao"]
+    assert [linha["nome"] for linha in editada["mercadorias"]] == ["Renomeada"]
+
+    id_ = mercadoria.id
+    banco.session.delete(mercadoria)
+    banco.session.commit()
+    excluida = sync(editada["versao"])
+    assert excluida["versao"] > editada["versao"]
+    assert excluida["mercadorias"] == []
+    assert excluida["excluidos"]["mercadoria"] == [id_]
+
+
+def test_cliente_retoma_do_cursor(banco, sync):
+    primeira = _nova_mercadoria(banco, "S-1")
+    cursor = sync()["versao"]
+    segunda = _nova_mercadoria(banco, "S-2")
+
+    retomada = sync(cursor)
+    assert _ids(retomada["mercadorias"]) == [segunda.id]
+    assert sync(retomada["versao"])["mercadorias"] == []
+    # Sem cursor o cliente recebe tudo
+    assert {primeira.id, segunda.id} <= set(_ids(sync()["mercadorias"]))
+
+
+def test_exclusao_aparece_como_tombstone(banco, sync):
+    cursor = sync()["versao"]
+    mercadoria = _nova_mercadoria(banco, "S-1")
+    id_ = mercadoria.id
+    banco.session.delete(mercadoria)
+    banco.session.commit()
+
+    # Criada e excluída depois do cursor: o cliente só precisa do tombstone
+    alteracoes = sync(cursor)
+    assert id_ not in _ids(alteracoes["mercadorias"])
+    assert alteracoes["excluidos"]["mercadoria"] == [id_]
+    assert id_ not in sync(alteracoes["versao"])["excluidos"]["mercadoria"]